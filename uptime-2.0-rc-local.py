@@ -18,9 +18,8 @@
 
 # NOTE - temperature measurement is + or - 2 C
 #
-# Please change the temperature calculation appropriately depending on produyct you are using.
-#
-# Search for TempV an you will find it documented.
+# Please set the variable board to the product you are using - search for board.
+# The calibration and temperature calculation of each product is in uptime2/boards.py.
 #
 # If you are running this script in the background, you may not need to capture all the data. You can comment out the print statements.
 #
@@ -37,17 +36,31 @@
 # Enable print to run the code interactively.
 #
 
-import time
-import smbus
 import sys
 import os
-import subprocess
+import signal
 
-from smbus import SMBus
 from sys import exit
+from uptime2.boards import BOARDS
+from uptime2.capture import Capture
+from uptime2.daemon import Daemon
+from uptime2.guard import BusGuard
+from uptime2.i2c import open_bus
+from uptime2.logsink import LogWriter
+from uptime2.metrics import Metrics
+from uptime2.multi import Device, MultiMonitor, find_devices
+from uptime2.policy import Limits, Rules, SHUTDOWN
+from uptime2.ringbuf import SampleRing
+from uptime2.rollup import Rollups
+from uptime2.runtime import RuntimeEstimator
+from uptime2.sampler import Sampler
+from uptime2.snapshot import SnapshotWriter
+from uptime2.scheduler import Scheduler, FAST, NORMAL, SLOW
+from uptime2.shutdown import Shutdown
+from uptime2.tla2024 import TLA2024
 
-# for older PI's (version 1) use bus = SMBus(0) in statement below.
-bus = SMBus(1)
+# for older PI's (version 1) use bus_number = 0 in statement below.
+bus_number = 1
 # One of the 3 possible addresses of the unit.
 address = 0x48
 # address = 0x49
@@ -75,7 +88,9 @@ channel3        =     0b11110001   # Measure V across NTC, to measure Temperatur
 # channel2        =     0b11100101   # Measure V-battery
 # channel3        =     0b11110101   # Measure V across NTC, to measure Temperature.
 #
-# Data Rate set to default of 128 SPS
+# Data Rate - the config LSB 0x43 used so far selects 490 SPS (DR = 010, Table 8). A conversion
+# takes about 2 ms at this rate. Allowed rates are 128, 250, 490, 920, 1600, 2400 and 3300 SPS.
+data_rate = 490
 #
 #
 #####################################################################################################################
@@ -87,21 +102,85 @@ vref = 6.144 # This is the max Vref - allows us to measure Vin up to Vin + 0.3V
 #####################################################################################################################
 
 
-max_reading = 2097.0 # 2^11 - 1 = 12 bits of information, with MSB set to zero. See page 15 of data sheet.
+#####################################################################################################################
+# The product you are using. The Pi-UpTime and PiZ-UpTime use different NTC's and calibration.
+#####################################################################################################################
+board = "piz-uptime"    # PiZ-UpTime 2.0
+# board = "pi-uptime"   # Pi-UpTime UPS 2.0
+#####################################################################################################################
 
 # Now we determine the operating parameters.
 # lange = number of bytes to read. 
 # zeit (German for time) - tells how frequently you want the readings to be read from the ADC. Define the
-# time to sleep between the readings.
-# tiempo (Spanish - noun - for time) shows how frequently each channel is read in over the I2C bus. Best to use
-# timepo between each successive readings.
+# time between the start of each reading. The readings are kept on a fixed schedule, so the time the
+# reading itself takes does not add up. zeit_fast is used when Vin has failed or the battery is close
+# to V_batt_min, zeit_slow when Vin is fine and the battery is full (Vbattery >= V_batt_full).
+# tiempo (Spanish - noun - for time) is the longest time we wait for the ADC to finish one conversion.
+# The ADC is polled until the conversion is done, so normally the wait is only 1/data_rate.
 #
 # All the timeouts and other operational variables.
 lange = 0x02 # number of bytes to read in the block. Need for Debug statements below.
-zeit = 5     # number of seconds to sleep between each measurement group. This will read variables every zeit seconds.
-tiempo = 0.1 # number of seconds to sleep between each channel reading.
-# tiempo = 1/SPS (default is 128) + 1 ms - so tiempo can be as low as 0.002 seconds. We deliberately make it
-# higher here for readings to settle down. Fast enough for us. In fact, in many cases this may not even be needed.
+zeit = 5     # number of seconds between each measurement group.
+zeit_fast = 0.5 # number of seconds between each measurement group on battery or near V_batt_min.
+zeit_slow = 25 # number of seconds between each measurement group when on mains with a full battery.
+tiempo = 0.1 # max number of seconds to wait for each channel reading.
+# If the I2C bus fails, each bus call is tried 3 times, then the reading is blind (no values) - the checks go on.
+# See uptime2/guard.py.
+cycle_timeout = 1.0 # max number of seconds for a whole reading, even with the bus stuck.
+bus_reopen_after = 3 # blind readings in a row before the I2C bus is opened again.
+blind_time = 30 # Shut down if the Pi is on battery and there has been no reading for this many seconds.
+#
+# Burst mode - instead of one sample per channel, take burst samples of each channel at burst_rate SPS
+# and filter them. One noisy sample can then no longer trigger a shutdown. At 3300 SPS a burst of 8 on
+# all 4 channels takes a few tens of ms. Set burst = 1 to read one sample per channel.
+burst = 8             # number of samples per channel.
+burst_rate = 3300     # SPS for the burst - 128, 250, 490, 920, 1600, 2400 or 3300.
+burst_filter = "median" # "median", "trimmed-mean" or "ema" - see uptime2/filters.py.
+noise_margin = 3      # A reading must be past the limit in a rule by this many standard errors of the burst.
+#
+# This script is the only one which reads the ADC. Other programs - e.g. uptime-2.0.py - get the readings
+# from it over a Unix socket, so they do not disturb its conversions. See uptime2/daemon.py.
+socket_path = "/run/uptime2.sock"
+# The latest reading is also kept in this shared memory file, for programs which poll it often.
+# See uptime2/snapshot.py.
+snapshot_path = "/dev/shm/uptime2.snapshot"
+# The raw readings are kept in this ring buffer file, so there is a history to look at after an unexpected
+# shutdown. It keeps the last ring_capacity readings - 10 bytes each, about 6 MB for 604800 readings (a week
+# at 1 reading a second). Print them with "python3 -m uptime2.ringbuf /var/lib/uptime2/samples.ring".
+ring_path = "/var/lib/uptime2/samples.ring"
+ring_capacity = 604800
+# Min/max/mean/last of each reading per minute (31 days) and per hour (2 years) are kept in this folder.
+# See uptime2/rollup.py. Print them with "python3 -m uptime2.rollup /var/lib/uptime2".
+rollup_dir = "/var/lib/uptime2"
+# Every reading is logged to this file, "csv" or "jsonl". Lines are written in batches (log_buffer lines,
+# or every log_flush seconds) to save SD card writes, and the file is rotated at log_max_bytes. The log is
+# always flushed to the card before a shutdown. See uptime2/logsink.py.
+log_path = "/var/log/uptime2.csv"
+log_format = "csv"
+log_buffer = 64       # lines
+log_flush = 60        # seconds
+log_max_bytes = 1024*1024
+# Brownout capture. Between readings the ADC watches Vin at capture_rate SPS. When Vin drops below
+# capture_V_in, or changes faster than capture_slope V a second, capture_pre seconds before and capture_post
+# seconds after (all 4 channels) are saved to a file in capture_dir. It keeps the ADC converting all the
+# time, so it is off by default. See uptime2/capture.py. Print a capture with
+# "python3 -m uptime2.capture /var/lib/uptime2/captures/<file> --board piz-uptime".
+capture = False
+capture_dir = "/var/lib/uptime2/captures"
+capture_V_in = 4.5    # V
+capture_slope = 20.0  # V a second
+capture_pre = 0.2     # seconds
+capture_post = 1.0    # seconds
+capture_rate = 3300   # SPS
+# Several boards. With multi = True, every board found at 0x48, 0x49 and 0x4B on each bus in buses is read,
+# all at the same time, each with its own rules and battery estimate (address above is not used).
+# shutdown_when = "all" shuts down when the shutdown rule is true on every board - packs sharing the load -
+# and "any" on the first board. Each board is logged to log_path with its name added, e.g.
+# /var/log/uptime2-1-0x49.csv. There is no daemon socket, snapshot, ring buffer or rollups in this mode.
+# See uptime2/multi.py. "python3 -m uptime2.multi" shows which boards are found.
+multi = False
+buses = [1]
+shutdown_when = "all"
 #####################################################################################################################
 #####################################################################################################################
 # Battery V
@@ -109,6 +188,22 @@ tiempo = 0.1 # number of seconds to sleep between each channel reading.
 V_batt_min = 3.1 # Minimum V of battery at which time shutdown is triggered.
 # Change that if you want the shutdown to initiate sooner. Note at 2.5V all electronics
 # will be shut down.
+V_batt_full = 4.1 # At or above this V the battery is full - readings are taken every zeit_slow seconds.
+V_batt_margin = 0.2 # Readings are taken every zeit_fast seconds once the battery is within this V of V_batt_min.
+# Once Vin has failed, the battery runtime left is estimated from how fast Vbattery falls - see uptime2/runtime.py.
+# Shutdown starts when it is less than shutdown_time, or at V_batt_min, whichever comes first.
+V_batt_empty = 2.7 # The battery is empty at this V - the board cuts off at 2.5V.
+shutdown_time = 150 # Seconds the Pi needs to shut down cleanly - "shutdown -h 2" waits 2 minutes, plus the halt.
+runtime_memory = 120 # Seconds of discharge the estimate follows.
+temp_coeff = 0.01 # A cold battery is empty sooner - V_batt_empty goes up this many V per degree below 25C.
+# The shutdown itself - see uptime2/shutdown.py. "shutdown -h" is run directly, without a shell, after the
+# readings are flushed to the card. It waits shutdown_grace seconds (in whole minutes) so users can save their
+# work - less when the battery runtime left is short, and none ("now") once it is under shutdown_halt_time plus
+# a minute. With the PiZ-UpTime (14500 battery) shutdown_grace = 0 is recommended.
+shutdown_grace = 120 # seconds
+shutdown_halt_time = 30 # Seconds the Pi needs to halt.
+shutdown_hook = None # A command to run instead of shutdown, e.g. "/usr/local/bin/ups-shutdown". If it fails, shutdown is run.
+shutdown_log = "/var/log/uptime2-shutdown.log" # Each shutdown and how long it took to start is logged here.
 #=========================================================================================================
 # Min Voltage
 #=========================================================================================================
@@ -128,48 +223,61 @@ Temp_max = 60.0 # Max temperature after which battery charging should be discont
 # This range is lower/higher by about 10 degrees to allow corrective action.
 
 #=========================================================================================================
+# Rules
+#=========================================================================================================
+# The checks made on each reading - see uptime2/policy.py for how to write them. An action fires once
+# when its rule becomes true, not on every reading.
+# "for debounce" - only after debounce readings in a row, so one noisy reading does not shut down.
+# "clear" - hysteresis, the temperature must come back Temp_hysteresis degrees before it alerts again.
+# "every alert_interval" - alert at most once every alert_interval seconds.
+# "stale" - seconds since the last reading which worked. The checks keep what they last saw while blind.
+debounce = 3
+Temp_hysteresis = 3.0
+alert_interval = 600
+# The rules are made by Limits.rules() in uptime2/policy.py - the replay and the backtest in uptime2/replay.py
+# check the same ones:
+#	Vin < V_in_min for debounce and Vbattery < V_batt_min for debounce -> shutdown
+#	Vin < V_in_min and runtime < shutdown_time for debounce -> shutdown
+#	Vin < V_in_min and stale > blind_time -> shutdown
+#	Vin > V_in_min and TempC < Temp_min clear Temp_min + Temp_hysteresis for debounce -> too-cold every alert_interval
+#	Vin > V_in_min and TempC > Temp_max clear Temp_max - Temp_hysteresis for debounce -> too-hot every alert_interval
+limits = Limits(V_batt_min, V_in_min, Temp_min, Temp_max, noise_margin, shutdown_time, debounce, Temp_hysteresis, alert_interval, blind_time)
+rules = limits.rules()
+#=========================================================================================================
 
 
-# This is a subroutine which is called from the main routine. 
-# The variables passed are:
-# adc_address - I2C address for the device. 
-# adc_channel - the analog channel you want to read in.
+# The scan engine which reads the ADC - see uptime2/tla2024.py.
+# Instead of sleeping tiempo before and after each conversion, it triggers the
+# conversion and polls the chip until it is done. tiempo is now the longest
+# we wait for one conversion before giving up.
 #####################################################################################################################
 #####################################################################################################################
 
-def getreading(adc_address,adc_channel):
-#Debug
-#	print "ADC Address and channel is ", adc_address, adc_channel, "Sleeping for ", tiempo, " seconds."
+# open_bus uses combined I2C messages if smbus2 is installed, else the smbus calls.
+bus = open_bus(bus_number, board)
+adc = TLA2024(bus, address, data_rate=data_rate, timeout=tiempo)
 
-# Reset the registers (address and data) and then read the data.
-	bus.write_i2c_block_data(adc_address, 0x01, [0x85, 0x83]) #Reset config register
-	bus.write_i2c_block_data(adc_address, 0x00, [0x00, 0x00]) #Reset data register
-# Wait till the reading stabilize.
-	time.sleep(tiempo) # Wait for conversion to finish
-# Trigger the ADC for a one-shot reading on the channel.
-	bus.write_i2c_block_data(adc_address, 0x01, [adc_channel, 0x43]) # Initialize channel we want to read.
-	time.sleep(tiempo) # Wait for conversion to finish
-#
-# Debug
-# Print the Config Register
-#	readread = bus.read_i2c_block_data(adc_address, 0x01, lange)
-#	print "Config Reg is ", readread[1], readread[0]
+# Build the code to value tables for the board once. decoder.decode() turns the 4 codes
+# of a scan into Vin, Vbattery, Vout and TempC. See uptime2/boards.py.
+decoder = BOARDS[board].decoder(vref)
 
-# Read the data register.
-	reading  = bus.read_word_data(adc_address, 0) # Read data register
-#Debug - print the data read
-#	print "Data register read as 16 but word is ", reading
+sampler = Sampler(adc, decoder, (channel0, channel1, channel2, channel3), burst, burst_rate, burst_filter)
 
-# Do the proper bit movements. Refer to data sheet for how the bits are read in.
- 	valor = ((((reading) & 0xFF) <<8) | ((int(reading) & 0xFFF0)>>8))
-	valor = valor >> 4 # 4 LSB bits are ignored.
+# Readings within cycle_timeout, blind ones if the bus fails, and the bus opened again - see uptime2/guard.py.
+guard = BusGuard(sampler, lambda: open_bus(bus_number, board), cycle_timeout, bus_reopen_after)
 
-# Debug print the bit movement value...
-#	print("Valor is 0x%x" % valor)
+# The rules above, ready to evaluate - see uptime2/policy.py.
+policy = Rules(rules, noise_margin)
 
-	volts = valor/max_reading*vref
+# Battery runtime left while Vin has failed - see uptime2/runtime.py.
+estimator = RuntimeEstimator(V_in_min, V_batt_empty, runtime_memory, temp_coeff)
 
-	return volts
+# Sampling schedule - see uptime2/scheduler.py.
+scheduler = Scheduler({FAST: zeit_fast, NORMAL: zeit, SLOW: zeit_slow}, V_in_min, V_batt_min, V_batt_full, V_batt_margin)
+
+# The shutdown command, found now rather than when the battery is low - see uptime2/shutdown.py.
+# What it flushes first is added below.
+shutdown = Shutdown(shutdown_hook, shutdown_grace, shutdown_halt_time, log_path=shutdown_log)
 
 # End of sub routine
 #####################################################################################################################
@@ -177,50 +285,102 @@ def getreading(adc_address,adc_channel):
 
 # Main routine. 
 
-ch0_mult = 1 # Multiplier is used to offset any values and for calibration adjustments. Vin
-ch1_mult = 1 # Multiplier for Channel 1 - Vout
-ch2_mult = 1 # Multiplier for Channel 2 - Vbattery
-ch3_mult = 1 # Multiplier for Channel 3 - V for Temperature at the NTC (thermistor).
-
-# Main routine - shows an endless loop. If used with a cron script or a 
-# trigger via GPIO, an endless loop is not recommended.
+# Main routine - the daemon reads the ADC in an endless loop and calls on_sample() with each sample.
+# If used with a cron script or a trigger via GPIO, an endless loop is not recommended.
 #
 #
 
-while (True):
-	Vin = ch0_mult*getreading(address,channel0) + 0.08
-#	time.sleep(tiempo)
-	Vbattery = ch1_mult*getreading(address, channel1) + 0.08
-	Vout = ch1_mult*getreading(address, channel2) + 0.08
-	TempV = ch3_mult*getreading(address, channel3) + 0.08
-# For Pi-Z-UpTime 2.0 use the value below.
-	TempC = (3.95 - TempV) / 0.0432 # Temperature in C calculated.
-# Use the line below for Pi-UpTime UPS 2.0
-#	TempC = (4.236 - TempV) / 0.0408 # Temperature in C calculated.
+def on_sample(sample):
+	Vin, Vbattery, Vout, TempC = sample.Vin, sample.Vbattery, sample.Vout, sample.TempC
 # Convert C to F
 	TempF = TempC * 1.8 + 32.0  # Temperature in F
 #====================================================================================
 # Check to see if all operating conditions are OK. 
 #
 #====================================================================================
-	# If input V is low and battery V is low initiate the shutdown process.
-	if ( Vin < V_in_min ): # Vin has failed or is a brownout
-		if (Vbattery < V_batt_min ): # Battery is low, time to shutdown.
-#			print("Shutdown initiated at %s " % (time.ctime()))
-                	#
-			sys.stdout.flush()
-			subprocess.call("shutdown -h 2 &", shell=True)
-                	#
-                	# Sleep for a second or so for the shutdown process to fork and then exit
-                	# Print the values out if needed - ok for debug.
-			time.sleep(2)
-                	# Flush any stdout messages before exiting..
+	runtime = estimator.update(sample)
+	# The checks are in uptime2/policy.py, shared with uptime-2.0.py.
+	actions = policy.evaluate(sample, runtime)
+	# If input V is low and battery V is low initiate the shutdown process - again, after a while, if it failed.
+	if shutdown.due(policy.active(SHUTDOWN)): # Vin has failed or is a brownout, and the battery is low - time to shutdown.
+#		print("Shutdown initiated at %s " % (time.ctime()))
+		#
+		# Flush the log, snapshot, ring and rollups to the card, run shutdown (or shutdown_hook)
+		# and log how long it took from the threshold crossing. If no command worked, keep reading - it is
+		# tried again after a backoff, see uptime2/shutdown.py.
+		if shutdown(sample, "; ".join(policy.why(SHUTDOWN)), runtime, policy.since(SHUTDOWN))["ok"]:
 			exit() # Exit out of the code - no further print etc. is printed.
 
 #====================================================================================
-# End of check statements. At end of the while statement.
+# End of check statements.
 #====================================================================================
 	sys.stdout.flush()
-# Sleep till next reading.
-	time.sleep(zeit)
+
+# Open a sink - make() returns it. One which can not be opened (the card is full or read-only, or the path can
+# not be created) is left out, and the readings and the shutdown checks go on without it. Returns None then.
+def open_sink(name, make):
+	try:
+		return make()
+	except (IOError, OSError) as e:
+		print ("Not keeping the %s - %s" % (name, e))
+		sys.stdout.flush()
+		return None
+
+if multi:
+	# One Device per board found, each with its own rules, estimate and log. The monitor returns
+	# once shutdown_boards() has shut down - the logs are flushed to the card first.
+	# All boards time their stages into one Metrics - "kill -USR1 <pid>" writes them to stderr.
+	devices = []
+	metrics = Metrics()
+	metrics.print_on(signal.SIGUSR1)
+	log_root, log_ext = os.path.splitext(log_path)
+	for number, board_bus, board_address in find_devices(buses, board=board):
+		name = "%d-0x%02x" % (number, board_address)
+		board_adc = TLA2024(board_bus, board_address, data_rate=data_rate, timeout=tiempo, metrics=metrics)
+		board_log = open_sink("log of %s" % name, lambda: LogWriter("%s-%s%s" % (log_root, name, log_ext), log_format,
+			buffer_lines=log_buffer, flush_interval=log_flush, max_bytes=log_max_bytes))
+		if board_log is not None:
+			shutdown.flush.append(lambda board_log=board_log: board_log.flush(fsync=True))
+		devices.append(Device(name, number, board_address, board_adc,
+			Sampler(board_adc, decoder, (channel0, channel1, channel2, channel3), burst, burst_rate, burst_filter),
+			Rules(rules, noise_margin), RuntimeEstimator(V_in_min, V_batt_empty, runtime_memory, temp_coeff),
+			[sink for sink in [board_log] if sink is not None]))
+	if not devices:
+		exit("No UpTime boards found on I2C buses %s" % buses)
+
+	# Shut down when the monitor says so - again, after a backoff, while no command works.
+	# Timed from the threshold crossing of the last board to get low with "all", the first with "any".
+	def shutdown_boards(devices, due):
+		if not shutdown.due(due):
+			return False
+		low = [d for d in devices if d.rules.active(SHUTDOWN)]
+		reason = ["%s: %s" % (d.name, "; ".join(d.rules.why(SHUTDOWN))) for d in low]
+		reason += ["%s: no reading for %d seconds" % (d.name, d.sample.time - d.rules.seen) for d in devices if d not in low]
+		since = [d.rules.since(SHUTDOWN) for d in low]
+		since = max(since) if shutdown_when == "all" else min(since)
+		return shutdown(low[0].sample, "; ".join(reason), low[0].runtime, since)["ok"]
+
+	# A board with no reading for blind_time seconds does not hold up a shutdown with shutdown_when = "all".
+	monitor = MultiMonitor(devices, scheduler, burst, burst_rate, shutdown_when, cycle_timeout=cycle_timeout,
+		reopen_after=bus_reopen_after, stale_after=blind_time, on_shutdown=shutdown_boards)
+	monitor.run()
+	exit()
+
+log = open_sink("log", lambda: LogWriter(log_path, log_format, buffer_lines=log_buffer, flush_interval=log_flush, max_bytes=log_max_bytes))
+snapshot = open_sink("snapshot", lambda: SnapshotWriter(snapshot_path))
+ring = open_sink("ring buffer", lambda: SampleRing(ring_path, ring_capacity))
+rollups = open_sink("rollups", lambda: Rollups(rollup_dir))
+sinks = [sink for sink in (snapshot, ring, rollups, log) if sink is not None]
+shutdown.flush = [flush for sink, flush in ((log, lambda: log.flush(fsync=True)), (snapshot, lambda: snapshot.flush()),
+	(ring, lambda: ring.sync()), (rollups, lambda: rollups.flush())) if sink is not None]
+
+if capture:
+	brownouts = Capture(adc, decoder, (channel0, channel1, channel2, channel3), capture_dir, capture_V_in, capture_slope,
+		pre=capture_pre, post=capture_post, data_rate=capture_rate)
+else:
+	brownouts = None
+
+# The daemon keeps the stage latencies and bus error counts - "python3 -m uptime2.metrics" shows them, and
+# "kill -USR1 <pid>" writes them to stderr. See uptime2/metrics.py.
+Daemon(guard, scheduler, on_sample=on_sample, sinks=sinks, path=socket_path, capture=brownouts).run()
 # End of main loop.
\ No newline at end of file
@@ -19,9 +19,8 @@
 
 # NOTE - temperature measurement is + or - 2 C
 #
-# Please change the temperature calculation appropriately depending on produyct you are using.
-#
-# Search for TempV an you will find it documented.
+# Please set the variable board to the product you are using - search for board.
+# The calibration and temperature calculation of each product is in uptime2/boards.py.
 #
 # If you are running this script in the background, you may not need to capture all the data. You can comment out the print statements.
 #
@@ -39,18 +38,28 @@
 #
 
 import time
-import smbus
 import sys
 assert ('linux' in sys.platform), "This code runs on Linux only."
 import os
 import signal
-import subprocess
 
-from smbus import SMBus
 from sys import exit
+from uptime2.boards import BOARDS
+from uptime2.client import subscribe
+from uptime2.daemon import daemon_running, write_sinks, close_sinks
+from uptime2.guard import BusGuard
+from uptime2.i2c import open_bus
+from uptime2.metrics import RULES, OUTPUT
+from uptime2.policy import Limits, Rules, SHUTDOWN, TOO_COLD, TOO_HOT
+from uptime2.rollup import Rollups
+from uptime2.runtime import RuntimeEstimator
+from uptime2.sampler import Sampler
+from uptime2.scheduler import Scheduler, FAST, NORMAL, SLOW
+from uptime2.shutdown import Shutdown
+from uptime2.tla2024 import TLA2024
 
-# for older PI's (version 1) use bus = SMBus(0) in statement below.
-bus = SMBus(1)
+# for older PI's (version 1) use bus_number = 0 in statement below.
+bus_number = 1
 # One of the 3 possible addresses of the unit.
 address = 0x48
 # address = 0x49
@@ -78,7 +87,9 @@ channel3        =     0b11110001   # Measure V across NTC, to measure Temperatur
 # channel2        =     0b11100101   # Measure V-battery
 # channel3        =     0b11110101   # Measure V across NTC, to measure Temperature.
 #
-# Data Rate set to default of 128 SPS
+# Data Rate - the config LSB 0x43 used so far selects 490 SPS (DR = 010, Table 8). A conversion
+# takes about 2 ms at this rate. Allowed rates are 128, 250, 490, 920, 1600, 2400 and 3300 SPS.
+data_rate = 490
 #
 #
 #####################################################################################################################
@@ -90,21 +101,49 @@ vref = 6.144 # This is the max Vref - allows us to measure Vin up to Vin + 0.3V
 #####################################################################################################################
 
 
-max_reading = 2047.0 # 2^11 - 1 = 12 bits of information, with MSB set to zero. See page 15 of data sheet.
+#####################################################################################################################
+# The product you are using. The Pi-UpTime and PiZ-UpTime use different NTC's and calibration.
+#####################################################################################################################
+board = "pi-uptime"     # Pi-UpTime UPS 2.0
+# board = "piz-uptime"  # PiZ-UpTime 2.0
+#####################################################################################################################
 
 # Now we determine the operating parameters.
 # lange = number of bytes to read. 
 # zeit (German for time) - tells how frequently you want the readings to be read from the ADC. Define the
-# time to sleep between the readings.
-# tiempo (Spanish - noun - for time) shows how frequently each channel is read in over the I2C bus. Best to use
-# timepo between each successive readings.
+# time between the start of each reading. The readings are kept on a fixed schedule, so the time the
+# reading itself takes does not add up. zeit_fast is used when Vin has failed or the battery is close
+# to V_batt_min, zeit_slow when Vin is fine and the battery is full (Vbattery >= V_batt_full).
+# tiempo (Spanish - noun - for time) is the longest time we wait for the ADC to finish one conversion.
+# The ADC is polled until the conversion is done, so normally the wait is only 1/data_rate.
 #
 # All the timeouts and other operational variables.
 lange = 0x02 # number of bytes to read in the block. Need for Debug statements below.
-zeit = 2     # number of seconds to sleep between each measurement group. This will read variables every 20 seconds.
-tiempo = 0.1 # number of seconds to sleep between each channel reading.
-# tiempo = 1/SPS (default is 128) + 1 ms - so tiempo can be as low as 0.002 seconds. We deliberately make it
-# higher here for readings to settle down. Fast enough for us. In fact, in many cases this may not even be needed.
+zeit = 2     # number of seconds between each measurement group.
+zeit_fast = 0.5 # number of seconds between each measurement group on battery or near V_batt_min.
+zeit_slow = 25 # number of seconds between each measurement group when on mains with a full battery.
+                # The same as the rc-local script - fewer CPU wakeups while there is nothing to watch.
+tiempo = 0.1 # max number of seconds to wait for each channel reading.
+# If the I2C bus fails, each bus call is tried 3 times, then the reading is blind (no values) - the checks go on.
+# See uptime2/guard.py.
+cycle_timeout = 1.0 # max number of seconds for a whole reading, even with the bus stuck.
+bus_reopen_after = 3 # blind readings in a row before the I2C bus is opened again.
+blind_time = 30 # Shut down if the Pi is on battery and there has been no reading for this many seconds.
+#
+# Burst mode - instead of one sample per channel, take burst samples of each channel at burst_rate SPS
+# and filter them. One noisy sample can then no longer trigger a shutdown. At 3300 SPS a burst of 8 on
+# all 4 channels takes a few tens of ms. Set burst = 1 to read one sample per channel.
+burst = 8             # number of samples per channel.
+burst_rate = 3300     # SPS for the burst - 128, 250, 490, 920, 1600, 2400 or 3300.
+burst_filter = "median" # "median", "trimmed-mean" or "ema" - see uptime2/filters.py.
+noise_margin = 3      # A reading must be past the limit in a rule by this many standard errors of the burst.
+#
+# If uptime-2.0-rc-local.py is running it owns the ADC, and this script gets the readings from it over
+# this Unix socket instead of reading the ADC itself. See uptime2/daemon.py.
+socket_path = "/run/uptime2.sock"
+# When this script reads the ADC itself, it keeps min/max/mean/last per minute and per hour in this folder,
+# the same as uptime-2.0-rc-local.py does. See uptime2/rollup.py. Set rollup_dir = None to keep none.
+rollup_dir = "/var/lib/uptime2"
 #####################################################################################################################
 #####################################################################################################################
 # Battery V
@@ -112,6 +151,22 @@ tiempo = 0.1 # number of seconds to sleep between each channel reading.
 V_batt_min = 3.1 # Minimum V of battery at which time shutdown is triggered.
 # Change that if you want the shutdown to initiate sooner. Note at 2.5V all electronics
 # will be shut down.
+V_batt_full = 4.1 # At or above this V the battery is full - readings are taken every zeit_slow seconds.
+V_batt_margin = 0.2 # Readings are taken every zeit_fast seconds once the battery is within this V of V_batt_min.
+# Once Vin has failed, the battery runtime left is estimated from how fast Vbattery falls - see uptime2/runtime.py.
+# Shutdown starts when it is less than shutdown_time, or at V_batt_min, whichever comes first.
+V_batt_empty = 2.7 # The battery is empty at this V - the board cuts off at 2.5V.
+shutdown_time = 150 # Seconds the Pi needs to shut down cleanly - "shutdown -h 2" waits 2 minutes, plus the halt.
+runtime_memory = 120 # Seconds of discharge the estimate follows.
+temp_coeff = 0.01 # A cold battery is empty sooner - V_batt_empty goes up this many V per degree below 25C.
+# The shutdown itself - see uptime2/shutdown.py. "shutdown -h" is run directly, without a shell, after the
+# readings are flushed to the card. It waits shutdown_grace seconds (in whole minutes) so users can save their
+# work - less when the battery runtime left is short, and none ("now") once it is under shutdown_halt_time plus
+# a minute. With the PiZ-UpTime (14500 battery) shutdown_grace = 0 is recommended.
+shutdown_grace = 120 # seconds
+shutdown_halt_time = 30 # Seconds the Pi needs to halt.
+shutdown_hook = None # A command to run instead of shutdown, e.g. "/usr/local/bin/ups-shutdown". If it fails, shutdown is run.
+shutdown_log = "/var/log/uptime2-shutdown.log" # Each shutdown and how long it took to start is logged here.
 #=========================================================================================================
 # Min Voltage
 #=========================================================================================================
@@ -131,48 +186,67 @@ Temp_max = 60.0 # Max temperature after which battery charging should be discont
 # This range is lower/higher by about 10 degrees to allow corrective action.
 
 #=========================================================================================================
+# Rules
+#=========================================================================================================
+# The checks made on each reading - see uptime2/policy.py for how to write them. An action fires once
+# when its rule becomes true, not on every reading.
+# "for debounce" - only after debounce readings in a row, so one noisy reading does not shut down.
+# "clear" - hysteresis, the temperature must come back Temp_hysteresis degrees before it alerts again.
+# "every alert_interval" - alert at most once every alert_interval seconds.
+# "stale" - seconds since the last reading which worked. The checks keep what they last saw while blind.
+debounce = 3
+Temp_hysteresis = 3.0
+alert_interval = 600
+# The rules are made by Limits.rules() in uptime2/policy.py - the replay and the backtest in uptime2/replay.py
+# check the same ones:
+#	Vin < V_in_min for debounce and Vbattery < V_batt_min for debounce -> shutdown
+#	Vin < V_in_min and runtime < shutdown_time for debounce -> shutdown
+#	Vin < V_in_min and stale > blind_time -> shutdown
+#	Vin > V_in_min and TempC < Temp_min clear Temp_min + Temp_hysteresis for debounce -> too-cold every alert_interval
+#	Vin > V_in_min and TempC > Temp_max clear Temp_max - Temp_hysteresis for debounce -> too-hot every alert_interval
+limits = Limits(V_batt_min, V_in_min, Temp_min, Temp_max, noise_margin, shutdown_time, debounce, Temp_hysteresis, alert_interval, blind_time)
+rules = limits.rules()
+#=========================================================================================================
 
 
-# This is a subroutine which is called from the main routine. 
-# The variables passed are:
-# adc_address - I2C address for the device. 
-# adc_channel - the analog channel you want to read in.
+# The scan engine which reads the ADC - see uptime2/tla2024.py.
+# Instead of sleeping tiempo before and after each conversion, it triggers the
+# conversion and polls the chip until it is done. tiempo is now the longest
+# we wait for one conversion before giving up.
 #####################################################################################################################
 #####################################################################################################################
 
-def getreading(adc_address,adc_channel):
-#Debug
-#	print "ADC Address and channel is ", adc_address, adc_channel, "Sleeping for ", tiempo, " seconds."
+# open_bus uses combined I2C messages if smbus2 is installed, else the smbus calls.
+bus = open_bus(bus_number, board)
+adc = TLA2024(bus, address, data_rate=data_rate, timeout=tiempo)
 
-# Reset the registers (address and data) and then read the data.
-	bus.write_i2c_block_data(adc_address, 0x01, [0x85, 0x83]) #Reset config register
-	bus.write_i2c_block_data(adc_address, 0x00, [0x00, 0x00]) #Reset data register
-# Wait till the reading stabilize.
-	time.sleep(tiempo) # Wait for conversion to finish
-# Trigger the ADC for a one-shot reading on the channel.
-	bus.write_i2c_block_data(adc_address, 0x01, [adc_channel, 0x43]) # Initialize channel we want to read.
-	time.sleep(tiempo) # Wait for conversion to finish
-#
-# Debug
-# Print the Config Register
-#	readread = bus.read_i2c_block_data(adc_address, 0x01, lange)
-#	print "Config Reg is ", readread[1], readread[0]
+# Build the code to value tables for the board once. decoder.decode() turns the 4 codes
+# of a scan into Vin, Vbattery, Vout and TempC. See uptime2/boards.py.
+decoder = BOARDS[board].decoder(vref)
+
+sampler = Sampler(adc, decoder, (channel0, channel1, channel2, channel3), burst, burst_rate, burst_filter)
 
-# Read the data register.
-	reading  = bus.read_word_data(adc_address, 0) # Read data register
-#Debug - print the data read
-#	print "Data register read as 16 but word is ", reading
+# Readings within cycle_timeout, blind ones if the bus fails, and the bus opened again - see uptime2/guard.py.
+guard = BusGuard(sampler, lambda: open_bus(bus_number, board), cycle_timeout, bus_reopen_after)
 
-# Do the proper bit movements. Refer to data sheet for how the bits are read in.
-	valor = ((((reading) & 0xFF) <<8) | ((int(reading) & 0xFFF0)>>8))
-	valor = valor >> 4 # 4 LSB bits are ignored.
+# The rules above, ready to evaluate - see uptime2/policy.py.
+policy = Rules(rules, noise_margin)
 
-# Debug print the bit movement value...
-#	print("Valor is 0x%x" % valor)
+# Battery runtime left while Vin has failed - see uptime2/runtime.py.
+estimator = RuntimeEstimator(V_in_min, V_batt_empty, runtime_memory, temp_coeff)
 
-	volts = valor/max_reading*vref
+# Sampling schedule - see uptime2/scheduler.py.
+scheduler = Scheduler({FAST: zeit_fast, NORMAL: zeit, SLOW: zeit_slow}, V_in_min, V_batt_min, V_batt_full, V_batt_margin)
 
-	return volts
+# The shutdown command, found now rather than when the battery is low - see uptime2/shutdown.py.
+def flush_sinks():
+	for sink in sinks:
+		sink.flush()
+shutdown = Shutdown(shutdown_hook, shutdown_grace, shutdown_halt_time, flush=[flush_sinks], log_path=shutdown_log)
+
+# How long each stage of a reading takes - bus calls, conversion waits, decode, rules and output - and the
+# bus errors. "kill -USR1 <pid>" prints them without stopping. See uptime2/metrics.py.
+metrics = adc.metrics
 
 # End of sub routine
 #####################################################################################################################
@@ -181,104 +255,110 @@ def getreading(adc_address,adc_channel):
 def keyboardInterruptHandler(signal, frame):
 	print
 	print("KeyboardInterrupt (ID: {}) detected. Cleaning up...".format(signal))
+	stats = scheduler.stats()
+	if stats["cycles"]:
+		print("%d readings, %d missed deadlines, jitter mean %.1f ms max %.1f ms" % (stats["cycles"], stats["missed"], stats["jitter_mean"]*1000, stats["jitter_max"]*1000))
+		print(metrics.report())
+	close_sinks(sinks)
 	sys.stdout.flush()	
 	exit(0)
 #####################################################################################################################
 #####################################################################################################################
 # Start watching for Keyboard interrupt
 signal.signal(signal.SIGINT, keyboardInterruptHandler)
+metrics.print_on(signal.SIGUSR1, sys.stdout.fileno())
 
 # Main routine. 
 
-ch0_mult = 1 # Multiplier is used to offset any values and for calibration adjustments. Vin
-ch1_mult = 1 # Multiplier for Channel 1 - Vout
-ch2_mult = 1 # Multiplier for Channel 2 - Vbattery
-ch3_mult = 1 # Multiplier for Channel 3 - V for Temperature at the NTC (thermistor).
-
 # Main routine - shows an endless loop. If used with a cron script or a 
 # trigger via GPIO, an endless loop is not recommended.
 #
+# Read all 4 channels back-to-back on the schedule. sample.elapsed is the time the reading took.
+# Each sample is also written to the sinks, e.g. the rollups. A sink which fails (a full card) is skipped.
+sinks = []
+def local_samples():
+	if rollup_dir is not None:
+		try:
+			sinks.append(Rollups(rollup_dir))
+		except (IOError, OSError) as e:
+			print ("Not keeping rollups - %s" % e)
+	seq = 0
+	errors = {}
+	while (True):
+		sample = guard.read()
+		seq += 1
+		if sample.codes: # Nothing to record from a blind reading.
+			write_sinks(sinks, sample, seq, metrics, errors)
+		yield sample
+		scheduler.wait(sample)
+
+if daemon_running(socket_path):
+	print ("Readings from the uptime2 daemon at %s" % socket_path)
+	samples = subscribe(zeit, socket_path)
+else:
+	samples = local_samples()
 #
-print ("Date & Time               Vin   Vout  Batt-V  Board Temperature")
-while (True):
-# Read Channel 0 - Input Voltage - max 5.5V.
-	Vin = ch0_mult*getreading(address,channel0)
+print ("Date & Time               Vin   Vout  Batt-V  Board Temperature   Scan")
+for sample in samples:
+	began = time.monotonic()
+# Channel 0 - Input Voltage - max 5.5V, Channel 1 - Battery V, Channel 2 - Output V,
+# Channel 3 - Temperature, from the V across the NTC.
+	Vin, Vbattery, Vout, TempC = sample.Vin, sample.Vbattery, sample.Vout, sample.TempC
 #	if (Vin < V_in_min):
 #		Vin = 0
-# Sleep between each reading. Sleep time is in the subroutine. Use this to slow down readings further. 
-# Add sleep as needed.
-#	time.sleep(tiempo)
-# Read Channel 1 - Battery V
-	Vbattery = ch1_mult*getreading(address, channel1) + 0.2
-# Read Channel 2 - Output V
-	Vout = ch1_mult*getreading(address, channel2)
-# Read Channel 3 - Temperature.
-	TempV = ch3_mult*getreading(address, channel3)
-# For Pi-Z-UpTime 2.0 use the value below.
-#	TempC = (4.0 - TempV) / 0.0432 # Temperature in C calculated.
-# Use the below line for Pi-UpTime UPS 2.0
-	TempC = (4.236 - TempV) / 0.0408 # Temperature in C calculated.
 # Line below computes Temperature in F from C
 	TempF = TempC * 1.8 + 32.0  # Temperature in F
-# Temperature is measured by measuring the V across the NTC. We assume a linear behavior in the use range.
-# According to Murata data sheet, the measurement of temperature is determined as below.
-#	R = R_ambient * exp (B) (1/T - 1/Tambient)
-#	R_ambient = 10K
-#	T_ambient = 25 C (need this in kelvin) = 298.15 K
-#	We can avoid complexity in calculation by assuming linearity.
-#   Doing some measurements and calculations
-#  Depending on Thermister in use, 
-#  Temperature = -0.00812 * Temp_V + 9.164
-#   Temperature = -0.0408 * Temp_V + 4.0
-#     where Temp_V is the Voltage measured by ADC
-#   Temperature is in degrees C.
 # Print values calculated so far.
 
 #	if(Vin < V_in_min):
 #		print ("%s %5.2f %5.2f %5.2f    Vin Failure - not charging" % (time.ctime(), Vin, Vout, Vbattery)) 
 #	else:
 #		print ("%s %5.2f %5.2f %5.2f %8.2fC %6.2fF" % (time.ctime(), Vin, Vout, Vbattery, TempC, TempF)) 
-	print ("%s %5.2f %5.2f %5.2f %8.2fC %6.2fF" % (time.ctime(), Vin, Vout, Vbattery, TempC, TempF)) 
+	if not sample.codes: # A blind reading - the bus failed, see uptime2/guard.py.
+		print ("%s No reading from the ADC" % (time.ctime()))
+	else:
+		print ("%s %5.2f %5.2f %5.2f %8.2fC %6.2fF %5.1fms" % (time.ctime(), Vin, Vout, Vbattery, TempC, TempF, sample.elapsed*1000)) 
+	printed = time.monotonic()
 # Write the values read should there be an interrupt. Since output is to stdout, it needs to be flushed
 ##
 #====================================================================================
 # Check to see if all operating conditions are OK. This code is a duplicate of
 # the shutdown code used with the cron script.
 #====================================================================================
-	# If input V is low and battery V is low initiate the shutdown process.
-	if ( Vin < V_in_min ): # Vin has failed or is a brownout
-        	if (Vbattery < V_batt_min ): # Battery is low, time to shutdown.
-                	print("Shutdown initiated at %s " % (time.ctime()))
-                	#
-                	# The command shuts down the pi in 2 minutes. Replace
-                	# 2 with word "now" (without the quotes) for immediate
-                	# shutdown. If you use the Pi-Zero-Uptime (the one which uses 14500 battery)
-                	# recommend using "shutdown -h now" instead of shutdown -h 2.
-                	# The subprocess method forks a process which can run in the background while this
-                	# program exits properly. os.system method continues to run in the program thread.
-                	#
-                	print ("At %s, Vin = %4.2f, Vout = %4.2f, Vbattery = %4.2f, Temperature = %5.2fC %5.2fF" % (time.ctime(), Vin, Vout, Vbattery, TempC,TempF)) # Print the values see to initiate the shutdown.
-                	# print ("At %s, Vin = %4.2f, Vout = %4.2f, Vbattery = %4.2f" % (time.ctime(), Vin, Vout, Vbattery)) # Print the values see to initiate the shutdown.
-                	sys.stdout.flush()
-                	subprocess.call("shutdown -h 2 &", shell=True)
-                	#
-                	# Sleep for a second or so for the shutdown process to fork and then exit
-                	# Print the values out if needed - ok for debug.
-                	time.sleep(2)
-                	# Flush any stdout messages before exiting..
-                	exit() # Exit out of the code - no further print etc. is printed.
-                #
-                # Note the if statement falls out of the code if all is well.
-                #
+	runtime = estimator.update(sample)
+	if runtime is not None:
+		print ("Battery runtime left about %5.1f minutes" % (runtime / 60.0))
+	# The checks are in uptime2/policy.py, shared with uptime-2.0-rc-local.py.
+	actions = policy.evaluate(sample, runtime)
+	metrics.since(RULES, printed)
+	# If input V is low and battery V is low initiate the shutdown process - again, after a while, if it failed.
+	if shutdown.due(policy.active(SHUTDOWN)): # Vin has failed or is a brownout, and the battery is low - time to shutdown.
+		print("Shutdown initiated at %s " % (time.ctime()))
+		#
+		# The command shuts down the pi in shutdown_grace seconds. Set shutdown_grace = 0
+		# for immediate shutdown. If you use the Pi-Zero-Uptime (the one which uses 14500 battery)
+		# recommend using shutdown_grace = 0. The command runs in the background while this
+		# program exits properly.
+		#
+		print ("At %s, Vin = %4.2f, Vout = %4.2f, Vbattery = %4.2f, Temperature = %5.2fC %5.2fF" % (time.ctime(), Vin, Vout, Vbattery, TempC,TempF)) # Print the values see to initiate the shutdown.
+		# print ("At %s, Vin = %4.2f, Vout = %4.2f, Vbattery = %4.2f" % (time.ctime(), Vin, Vout, Vbattery)) # Print the values see to initiate the shutdown.
+		# Flush the rollups, run shutdown (or shutdown_hook) and log how long it took from the threshold crossing.
+		# If no command worked, keep reading - it is tried again after a backoff, see uptime2/shutdown.py.
+		if shutdown(sample, "; ".join(policy.why(SHUTDOWN)), runtime, policy.since(SHUTDOWN))["ok"]:
+			exit() # Exit out of the code - no further print etc. is printed.
+	#
+	# Note the if statement falls out of the code if all is well.
+	#
 	# You can comment out the temperature monitoring if you desire. The hardware will ensure temperature is in the operating
 	# range.
-	# Lets monitor temperature on the board.
-	if(Vin > V_in_min): # Vin is off - so temperature is not as critical for charging
-		if (TempC < Temp_min): # Temperature is too cold
-        		print ("Temperature is too cold for battery charging - at %s, Temperature is  %5.2f" % (time.ctime(), TempC))
-	if(Vin > V_in_min): # Vin is off - so temperature is not as critical for charging
-		if (TempC > Temp_max): # Temperature is too hot
-        		print ("Temperature is too hot for battery charging -  at %s, Temperature is  %5.2f" % (time.ctime(), TempC))
+	# Lets monitor temperature on the board. Only checked while Vin is on - temperature matters for charging.
+	# Each alert is printed once, and again after the temperature has been back in range.
+	if TOO_COLD in actions: # Temperature is too cold
+		print ("Temperature is too cold for battery charging - at %s, Temperature is  %5.2f" % (time.ctime(), TempC))
+	if TOO_HOT in actions: # Temperature is too hot
+		print ("Temperature is too hot for battery charging -  at %s, Temperature is  %5.2f" % (time.ctime(), TempC))
+	if TOO_COLD in policy.cleared or TOO_HOT in policy.cleared:
+		print ("Temperature is back in range for battery charging - at %s, Temperature is  %5.2f" % (time.ctime(), TempC))
 	# You can modify the code to page you or send you an email if the temperature gets too hot. A print statement is in
 	# in place as a place holder.
 
@@ -286,5 +366,6 @@ while (True):
 #====================================================================================
 # End of check statements.
 #====================================================================================
+	flushed = time.monotonic()
 	sys.stdout.flush()
-	time.sleep(zeit)
+	metrics.add(OUTPUT, printed - began + time.monotonic() - flushed)
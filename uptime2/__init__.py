@@ -0,0 +1,17 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Shared code for the Pi-UpTime 2.0 and PiZ-UpTime 2.0 scripts.
+#
+# The scripts uptime-2.0.py and uptime-2.0-rc-local.py import from this
+# folder, so keep it next to them (e.g. /home/pi/uptime/uptime2).
+#
+# Import from the modules, e.g. "from uptime2.tla2024 import TLA2024". The
+# package imports none of them itself, so "python3 -m uptime2.snapshot" and
+# the other commands load only what they use - not numpy and asyncio for a
+# snapshot read on a Pi Zero.
+#
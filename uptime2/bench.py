@@ -0,0 +1,132 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Acquisition benchmarks on the simulated bus (uptime2/sim.py).
+#
+#	reads    - for each transport (combined I2C messages or plain SMBus
+#	           calls) and burst setting: readings a second, bus
+#	           transactions a reading, CPU time and wall time a reading.
+#	decision - the time from Vin failing, with the battery already low, to
+#	           the shutdown rule firing - the point where the scripts call
+#	           shutdown - with the sampling schedule and rules of the scripts.
+#	           The failure comes at a different point of the schedule in each
+#	           trial.
+#
+# The noise and the trials are seeded, so two runs differ only by how the
+# machine schedules the threads. Run it before and after a change to the
+# scan engine or the main loop:
+#
+#	python3 -m uptime2.bench
+#	python3 -m uptime2.bench --json > before.json
+#
+
+import json
+import random
+import time
+
+from uptime2.boards import BOARDS
+from uptime2.policy import Limits, Rules, SHUTDOWN
+from uptime2.runtime import RuntimeEstimator
+from uptime2.sampler import Sampler
+from uptime2.scheduler import Scheduler, FAST, NORMAL, SLOW
+from uptime2.sim import Scenario, constant, step, mains, open_sim_bus
+from uptime2.tla2024 import SINGLE_ENDED, TLA2024
+
+
+#
+# n readings with one transport and burst setting. Returns a dict of
+# samples_per_s, transactions_per_sample, cpu_ms and wall_ms (a reading).
+#
+def bench_reads(combined, burst, n=50, data_rate=490, burst_rate=3300, board="pi-uptime", clock_hz=100000):
+	bus = open_sim_bus(scenario=mains(), board=board, clock_hz=clock_hz, combined=combined)
+	adc = TLA2024(bus, 0x48, data_rate)
+	sampler = Sampler(adc, BOARDS[board].decoder(6.144), SINGLE_ENDED, burst, burst_rate)
+	sampler.read()
+	transactions = bus.transactions
+	cpu = time.process_time()
+	wall = time.monotonic()
+	for i in range(n):
+		sampler.read()
+	wall = time.monotonic() - wall
+	cpu = time.process_time() - cpu
+	return {
+		"transport": "combined" if combined else "smbus",
+		"burst": burst,
+		"samples_per_s": n / wall,
+		"transactions_per_sample": (bus.transactions - transactions) / float(n),
+		"cpu_ms": cpu / n * 1000,
+		"wall_ms": wall / n * 1000,
+	}
+
+
+#
+# Seconds from Vin failing to the shutdown rule firing, for each trial.
+# periods - the scheduler periods {FAST: ..., NORMAL: ..., SLOW: ...}.
+# rules - the rules of the scripts.
+#
+def bench_decision(periods, rules, trials=5, V_in_min=3.8, V_batt_min=3.1, burst=8, board="pi-uptime", seed=1, timeout=30.0):
+	rng = random.Random(seed)
+	latencies = []
+	for trial in range(trials):
+		fail = 1.0 + rng.random() * max(periods.values())
+		scenario = Scenario(step(5.1, 0.3, fail), constant(3.0), constant(5.0), constant(25.0), seed=seed + trial)
+		bus = open_sim_bus(scenario=scenario, board=board)
+		start = time.monotonic()
+		adc = TLA2024(bus, 0x48)
+		sampler = Sampler(adc, BOARDS[board].decoder(6.144), SINGLE_ENDED, burst)
+		scheduler = Scheduler(periods, V_in_min, V_batt_min, 4.1)
+		estimator = RuntimeEstimator(V_in_min)
+		policy = Rules(rules)
+		latency = None
+		while time.monotonic() - start < fail + timeout:
+			sample = sampler.read()
+			if SHUTDOWN in policy.evaluate(sample, estimator.update(sample)):
+				latency = time.monotonic() - start - fail
+				break
+			scheduler.wait(sample)
+		latencies.append(latency)
+	return latencies
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Benchmark uptime2 acquisition on the simulated bus.")
+	parser.add_argument("--reads", type=int, default=50, help="readings per read benchmark")
+	parser.add_argument("--trials", type=int, default=5, help="outages for the decision benchmark")
+	parser.add_argument("--zeit", type=float, default=2.0)
+	parser.add_argument("--zeit_fast", type=float, default=0.5)
+	parser.add_argument("--zeit_slow", type=float, default=2.0)
+	parser.add_argument("--debounce", type=int, default=3)
+	parser.add_argument("--skip-decision", action="store_true")
+	parser.add_argument("--json", action="store_true", help="print the results as JSON")
+	args = parser.parse_args()
+
+	results = {"reads": [], "decision": None}
+	for combined in (True, False):
+		for burst in (1, 8):
+			results["reads"].append(bench_reads(combined, burst, args.reads))
+	if not args.skip_decision:
+		# The rules of the scripts, as they are set up out of the box.
+		rules = Limits(3.1, 3.8, 5.0, 60.0, shutdown_time=150, debounce=args.debounce, blind_time=30).rules()
+		latencies = bench_decision({FAST: args.zeit_fast, NORMAL: args.zeit, SLOW: args.zeit_slow}, rules, args.trials)
+		done = [l for l in latencies if l is not None]
+		results["decision"] = {"latencies": latencies, "missed": len(latencies) - len(done),
+			"mean_s": sum(done) / len(done) if done else None, "max_s": max(done) if done else None}
+
+	if args.json:
+		print(json.dumps(results, indent=1))
+	else:
+		print("Transport  Burst  Samples/s  Transactions/sample  CPU ms/reading  Wall ms/reading")
+		for r in results["reads"]:
+			print("%-9s %6d %10.1f %20.1f %15.2f %16.2f" % (r["transport"], r["burst"], r["samples_per_s"],
+				r["transactions_per_sample"], r["cpu_ms"], r["wall_ms"]))
+		d = results["decision"]
+		if d is not None:
+			print("Vin failure to shutdown: %s s" % ", ".join("%.2f" % l if l is not None else "none" for l in d["latencies"]))
+			if d["mean_s"] is not None:
+				print("mean %.2f s, max %.2f s, %d without a shutdown" % (d["mean_s"], d["max_s"], d["missed"]))
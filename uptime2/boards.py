@@ -0,0 +1,154 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Board profiles - the calibration of the Pi-UpTime 2.0 and PiZ-UpTime 2.0.
+#
+# The scripts used to convert each reading by hand - code/max_reading*vref,
+# a multiplier, an offset and a linear temperature formula which had to be
+# commented in or out for each board. A profile holds those numbers and
+# builds, once at startup, a table from every 12 bit code to the final
+# value of each channel. Decoding a scan is then one index per channel.
+#
+# The scan order used everywhere is channel0 - channel3:
+#	Vin, Vbattery, Vout, TempC
+#
+
+import math
+from array import array
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+CHANNELS = ("Vin", "Vbattery", "Vout", "TempC")
+
+CODES = 4096            # 12 bits
+KELVIN = 273.15
+
+
+# The data register is two's complement (page 15 of data sheet). A single
+# ended input can still read a little below 0V, which must not show up as
+# a large positive voltage.
+def signed_code(code):
+	if code & 0x800:
+		return code - CODES
+	return code
+
+
+#
+# NTC thermistor at channel3. The ADC measures the voltage across the NTC,
+# which sits at the bottom of a divider fed from supply through r_fixed.
+# R = R25 * exp(B * (1/T - 1/T25)) - see the Murata data sheet. If the
+# Steinhart-Hart coefficients (A, B, C) are known they are used instead:
+# 1/T = A + B * ln(R) + C * ln(R)^3
+#
+class NTC(object):
+	def __init__(self, supply, r_fixed, r25=10000.0, beta=3435.0, steinhart=None):
+		self.supply = supply
+		self.r_fixed = r_fixed
+		self.r25 = r25
+		self.beta = beta
+		self.steinhart = steinhart
+
+	def resistance(self, volts):
+		return self.r_fixed * volts / (self.supply - volts)
+
+	# Temperature in C for the voltage across the NTC. Voltages outside the
+	# divider range have no temperature and give NaN.
+	def temperature(self, volts):
+		if volts <= 0.0 or volts >= self.supply:
+			return float("nan")
+		r = self.resistance(volts)
+		if self.steinhart is not None:
+			a, b, c = self.steinhart
+			ln_r = math.log(r)
+			return 1.0 / (a + b * ln_r + c * ln_r ** 3) - KELVIN
+		return 1.0 / (1.0 / (25.0 + KELVIN) + math.log(r / self.r25) / self.beta) - KELVIN
+
+
+#
+# name - what the scripts put in the variable board.
+# max_reading - code for vref. 2^11 - 1 = 2047 unless calibrated.
+# mult - multiplier for each channel, for calibration adjustments.
+# offset - added to each channel in volts, e.g. the V drop in the R-C filter.
+# ntc - the NTC model for channel3. offset[3] is added before the model.
+#
+class Board(object):
+	def __init__(self, name, max_reading, mult, offset, ntc):
+		self.name = name
+		self.max_reading = max_reading
+		self.mult = mult
+		self.offset = offset
+		self.ntc = ntc
+
+	# Volts seen by channel for a 12 bit code, after calibration.
+	def volts(self, channel, code, vref):
+		return self.mult[channel] * signed_code(code) / self.max_reading * vref + self.offset[channel]
+
+	# vref is set by the PGA bits of the channel settings - 6.144 or 2.048.
+	def decoder(self, vref):
+		return Decoder(self, vref)
+
+
+class Decoder(object):
+	def __init__(self, board, vref):
+		self.board = board
+		self.vref = vref
+		self.tables = []
+		for channel in range(len(CHANNELS)):
+			table = array("d", [board.volts(channel, code, vref) for code in range(CODES)])
+			if CHANNELS[channel] == "TempC":
+				table = array("d", [board.ntc.temperature(v) for v in table])
+			self.tables.append(table)
+		self.arrays = None
+
+	# Decode one scan - a code for each channel - to (Vin, Vbattery, Vout, TempC).
+	def decode(self, codes):
+		t = self.tables
+		return t[0][codes[0]], t[1][codes[1]], t[2][codes[2]], t[3][codes[3]]
+
+	# Decode a list of codes of one channel, e.g. a burst. Returns a numpy
+	# array if numpy is installed, else a list.
+	def decode_channel(self, channel, codes):
+		if numpy is not None:
+			return self._arrays()[channel][numpy.asarray(codes) & (CODES - 1)]
+		table = self.tables[channel]
+		return [table[code] for code in codes]
+
+	def _arrays(self):
+		if self.arrays is None:
+			self.arrays = [numpy.frombuffer(table, dtype=numpy.float64) for table in self.tables]
+		return self.arrays
+
+	# Decode many scans at once, e.g. recorded raw codes. codes is an N x 4
+	# array of codes; returns an N x 4 array of values. Needs numpy.
+	def decode_array(self, codes):
+		arrays = self._arrays()
+		codes = numpy.asarray(codes) & (CODES - 1)
+		return numpy.column_stack([arrays[c][codes[:, c]] for c in range(len(CHANNELS))])
+
+
+#
+# The NTC supply and fixed resistor were chosen so the curve matches, at 25 C,
+# the linear formulas used before: (4.236 - TempV) / 0.0408 on the Pi-UpTime
+# and (3.95 - TempV) / 0.0432 on the PiZ-UpTime, for a 10K, B = 3435 Murata NTC.
+# Replace them with the measured values if you have them.
+#
+# Pi-UpTime 2.0 - calibration from uptime-2.0.py (Vbattery + 0.2V).
+# PiZ-UpTime 2.0 - calibration from uptime-2.0-rc-local.py (+ 0.08V, max_reading 2097).
+#
+BOARDS = {
+	"pi-uptime": Board("pi-uptime", 2047.0,
+		mult=(1.0, 1.0, 1.0, 1.0),
+		offset=(0.0, 0.2, 0.0, 0.0),
+		ntc=NTC(supply=4.788, r_fixed=4888.0)),
+	"piz-uptime": Board("piz-uptime", 2097.0,
+		mult=(1.0, 1.0, 1.0, 1.0),
+		offset=(0.08, 0.08, 0.08, 0.08),
+		ntc=NTC(supply=4.701, r_fixed=6381.0)),
+}
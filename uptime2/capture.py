@@ -0,0 +1,234 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Brownout capture - a recording of Vin around short dips.
+#
+# One reading every zeit seconds never sees the dips and switchover
+# glitches that last a few milliseconds. Between readings, Capture puts the
+# ADC in continuous mode on channel0 (Vin) at the top data rate and keeps
+# the last pre seconds of Vin in memory. When Vin drops below V_in_trigger,
+# or changes faster than slope_trigger volts a second, it records post
+# seconds of all channels (back-to-back scans) and saves the lot to a file
+# in directory - like an oscilloscope on single trigger.
+#
+# After a capture it only triggers again once Vin is back above
+# V_in_trigger and holdoff seconds have passed, so a long outage makes one
+# file, not hundreds. At most max_files are kept - the oldest go first.
+#
+# File, little endian:
+#
+#	header, 32 bytes:
+#	0   4s  magic "UPTC"
+#	4   B   version (1)
+#	5   B   reason - 1 Vin below V_in_trigger, 2 slope
+#	6   H   data rate, SPS
+#	8   d   time.time() of the trigger
+#	16  f   Vin at the trigger
+#	20  I   number of records
+#	24  8x
+#
+#	records, 7 bytes each, in time order:
+#	i   microseconds from the trigger (negative before it)
+#	B   channel, 0 - 3 (Vin, Vbattery, Vout, TempC)
+#	H   12 bit code
+#
+# Codes are kept raw - decode them with the board's Decoder. To print a
+# capture:
+#
+#	python3 -m uptime2.capture /var/lib/uptime2/captures/capture-20170101-120000.bin --board piz-uptime
+#
+
+import os
+import struct
+import time
+from collections import deque, namedtuple
+
+from uptime2.metrics import WATCH
+
+CAPTURE_MAGIC = b"UPTC"
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct("<4sBBHdfI8x")
+CAPTURE_RECORD = struct.Struct("<iBH")
+
+THRESHOLD = 1
+SLOPE = 2
+REASONS = {THRESHOLD: "threshold", SLOPE: "slope"}
+
+# reason - THRESHOLD or SLOPE. time - time.time() of the trigger.
+# Vin - at the trigger. records - (seconds from the trigger, channel, code).
+CaptureFile = namedtuple("CaptureFile", "reason data_rate time Vin records")
+
+
+def write_capture(path, reason, data_rate, trigger_time, Vin, records):
+	tmp = path + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, reason, data_rate, trigger_time, Vin, len(records)))
+		f.write(b"".join(CAPTURE_RECORD.pack(int(round(t * 1e6)), channel, code) for t, channel, code in records))
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmp, path)
+
+
+def read_capture(path):
+	with open(path, "rb") as f:
+		data = f.read()
+	magic, version, reason, data_rate, trigger_time, Vin, count = CAPTURE_HEADER.unpack_from(data, 0)
+	if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+		raise IOError("%s is not an uptime2 capture file" % path)
+	records = [(t / 1e6, channel, code) for t, channel, code in
+		CAPTURE_RECORD.iter_unpack(data[CAPTURE_HEADER.size:CAPTURE_HEADER.size + count * CAPTURE_RECORD.size])]
+	return CaptureFile(reason, data_rate, trigger_time, Vin, records)
+
+
+class Capture(object):
+	#
+	# adc - a TLA2024. decoder - from BOARDS[board].decoder(vref).
+	# channels - the config MSB of channel0 - channel3. channel0 is watched.
+	# directory - where capture files are saved.
+	# V_in_trigger - trigger when Vin is below this (volts).
+	# slope_trigger - trigger when Vin changes faster than this (volts a
+	# second, measured over slope_window seconds). None to not use it.
+	# pre, post - seconds kept before and recorded after the trigger.
+	# data_rate - SPS while watching and recording.
+	# holdoff - seconds after a capture before the next one.
+	# max_files - captures kept in directory.
+	#
+	def __init__(self, adc, decoder, channels, directory, V_in_trigger, slope_trigger=None, pre=0.2, post=1.0,
+			data_rate=3300, slope_window=0.005, holdoff=5.0, max_files=100):
+		self.adc = adc
+		self.vin = decoder.tables[0]
+		self.channels = channels
+		self.directory = directory
+		self.V_in_trigger = V_in_trigger
+		self.slope_trigger = slope_trigger
+		self.pre = pre
+		self.post = post
+		self.data_rate = data_rate
+		self.lag = max(1, int(slope_window * data_rate))
+		self.holdoff = holdoff
+		self.max_files = max_files
+		# (time.monotonic(), code) of Vin, one a conversion, for the last keep
+		# seconds - trimmed by time, so it holds pre seconds whatever the bus speed.
+		self.buffer = deque()
+		self.keep = max(pre, slope_window)
+		self.armed = True
+		self.last = None
+		self.captures = 0
+
+	# Should (t, code) trigger a capture? Returns THRESHOLD, SLOPE or None.
+	def triggered(self, t, code):
+		v = self.vin[code]
+		if v < self.V_in_trigger:
+			return THRESHOLD
+		if self.slope_trigger is not None and len(self.buffer) > self.lag:
+			t0, c0 = self.buffer[-self.lag - 1]
+			if t > t0 and abs(v - self.vin[c0]) > self.slope_trigger * (t - t0):
+				return SLOPE
+		return None
+
+	#
+	# Watch Vin until the time.monotonic() deadline, e.g. until the next
+	# scheduled reading. Returns the path of the capture saved, or None. A
+	# capture may run past the deadline by up to post seconds.
+	#
+	def watch(self, deadline):
+		adc = self.adc
+		rate = adc.data_rate
+		adc.set_data_rate(self.data_rate)
+		period = 1.0 / self.data_rate
+		buffer = self.buffer
+		try:
+			adc.start_continuous(self.channels[0])
+			# The first conversion, and anything left from before, is not Vin yet.
+			time.sleep(adc.conversion_time)
+			buffer.clear()
+			due = time.monotonic()
+			while True:
+				code = adc.read_code(WATCH)
+				t = time.monotonic()
+				reason = None
+				if self.armed:
+					reason = self.triggered(t, code)
+				elif self.vin[code] >= self.V_in_trigger and t - self.last >= self.holdoff:
+					self.armed = True
+				buffer.append((t, code))
+				while buffer[0][0] < t - self.keep:
+					buffer.popleft()
+				if reason is not None:
+					return self.record(reason, t, code)
+				if t >= deadline:
+					return None
+				# One read a conversion - a faster read only gets the same
+				# conversion again, and keeps the CPU and the bus busy. If the
+				# reads fell behind, start the schedule again from now.
+				due += period
+				left = due - time.monotonic()
+				if left > 0:
+					time.sleep(left)
+				elif left < -period:
+					due = time.monotonic()
+		finally:
+			adc.stop_continuous(self.channels[0])
+			adc.set_data_rate(rate)
+
+	# Record post seconds of all channels after the trigger at t and save.
+	def record(self, reason, t, code):
+		trigger_time = time.time()
+		records = [(bt - t, 0, bc) for bt, bc in self.buffer if bt >= t - self.pre]
+		end = t + self.post
+		now = t
+		while now < end:
+			scan = self.adc.scan(self.channels)
+			now = time.monotonic()
+			# times are back to back - the last one ends now.
+			done = now - scan.elapsed
+			for channel, (c, took) in enumerate(zip(scan.codes, scan.times)):
+				done += took
+				records.append((done - t, channel, c))
+		self.armed = False
+		self.last = now
+		self.captures += 1
+		path = os.path.join(self.directory, "capture-%s-%03d.bin" % (time.strftime("%Y%m%d-%H%M%S", time.localtime(trigger_time)),
+			int(trigger_time * 1000) % 1000))
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		write_capture(path, reason, self.data_rate, trigger_time, self.vin[code], records)
+		self.prune()
+		return path
+
+	def prune(self):
+		files = sorted(f for f in os.listdir(self.directory) if f.startswith("capture-") and f.endswith(".bin"))
+		for f in files[:max(0, len(files) - self.max_files)]:
+			os.unlink(os.path.join(self.directory, f))
+
+
+if __name__ == "__main__":
+	import argparse
+	from uptime2.boards import BOARDS, CHANNELS
+
+	parser = argparse.ArgumentParser(description="Print an uptime2 brownout capture file.")
+	parser.add_argument("path")
+	parser.add_argument("--board", default="pi-uptime", choices=sorted(BOARDS))
+	parser.add_argument("--vref", type=float, default=6.144)
+	parser.add_argument("--csv", action="store_true", help="one line per record: seconds,channel,value")
+	args = parser.parse_args()
+
+	capture = read_capture(args.path)
+	decoder = BOARDS[args.board].decoder(args.vref)
+	if args.csv:
+		print("seconds,channel,value")
+		for t, channel, code in capture.records:
+			print("%.6f,%s,%.3f" % (t, CHANNELS[channel], decoder.tables[channel][code]))
+	else:
+		print("Triggered at %s by %s, Vin = %.3f, %d SPS, %d records" % (time.ctime(capture.time),
+			REASONS.get(capture.reason, "?"), capture.Vin, capture.data_rate, len(capture.records)))
+		for channel, name in enumerate(CHANNELS):
+			values = [(t, decoder.tables[channel][code]) for t, c, code in capture.records if c == channel]
+			if values:
+				low = min(values, key=lambda x: x[1])
+				print("%-9s %5d records  %+.4f to %+.4f s  min %.3f at %+.4f s  max %.3f" % (name, len(values),
+					values[0][0], values[-1][0], low[1], low[0], max(v for t, v in values)))
@@ -0,0 +1,76 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Client for the telemetry daemon - see uptime2/daemon.py.
+#
+#	sample = latest()
+#	for sample in subscribe(2.0):
+#		print(sample.Vin)
+#	print(stats()["stages"]["scan"]["p99"])
+#
+# Samples come back as uptime2.sampler.Sample.
+#
+
+import json
+import socket
+
+from uptime2.daemon import SOCKET_PATH
+from uptime2.sampler import Sample
+
+
+def to_sample(d):
+	return Sample(d["time"], d["Vin"], d["Vbattery"], d["Vout"], d["TempC"],
+		tuple(d["codes"]), tuple(d["noise"]), d["elapsed"])
+
+
+def _request(path, request):
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	s.connect(path)
+	s.sendall((json.dumps(request) + "\n").encode())
+	return s
+
+
+def _replies(s):
+	f = s.makefile("r")
+	try:
+		for line in f:
+			reply = json.loads(line)
+			if "error" in reply:
+				raise IOError("uptime2 daemon: %s" % reply["error"])
+			yield reply
+	finally:
+		f.close()
+		s.close()
+
+
+# The latest sample from the daemon.
+def latest(path=SOCKET_PATH):
+	replies = _replies(_request(path, {"cmd": "latest"}))
+	try:
+		return to_sample(next(replies)["sample"])
+	except StopIteration:
+		raise IOError("uptime2 daemon closed the connection")
+	finally:
+		replies.close()
+
+
+# Yield samples every interval seconds (0 - every new sample) until the
+# daemon goes away.
+def subscribe(interval=0, path=SOCKET_PATH):
+	for reply in _replies(_request(path, {"cmd": "subscribe", "interval": interval})):
+		yield to_sample(reply["sample"])
+
+
+# The stage latencies and counters of the daemon - see uptime2/metrics.py.
+def stats(path=SOCKET_PATH):
+	replies = _replies(_request(path, {"cmd": "stats"}))
+	try:
+		return next(replies)["stats"]
+	except StopIteration:
+		raise IOError("uptime2 daemon closed the connection")
+	finally:
+		replies.close()
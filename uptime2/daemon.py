@@ -0,0 +1,253 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Telemetry daemon - the only process which touches the ADC.
+#
+# When uptime-2.0-rc-local.py ran in the background and someone started
+# uptime-2.0.py as well, both drove the ADC at the same time and could
+# corrupt each other's conversions. The daemon owns the bus: it reads the
+# ADC on the schedule and serves the latest sample over a Unix socket.
+# Any number of clients can attach without adding bus traffic.
+#
+# Protocol - one JSON object per line, both ways:
+#
+#	{"cmd": "latest"}
+#		-> {"sample": {...}}   the latest sample, once.
+#	{"cmd": "subscribe", "interval": 2.0}
+#		-> {"sample": {...}}   every interval seconds until the client
+#		   goes away. interval 0 sends every new sample.
+#	{"cmd": "stats"}
+#		-> {"stats": {...}}    the stage latencies and counters (see
+#		   uptime2/metrics.py), the schedule and the clients, once.
+#
+# A sample is the fields of uptime2.sampler.Sample plus seq, a counter
+# which goes up by one for each reading. See uptime2/client.py.
+#
+# On SIGUSR1 the daemon writes the same stats, as a table, to stderr.
+#
+
+import asyncio
+import functools
+import json
+import os
+import signal
+import socket
+import sys
+import time
+
+from uptime2.metrics import RULES, OUTPUT, CYCLE, SINK_ERRORS
+
+SOCKET_PATH = "/run/uptime2.sock"
+
+
+def sample_to_dict(sample, seq):
+	d = sample._asdict()
+	d["codes"] = list(sample.codes)
+	d["noise"] = list(sample.noise)
+	d["seq"] = seq
+	return d
+
+
+#
+# Write sample to each sink. A sink which fails - the card is full or
+# was remounted read-only, a bad record - must not stop the readings and
+# the shutdown checks: the error is counted in metrics (sink_errors), written
+# to stderr when it is new for the sink (errors keeps the last one of each),
+# and the other sinks still get the sample.
+#
+def write_sinks(sinks, sample, seq, metrics, errors):
+	for sink in sinks:
+		try:
+			sink.write(sample, seq)
+		except Exception as e:
+			metrics.count(SINK_ERRORS)
+			message = "%s" % e
+			if errors.get(sink) != message:
+				errors[sink] = message
+				sys.stderr.write("%s: %s\n" % (type(sink).__name__, message))
+				sys.stderr.flush()
+		else:
+			errors.pop(sink, None)
+
+
+# Close each sink. Errors are only reported - see write_sinks().
+def close_sinks(sinks):
+	for sink in sinks:
+		try:
+			sink.close()
+		except Exception as e:
+			sys.stderr.write("%s: %s\n" % (type(sink).__name__, e))
+
+
+# True if a daemon is answering on path.
+def daemon_running(path=SOCKET_PATH):
+	s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		s.connect(path)
+		return True
+	except (IOError, OSError):
+		return False
+	finally:
+		s.close()
+
+
+class Daemon(object):
+	#
+	# sampler - a Sampler, or a BusGuard (uptime2/guard.py) to keep going
+	# when the bus fails. scheduler - a Scheduler.
+	# on_sample - called in the daemon with each new sample, e.g. the
+	# shutdown checks. Keep it short, it runs between readings.
+	# sinks - where each sample is written, before on_sample is called, e.g.
+	# a SnapshotWriter. A sink has write(sample, seq), flush() and close().
+	# A sink which fails is counted and skipped, see write_sinks().
+	# path - the Unix socket. mode - its permissions, so other users can read.
+	# capture - a Capture (uptime2/capture.py) which watches Vin between
+	# readings, or None to leave the ADC idle. It runs through the
+	# sampler's call(), so a BusGuard gives it a deadline too.
+	# report_signal - the signal to write the stats on, None for none.
+	# The output, on_sample (as "rules") and cycle times go to the Metrics of
+	# the sampler.
+	#
+	def __init__(self, sampler, scheduler, on_sample=None, sinks=(), path=SOCKET_PATH, mode=0o666, capture=None,
+			report_signal=signal.SIGUSR1):
+		self.sampler = sampler
+		self.scheduler = scheduler
+		self.metrics = sampler.metrics
+		self.report_signal = report_signal
+		self.on_sample = on_sample
+		self.sinks = list(sinks)
+		self.sink_errors = {}
+		self.capture = capture
+		self.path = path
+		self.mode = mode
+		self.latest = None
+		self.seq = 0
+		self.clients = 0
+		self.new_sample = None
+
+	def run(self):
+		if daemon_running(self.path):
+			raise RuntimeError("another daemon is already serving %s" % self.path)
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		loop = asyncio.new_event_loop()
+		try:
+			loop.run_until_complete(self.main())
+		finally:
+			loop.close()
+			if os.path.exists(self.path):
+				os.unlink(self.path)
+
+	async def main(self):
+		self.new_sample = asyncio.Condition()
+		server = await asyncio.start_unix_server(self.handle, path=self.path)
+		os.chmod(self.path, self.mode)
+		if self.report_signal is not None:
+			asyncio.get_event_loop().add_signal_handler(self.report_signal, self.report)
+		try:
+			await self.sample_loop()
+		finally:
+			if self.report_signal is not None:
+				asyncio.get_event_loop().remove_signal_handler(self.report_signal)
+			server.close()
+			close_sinks(self.sinks)
+
+	# Read the ADC on the schedule. The read runs in a worker thread so the
+	# clients are served while the bus is busy.
+	async def sample_loop(self):
+		loop = asyncio.get_event_loop()
+		while True:
+			began = time.monotonic()
+			sample = await loop.run_in_executor(None, self.sampler.read)
+			self.seq += 1
+			now = time.monotonic()
+			# A blind sample (the bus failed, see uptime2/guard.py) has nothing to record.
+			if sample.codes:
+				write_sinks(self.sinks, sample, self.seq, self.metrics, self.sink_errors)
+			self.latest = sample_to_dict(sample, self.seq)
+			async with self.new_sample:
+				self.new_sample.notify_all()
+			now = self.metrics.since(OUTPUT, now)
+			if self.on_sample is not None:
+				self.on_sample(sample)
+				self.metrics.since(RULES, now)
+			self.metrics.since(CYCLE, began)
+			delay = self.scheduler.next_delay(sample)
+			if self.capture is not None and sample.codes:
+				deadline = self.scheduler.deadline
+				try:
+					# A capture may run post seconds past the deadline.
+					await loop.run_in_executor(None, self.sampler.call, functools.partial(self.capture.watch, deadline),
+						deadline + self.capture.post)
+				except (IOError, OSError):
+					await asyncio.sleep(max(0.0, self.scheduler.deadline - time.monotonic()))
+			else:
+				await asyncio.sleep(delay)
+			self.scheduler.woke()
+
+	def stats(self):
+		stats = self.metrics.snapshot()
+		stats["scheduler"] = self.scheduler.stats()
+		stats["clients"] = self.clients
+		stats["seq"] = self.seq
+		return stats
+
+	def report(self):
+		s = self.scheduler.stats()
+		sys.stderr.write("%s\n%d readings, %d missed deadlines, jitter mean %.1f ms max %.1f ms, %d clients\n" % (self.metrics.report(),
+			s["cycles"], s["missed"], s["jitter_mean"] * 1000, s["jitter_max"] * 1000, self.clients))
+		sys.stderr.flush()
+
+	async def wait_sample(self, seq):
+		async with self.new_sample:
+			while self.latest is None or self.latest["seq"] == seq:
+				await self.new_sample.wait()
+		return self.latest
+
+	async def send(self, writer, sample):
+		writer.write((json.dumps({"sample": sample}) + "\n").encode())
+		await writer.drain()
+
+	async def handle(self, reader, writer):
+		self.clients += 1
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				try:
+					request = json.loads(line.decode())
+					cmd = request["cmd"]
+				except (ValueError, KeyError, TypeError):
+					writer.write(b'{"error": "bad request"}\n')
+					continue
+				if cmd == "latest":
+					await self.send(writer, await self.wait_sample(None))
+				elif cmd == "stats":
+					writer.write((json.dumps({"stats": self.stats()}) + "\n").encode())
+					await writer.drain()
+				elif cmd == "subscribe":
+					await self.subscribe(writer, float(request.get("interval", 0)))
+					break
+				else:
+					writer.write((json.dumps({"error": "unknown cmd %s" % cmd}) + "\n").encode())
+		except (ConnectionError, IOError):
+			pass
+		finally:
+			self.clients -= 1
+			writer.close()
+
+	# Stream samples to a client. Nothing here touches the bus - a client
+	# asking for a faster rate than the schedule gets each sample once.
+	async def subscribe(self, writer, interval):
+		seq = None
+		while True:
+			sample = await self.wait_sample(seq)
+			seq = sample["seq"]
+			await self.send(writer, sample)
+			if interval > 0:
+				await asyncio.sleep(interval)
@@ -0,0 +1,93 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Filters which reduce a burst of readings of one channel to one value.
+#
+# Instead of sleeping tiempo "for readings to settle down" and trusting a
+# single sample, a burst of conversions is taken at a high data rate and
+# reduced here. Each filter returns the value and the variance of the
+# samples in the burst, so the checks can tell a real drop from noise.
+#
+# numpy is used when installed ("sudo apt install python3-numpy"), else
+# the same sums are done in plain Python.
+#
+
+import math
+from collections import namedtuple
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# value - the filtered value.
+# variance - variance of the samples in the burst (0 for one sample).
+# n - number of samples.
+Filtered = namedtuple("Filtered", "value variance n")
+
+
+# Standard error of the filtered value - how far it may be off because of noise.
+def stderr(filtered):
+	return math.sqrt(filtered.variance / filtered.n)
+
+
+def variance(values):
+	n = len(values)
+	if n < 2:
+		return 0.0
+	if numpy is not None:
+		return float(numpy.var(values, ddof=1))
+	mean = sum(values) / float(n)
+	return sum((v - mean) ** 2 for v in values) / (n - 1)
+
+
+def median(values):
+	if numpy is not None:
+		return Filtered(float(numpy.median(values)), variance(values), len(values))
+	s = sorted(values)
+	n = len(s)
+	if n % 2:
+		value = s[n // 2]
+	else:
+		value = (s[n // 2 - 1] + s[n // 2]) / 2.0
+	return Filtered(value, variance(values), n)
+
+
+# Mean of the samples left after dropping the lowest and highest trim fraction.
+def trimmed_mean(values, trim=0.25):
+	n = len(values)
+	k = int(n * trim)
+	if 2 * k >= n:
+		k = (n - 1) // 2
+	if numpy is not None:
+		s = numpy.sort(numpy.asarray(values, dtype=float))
+		return Filtered(float(s[k:n - k].mean()), variance(values), n)
+	s = sorted(values)[k:n - k]
+	return Filtered(sum(s) / float(len(s)), variance(values), n)
+
+
+# Exponential moving average through the burst, oldest sample first.
+# alpha is the weight of each new sample.
+def ema(values, alpha=0.3):
+	n = len(values)
+	if numpy is not None:
+		# The EMA is a weighted sum - the first sample carries the weight
+		# left over from all the others.
+		weights = alpha * (1.0 - alpha) ** numpy.arange(n - 1, -1, -1, dtype=float)
+		weights[0] = (1.0 - alpha) ** (n - 1)
+		return Filtered(float(numpy.dot(weights, values)), variance(values), n)
+	value = values[0]
+	for v in values[1:]:
+		value += alpha * (v - value)
+	return Filtered(value, variance(values), n)
+
+
+FILTERS = {
+	"median": median,
+	"trimmed-mean": trimmed_mean,
+	"ema": ema,
+}
@@ -0,0 +1,271 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Readings with a deadline, and recovery when the bus fails.
+#
+# An IOError from the bus, or a bus call which never comes back, used to stop
+# the main loop - and with it the shutdown checks. BusGuard reads the ADC in
+# a worker thread and waits at most cycle_timeout seconds for it:
+#
+#	- a reading which fails (after the retries of each bus call, see
+#	  uptime2/tla2024.py) or is not done in time gives a blind sample - the
+#	  values are NaN (uptime2.sampler.blind_sample()). read() never takes
+#	  much more than cycle_timeout, so the checks run on time whatever the
+#	  bus does.
+#	- after reopen_after failed readings in a row the bus is opened again
+#	  and the chip probed - in the worker thread, within the same
+#	  cycle_timeout. The old transport is closed. A worker stuck in a bus
+#	  call is left behind and a new one reads the new bus; the old transport
+#	  is closed when the stuck worker comes back. Until a worker comes back,
+#	  no new reading is started on it. The new worker owns the ADC (see
+#	  uptime2/tla2024.py), so the one left behind gets an error on its next
+#	  bus call - it never touches the new bus - and its result is dropped.
+#
+# Degraded mode - what the checks do with blind samples:
+#
+#	- conditions on a field which could not be read keep their state
+#	  (uptime2/policy.py), so a battery found low stays low.
+#	- "stale" is the seconds since the last good reading, e.g.
+#	  "Vin < 3.8 and stale > 30 -> shutdown" shuts down when the Pi has been
+#	  on the battery and blind for 30 seconds.
+#	- the battery runtime left counts down from the last estimate
+#	  (uptime2/runtime.py), so "runtime < shutdown_time" still fires.
+#	- readings come every zeit_fast seconds (uptime2/scheduler.py).
+#
+# Other work on the ADC between readings - the brownout watch of
+# uptime2/capture.py - goes through call(), in the same worker and with a
+# deadline, so it can not hang the daemon or use the bus at the same time as
+# a reading.
+#
+# While readings come, a shutdown is at most cycle_timeout + zeit_fast
+# later than on a bus which never fails. While the bus is blind, the rules
+# see no new values: a shutdown comes from what they saw last (a battery
+# found low stays low), from the runtime countdown, or, at the latest,
+# blind_time seconds after the last reading if Vin was low then - the stale
+# rule. A Pi on mains when the bus went blind is not shut down.
+#
+
+import queue
+import threading
+import time
+
+from uptime2.i2c import close_bus
+from uptime2.metrics import FAILED, REOPENS
+from uptime2.sampler import blind_sample
+from uptime2.tla2024 import probe
+
+
+class ReadTimeout(IOError):
+	pass
+
+
+#
+# Worker thread reading the ADC. ask() hands it a job - a reading, or
+# reopening the bus - and the result, or the exception, comes back on done.
+#
+# A worker stuck in a bus call is left behind with stop(). The transport it
+# is stuck on is given to retire(), and closed when the worker comes back
+# and exits - not before, since it may still be in use.
+#
+# adcs - the TLA2024s the worker reads. It owns them from now on, and a
+# worker which owned them before can no longer use them.
+#
+class ReadWorker(threading.Thread):
+	def __init__(self, read, name="uptime2-read", adcs=()):
+		threading.Thread.__init__(self, name=name)
+		self.daemon = True
+		self.reading = read
+		self.requests = queue.Queue()
+		self.done = queue.Queue()
+		self.busy = False
+		self.lock = threading.Lock()
+		self.exited = False
+		self.retired = []
+		self.adcs = list(adcs)
+		for adc in self.adcs:
+			adc.owner = self
+
+	def run(self):
+		try:
+			while True:
+				job = self.requests.get()
+				if job is None:
+					break
+				try:
+					self.done.put(job())
+				except Exception as e:
+					self.done.put(e)
+		finally:
+			with self.lock:
+				self.exited = True
+				retired, self.retired = self.retired, []
+			for bus in retired:
+				close_bus(bus)
+
+	# Start job, a reading if None.
+	def ask(self, job=None):
+		self.busy = True
+		self.requests.put(job or self.reading)
+
+	def stop(self):
+		self.requests.put(None)
+
+	# Let any thread use the ADCs again, e.g. once the readings are done.
+	def release(self):
+		for adc in self.adcs:
+			if adc.owner is self:
+				adc.owner = None
+
+	# Close bus once this worker is done with it.
+	def retire(self, bus):
+		with self.lock:
+			if not self.exited:
+				self.retired.append(bus)
+				return
+		close_bus(bus)
+
+
+class BusGuard(object):
+	#
+	# sampler - the Sampler of the board.
+	# reopen - called to open the bus again, returns a transport (e.g.
+	# lambda: open_bus(1)). None to not reopen it.
+	# cycle_timeout - the longest read() waits for a reading, in seconds.
+	# reopen_after - failed readings in a row before the bus is reopened.
+	#
+	def __init__(self, sampler, reopen=None, cycle_timeout=1.0, reopen_after=3):
+		self.sampler = sampler
+		self.metrics = sampler.metrics
+		self.reopen = reopen
+		self.cycle_timeout = cycle_timeout
+		self.reopen_after = max(1, reopen_after)
+		self.failures = 0
+		self.last_error = None
+		self.good = time.monotonic()
+		self.asked = None
+		self.worker = None
+		self.swap = threading.Lock()
+
+	# The worker, a new one if there is none. It owns the ADC from now on.
+	def start_worker(self):
+		if self.worker is None:
+			self.worker = ReadWorker(self.sampler.read, adcs=[self.sampler.adc])
+			self.worker.start()
+		return self.worker
+
+	# Like Sampler.read(), but never raises an I/O error - see above.
+	def read(self):
+		start = time.time()
+		began = time.monotonic()
+		deadline = began + self.cycle_timeout
+		worker = self.start_worker()
+		if worker.busy:
+			# The last reading, or a reopen, is still on the bus. Give it this
+			# cycle to come back - a reading is old by now - then read in what
+			# is left.
+			try:
+				worker.done.get(timeout=self.cycle_timeout)
+				worker.busy = False
+			except queue.Empty:
+				return self.failed(start, began, ReadTimeout("bus call stuck for %.1f seconds" % (time.monotonic() - self.asked)))
+		self.asked = began
+		worker.ask()
+		try:
+			result = worker.done.get(timeout=max(0.0, deadline - time.monotonic()))
+		except queue.Empty:
+			return self.failed(start, began, ReadTimeout("no reading after %.1f seconds" % self.cycle_timeout))
+		worker.busy = False
+		if isinstance(result, (IOError, OSError)):
+			return self.failed(start, began, result)
+		if isinstance(result, Exception):
+			raise result
+		self.failures = 0
+		self.good = time.monotonic()
+		return result
+
+	def failed(self, start, began, error):
+		self.failures += 1
+		self.last_error = error
+		self.metrics.count(FAILED)
+		if self.reopen is not None and self.failures % self.reopen_after == 0:
+			self.recover(began + self.cycle_timeout)
+		return blind_sample(start, time.monotonic() - began)
+
+	#
+	# Open the bus again and probe the chip, in the worker thread, waiting
+	# until deadline (time.monotonic()) at most. A stuck worker is left
+	# behind and a new one reopens the bus; if the old one ever comes back it
+	# gets Abandoned from the ADC and drops its reading, see above.
+	# Returns True if the chip answered in time. If the reopen is not done by
+	# deadline the worker stays busy with it - see read().
+	#
+	def recover(self, deadline=None):
+		if deadline is None:
+			deadline = time.monotonic() + self.cycle_timeout
+		stuck = None
+		if self.worker is not None and self.worker.busy:
+			stuck = self.worker
+			stuck.stop()
+			self.worker = None
+		worker = self.start_worker()
+		self.asked = time.monotonic()
+		worker.ask(lambda: self.reopen_bus(stuck))
+		try:
+			result = worker.done.get(timeout=max(0.0, deadline - time.monotonic()))
+		except queue.Empty:
+			return False
+		worker.busy = False
+		if isinstance(result, Exception):
+			self.last_error = result
+			return False
+		return result
+
+	# Run by the worker: the new transport replaces the old one, which is
+	# closed - by the stuck worker, if there is one, when it exits.
+	def reopen_bus(self, stuck):
+		adc = self.sampler.adc
+		bus = self.reopen()
+		with self.swap:
+			old, adc.bus = adc.bus, bus
+		if stuck is not None:
+			stuck.retire(old)
+		else:
+			close_bus(old)
+		self.metrics.count(REOPENS)
+		return probe(bus, adc.address)
+
+	#
+	# Run job (e.g. Capture.watch) in the worker, waiting until deadline
+	# (time.monotonic()) plus cycle_timeout at most. Returns what job
+	# returns, or raises its exception - ReadTimeout if it is not done in
+	# time, or the worker is still busy with the last reading. A job which is
+	# not done is left to the next read(), as a stuck reading is.
+	#
+	def call(self, job, deadline):
+		worker = self.start_worker()
+		if worker.busy:
+			raise ReadTimeout("bus call stuck for %.1f seconds" % (time.monotonic() - self.asked))
+		self.asked = time.monotonic()
+		worker.ask(job)
+		try:
+			result = worker.done.get(timeout=max(0.0, deadline + self.cycle_timeout - time.monotonic()))
+		except queue.Empty:
+			raise ReadTimeout("bus call not done after %.1f seconds" % (time.monotonic() - self.asked))
+		worker.busy = False
+		if isinstance(result, Exception):
+			raise result
+		return result
+
+	# Seconds since the last good reading.
+	def stale(self):
+		return time.monotonic() - self.good
+
+	def close(self):
+		if self.worker is not None:
+			self.worker.stop()
+			self.worker.release()
+			self.worker = None
@@ -0,0 +1,153 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# I2C access to the TLA2024 registers.
+#
+# Every SMBus call is its own ioctl and its own bus transaction. When the
+# smbus2 module is installed and the adapter can do plain I2C messages, we
+# use i2c_rdwr instead and pack several messages into one ioctl, joined with
+# repeated starts:
+#
+#	- reading the data register and triggering the next channel is a single
+#	  ioctl - pointer write, 2 byte read, config write.
+#	- after a config write the register pointer is left on the config register,
+#	  so polling the OS bit is a bare 2 byte read with no pointer write.
+#
+# Otherwise we fall back to the SMBus calls the scripts always used.
+# Install smbus2 with "sudo pip3 install smbus2".
+#
+
+import os
+
+try:
+	import smbus2
+except ImportError:
+	smbus2 = None
+
+REG_CONVERSION  = 0x00
+REG_CONFIG      = 0x01
+
+
+#
+# Transport using the plain SMBus calls. Works with smbus and smbus2.
+# transactions counts the ioctls made - one per call.
+#
+class SMBusTransport(object):
+	def __init__(self, bus):
+		self.bus = bus
+		self.transactions = 0
+
+	def write_config(self, address, msb, lsb):
+		self.transactions += 1
+		self.bus.write_i2c_block_data(address, REG_CONFIG, [msb, lsb])
+
+	# Returns the config register as [MSB, LSB].
+	def read_config(self, address):
+		self.transactions += 1
+		return self.bus.read_i2c_block_data(address, REG_CONFIG, 2)
+
+	# Returns the data register as a 16 bit value, MSB first.
+	def read_conversion(self, address):
+		self.transactions += 1
+		reading = self.bus.read_word_data(address, REG_CONVERSION)
+		# SMBus returns the LSB first - swap the bytes. See page 15 of data sheet.
+		return ((reading & 0xFF) << 8) | ((reading & 0xFF00) >> 8)
+
+	# Read the data register, then start the next conversion.
+	def read_conversion_and_write_config(self, address, msb, lsb):
+		value = self.read_conversion(address)
+		self.write_config(address, msb, lsb)
+		return value
+
+	def close(self):
+		self.bus.close()
+
+
+#
+# Transport using combined I2C messages (smbus2 i2c_rdwr).
+# pointer keeps the register pointer of each device, so we only write it
+# when it has to change.
+#
+class RdwrTransport(object):
+	def __init__(self, bus, i2c_msg):
+		self.bus = bus
+		self.msg = i2c_msg
+		self.pointer = {}
+		self.transactions = 0
+
+	# One ioctl. If it fails we no longer know where the pointer is.
+	def _rdwr(self, address, msgs):
+		self.transactions += 1
+		try:
+			self.bus.i2c_rdwr(*msgs)
+		except IOError:
+			self.pointer.pop(address, None)
+			raise
+
+	def write_config(self, address, msb, lsb):
+		self._rdwr(address, [self.msg.write(address, [REG_CONFIG, msb, lsb])])
+		self.pointer[address] = REG_CONFIG
+
+	# Build the messages to read a register - a bare read if the pointer is
+	# already there, else pointer write + repeated start + read.
+	def _read(self, address, register):
+		read = self.msg.read(address, 2)
+		if self.pointer.get(address) == register:
+			return [read], read
+		self.pointer[address] = register
+		return [self.msg.write(address, [register]), read], read
+
+	def read_config(self, address):
+		msgs, read = self._read(address, REG_CONFIG)
+		self._rdwr(address, msgs)
+		return list(read)
+
+	def read_conversion(self, address):
+		msgs, read = self._read(address, REG_CONVERSION)
+		self._rdwr(address, msgs)
+		data = list(read)
+		return (data[0] << 8) | data[1]
+
+	def read_conversion_and_write_config(self, address, msb, lsb):
+		msgs, read = self._read(address, REG_CONVERSION)
+		msgs.append(self.msg.write(address, [REG_CONFIG, msb, lsb]))
+		self._rdwr(address, msgs)
+		self.pointer[address] = REG_CONFIG
+		data = list(read)
+		return (data[0] << 8) | data[1]
+
+	def close(self):
+		self.pointer.clear()
+		self.bus.close()
+
+
+#
+# Open I2C bus number (1 on all but the oldest Pi's, which use 0) and
+# return the best transport the adapter supports.
+# With UPTIME2_BUS=sim in the environment the bus is simulated, with inputs
+# made for board (a name in uptime2.boards.BOARDS) - see uptime2/sim.py.
+#
+def open_bus(number, board="pi-uptime"):
+	if os.environ.get("UPTIME2_BUS") == "sim":
+		from uptime2.sim import open_sim_bus_from_environment
+		return open_sim_bus_from_environment(number, board)
+	if smbus2 is not None:
+		bus = smbus2.SMBus(number)
+		if bus.funcs & smbus2.I2cFunc.I2C:
+			return RdwrTransport(bus, smbus2.i2c_msg)
+		return SMBusTransport(bus)
+	import smbus
+	return SMBusTransport(smbus.SMBus(number))
+
+
+# Close a transport which is being replaced. It failed already, so an error
+# closing it is of no interest.
+def close_bus(bus):
+	try:
+		bus.close()
+	except (IOError, OSError):
+		pass
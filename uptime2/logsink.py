@@ -0,0 +1,116 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Log of every reading, in CSV or JSON Lines, for the background daemon.
+#
+# Writing and flushing a line for every reading means an SD card write per
+# reading. LogWriter keeps the lines in memory and writes them in one go
+# when buffer_lines are waiting or flush_interval seconds have passed. The
+# file is fsync'ed at most every fsync_interval seconds. When the file
+# reaches max_bytes it is rotated - uptime2.csv becomes uptime2.csv.1 and
+# so on, keeping backups old files.
+#
+# Call flush(fsync=True) before shutting down, so the last readings before
+# the power goes are on the card.
+#
+
+import json
+import math
+import os
+import time
+
+CSV_HEADER = "time,Vin,Vout,Vbattery,TempC,elapsed\n"
+
+
+def csv_line(sample):
+	return "%.1f,%.3f,%.3f,%.3f,%.2f,%.4f\n" % (sample.time, sample.Vin, sample.Vout, sample.Vbattery, sample.TempC, sample.elapsed)
+
+
+# JSON has no NaN (e.g. TempC with the NTC out of range) - use null.
+def number(value, digits):
+	if math.isnan(value):
+		return None
+	return round(value, digits)
+
+
+def json_line(sample):
+	return json.dumps({"time": round(sample.time, 1), "Vin": number(sample.Vin, 3), "Vout": number(sample.Vout, 3),
+		"Vbattery": number(sample.Vbattery, 3), "TempC": number(sample.TempC, 2), "elapsed": round(sample.elapsed, 4)}) + "\n"
+
+
+FORMATS = {
+	"csv": (csv_line, CSV_HEADER),
+	"jsonl": (json_line, ""),
+}
+
+
+class LogWriter(object):
+	#
+	# path - the log file. format - "csv" or "jsonl".
+	# buffer_lines - write when this many lines are waiting. The buffer
+	# never holds more.
+	# flush_interval - write at least this often (seconds).
+	# fsync_interval - fsync at least this often (seconds) - each fsync is an SD card write.
+	# max_bytes, backups - rotate the file at max_bytes, keep backups old files.
+	#
+	def __init__(self, path, format="csv", buffer_lines=64, flush_interval=60, fsync_interval=300,
+			max_bytes=1024 * 1024, backups=5):
+		self.path = path
+		self.line, self.header = FORMATS[format]
+		self.buffer_lines = buffer_lines
+		self.flush_interval = flush_interval
+		self.fsync_interval = fsync_interval
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.buffer = []
+		self.file = None
+		self.open()
+		self.flushed = self.synced = time.monotonic()
+
+	def open(self):
+		directory = os.path.dirname(self.path)
+		if directory and not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.file = open(self.path, "a")
+		if self.file.tell() == 0:
+			self.file.write(self.header)
+
+	# Daemon sink - see uptime2/daemon.py.
+	def write(self, sample, seq):
+		self.buffer.append(self.line(sample))
+		if len(self.buffer) >= self.buffer_lines or time.monotonic() - self.flushed >= self.flush_interval:
+			self.flush()
+
+	def flush(self, fsync=False):
+		now = time.monotonic()
+		if self.buffer:
+			self.file.write("".join(self.buffer))
+			self.buffer = []
+		self.file.flush()
+		self.flushed = now
+		if fsync or now - self.synced >= self.fsync_interval:
+			os.fsync(self.file.fileno())
+			self.synced = now
+		if self.file.tell() >= self.max_bytes:
+			self.rotate()
+
+	def rotate(self):
+		os.fsync(self.file.fileno())
+		self.file.close()
+		for n in range(self.backups - 1, 0, -1):
+			old = "%s.%d" % (self.path, n)
+			if os.path.exists(old):
+				os.rename(old, "%s.%d" % (self.path, n + 1))
+		if self.backups > 0:
+			os.rename(self.path, self.path + ".1")
+		else:
+			os.unlink(self.path)
+		self.open()
+
+	def close(self):
+		self.flush(fsync=True)
+		self.file.close()
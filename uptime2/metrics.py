@@ -0,0 +1,178 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Latency histograms of each stage of a reading, and bus error counters.
+#
+# When a reading takes 1.5 seconds instead of 0.8, these say where the time
+# went. Each stage has a histogram with fixed buckets - 50us to 10s in 1, 2,
+# 5 steps - so adding a time is a bisect and an increment, no memory is
+# allocated, and it can stay on on a Pi Zero. Stages:
+#
+#	trigger - config write starting a conversion (the register reset and
+#	          the trigger are the same write on the TLA2024).
+#	poll    - one read of the OS bit.
+#	wait    - from the trigger to the conversion being done - the sleep
+#	          plus the polls.
+#	read    - reading the conversion register (and triggering the next
+#	          conversion, see TLA2024.read_code_and_trigger()).
+#	watch   - a read while watching Vin for brownouts (uptime2/capture.py).
+#	scan    - a whole reading of all channels, burst included.
+#	decode  - codes to Vin, Vbattery, Vout and TempC, bursts filtered.
+#	rules   - runtime estimate, rules and what the script does with them.
+#	output  - the sinks and printing.
+#	cycle   - a whole reading, from the ADC to the output, without the
+#	          sleep until the next one.
+#
+# Counters: bus_errors (I/O errors from the bus), timeouts (conversions not
+# done in time), polls (OS bit reads), retries (bus calls tried again),
+# failed (readings given up on - see uptime2/guard.py), reopens (of the bus),
+# sink_errors (samples a sink could not write, e.g. the card is full).
+#
+# The daemon answers {"cmd": "stats"} with snapshot(), and the scripts print
+# report() on SIGUSR1 ("kill -USR1 <pid>") without stopping the readings.
+# To ask the daemon:
+#
+#	python3 -m uptime2.metrics
+#
+
+import bisect
+import os
+import signal
+import time
+
+TRIGGER = "trigger"
+POLL = "poll"
+WAIT = "wait"
+READ = "read"
+WATCH = "watch"
+SCAN = "scan"
+DECODE = "decode"
+RULES = "rules"
+OUTPUT = "output"
+CYCLE = "cycle"
+STAGES = (TRIGGER, POLL, WAIT, READ, WATCH, SCAN, DECODE, RULES, OUTPUT, CYCLE)
+
+BUS_ERRORS = "bus_errors"
+TIMEOUTS = "timeouts"
+POLLS = "polls"
+RETRIES = "retries"
+FAILED = "failed"
+REOPENS = "reopens"
+SINK_ERRORS = "sink_errors"
+COUNTERS = (BUS_ERRORS, TIMEOUTS, POLLS, RETRIES, FAILED, REOPENS, SINK_ERRORS)
+
+# Upper bound of each bucket, in seconds. A last bucket takes the rest.
+BOUNDS = tuple(m * 10.0 ** e for e in range(-5, 2) for m in (1, 2, 5))[2:-2]
+
+
+class Histogram(object):
+	def __init__(self):
+		self.counts = [0] * (len(BOUNDS) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		self.counts[bisect.bisect_left(BOUNDS, seconds)] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	# The upper bound of the bucket holding fraction q of the times - never
+	# more than the longest time seen.
+	def percentile(self, q):
+		if not self.count:
+			return 0.0
+		rank = q * self.count
+		seen = 0
+		for i, n in enumerate(self.counts):
+			seen += n
+			if seen >= rank and n:
+				break
+		return min(BOUNDS[i], self.max) if i < len(BOUNDS) else self.max
+
+	def mean(self):
+		return self.total / self.count if self.count else 0.0
+
+	def to_dict(self):
+		return {"count": self.count, "total": self.total, "max": self.max, "mean": self.mean(),
+			"p50": self.percentile(0.5), "p99": self.percentile(0.99), "buckets": list(self.counts)}
+
+
+class Metrics(object):
+	def __init__(self):
+		self.started = time.time()
+		self.stages = dict((stage, Histogram()) for stage in STAGES)
+		self.counters = dict((counter, 0) for counter in COUNTERS)
+
+	def add(self, stage, seconds):
+		self.stages[stage].add(seconds)
+
+	# Add the time since start (time.monotonic()) to stage. Returns now, to
+	# start the next stage from.
+	def since(self, stage, start):
+		now = time.monotonic()
+		self.stages[stage].add(now - start)
+		return now
+
+	def count(self, counter, n=1):
+		self.counters[counter] += n
+
+	def snapshot(self):
+		return {"since": self.started, "bounds": list(BOUNDS), "counters": dict(self.counters),
+			"stages": dict((stage, h.to_dict()) for stage, h in self.stages.items())}
+
+	def report(self):
+		return report(self.snapshot())
+
+	# Write report() to file descriptor fd (stderr) on signal signum, e.g.
+	# signal.SIGUSR1. The signal may come in the middle of a print, so the
+	# report goes straight to the descriptor - writing to sys.stdout from the
+	# handler then raises "reentrant call" and stops the script.
+	def print_on(self, signum, fd=2):
+		def handler(signum, frame):
+			data = (self.report() + "\n").encode()
+			try:
+				while data:
+					data = data[os.write(fd, data):]
+			except OSError:
+				pass
+		signal.signal(signum, handler)
+
+
+# A table of a snapshot().
+def report(snapshot):
+	lines = ["Stage       count     mean ms      p50 ms      p99 ms      max ms"]
+	for stage in STAGES:
+		h = snapshot["stages"].get(stage)
+		if h and h["count"]:
+			lines.append("%-8s %8d %11.3f %11.3f %11.3f %11.3f" % (stage, h["count"], h["mean"] * 1000,
+				h["p50"] * 1000, h["p99"] * 1000, h["max"] * 1000))
+	lines.append(", ".join("%s %d" % (c, snapshot["counters"].get(c, 0)) for c in COUNTERS))
+	return "\n".join(lines)
+
+
+if __name__ == "__main__":
+	import argparse
+	import json
+	from uptime2.client import stats
+	from uptime2.daemon import SOCKET_PATH
+
+	parser = argparse.ArgumentParser(description="Print the stage latencies and counters of the uptime2 daemon.")
+	parser.add_argument("--socket", default=SOCKET_PATH)
+	parser.add_argument("--json", action="store_true")
+	args = parser.parse_args()
+
+	snapshot = stats(args.socket)
+	if args.json:
+		print(json.dumps(snapshot, indent=1))
+	else:
+		s = snapshot["scheduler"]
+		print(report(snapshot))
+		print("%d readings, %d missed deadlines, jitter mean %.1f ms max %.1f ms, %d clients, up %d s" % (s["cycles"],
+			s["missed"], s["jitter_mean"] * 1000, s["jitter_max"] * 1000, snapshot["clients"], time.time() - snapshot["since"]))
@@ -0,0 +1,320 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Several UpTime boards, on one or more I2C buses.
+#
+# find_devices() probes the 3 addresses a board can have (0x48, 0x49,
+# 0x4B) on each bus. Each bus gets a worker thread; a reading of all boards
+# starts all workers at once. On one bus the conversions are pipelined -
+# see scan_many() in uptime2/tla2024.py - so a reading of every board takes
+# about as long as a reading of one.
+#
+# Each board (a Device) keeps its own rules, runtime estimate and sinks.
+# MultiMonitor reads all boards on the schedule and shuts down when the
+# shutdown rule is true on all boards (shutdown_when = "all", e.g. packs
+# sharing the load) or on any board ("any"). With "all", a board with no
+# reading for stale_after seconds does not hold the others back - its
+# conditions keep what they last saw, so a board which went blind on mains
+# would never be low. At least one board must be low.
+#
+# As with BusGuard (uptime2/guard.py), a bus which fails or does not answer
+# within cycle_timeout gives blind samples for its boards, and is opened
+# again after reopen_after failed readings in a row.
+#
+# To see which boards are found and their readings:
+#
+#	python3 -m uptime2.multi --bus 1 --board piz-uptime
+#
+
+import queue
+import threading
+import time
+
+from uptime2.daemon import write_sinks, close_sinks
+from uptime2.guard import ReadWorker
+from uptime2.i2c import open_bus, close_bus
+from uptime2.metrics import SCAN, RULES, OUTPUT, FAILED, REOPENS
+from uptime2.policy import SHUTDOWN
+from uptime2.sampler import blind_sample
+from uptime2.tla2024 import SINGLE_ENDED, TLA2024, probe, scan_many, burst_many
+
+ADDRESSES = (0x48, 0x49, 0x4B)
+
+
+class Device(object):
+	#
+	# name - e.g. "1-0x49". bus - the bus number. address - I2C address.
+	# adc - a TLA2024. sampler - a Sampler for the board, to turn codes into
+	# a Sample. rules - uptime2.policy.Rules. estimator - a RuntimeEstimator
+	# or None. sinks - written with each sample, see uptime2/daemon.py.
+	#
+	def __init__(self, name, bus, address, adc, sampler, rules, estimator=None, sinks=()):
+		self.name = name
+		self.bus = bus
+		self.address = address
+		self.adc = adc
+		self.sampler = sampler
+		self.rules = rules
+		self.estimator = estimator
+		self.sinks = list(sinks)
+		self.sink_errors = {}
+		self.sample = None
+		self.runtime = None
+		self.actions = []
+
+
+#
+# Probe the buses and return (bus number, transport, address) for each
+# board found. board - see uptime2.i2c.open_bus().
+#
+def find_devices(buses, addresses=ADDRESSES, board="pi-uptime"):
+	found = []
+	for number in buses:
+		bus = open_bus(number, board)
+		for address in addresses:
+			if probe(bus, address):
+				found.append((number, bus, address))
+	return found
+
+
+#
+# Worker thread of one bus - a ReadWorker (uptime2/guard.py) reading all
+# boards on it.
+#
+class BusWorker(ReadWorker):
+	def __init__(self, devices, burst=1, burst_rate=3300):
+		ReadWorker.__init__(self, self.read, "uptime2-bus-%s" % devices[0].bus, [d.adc for d in devices])
+		self.devices = devices
+		self.burst = burst
+		self.burst_rate = burst_rate
+		self.failures = 0
+
+	def read(self):
+		start = time.time()
+		adcs = [d.adc for d in self.devices]
+		channels = self.devices[0].sampler.channels
+		if self.burst <= 1:
+			scans = scan_many(adcs, channels)
+			for adc, scan in zip(adcs, scans):
+				adc.metrics.add(SCAN, scan.elapsed)
+			return [d.sampler.from_scan(start, scan.codes, scan.elapsed) for d, scan in zip(self.devices, scans)]
+		results = burst_many(adcs, channels, self.burst, self.burst_rate)
+		for adc, result in zip(adcs, results):
+			adc.metrics.add(SCAN, result.elapsed)
+		return [d.sampler.from_burst(start, result.codes, result.elapsed) for d, result in zip(self.devices, results)]
+
+
+class MultiMonitor(object):
+	#
+	# devices - the Devices, all with the same channels.
+	# scheduler - a Scheduler. The period is set by the board that needs
+	# the fastest readings.
+	# shutdown_when - "all" or "any", see above.
+	# on_samples - called with the devices after each reading, e.g. to print.
+	# on_shutdown - called with the devices and whether it is time to shut
+	# down after each reading, e.g. to run the shutdown. run() returns when it
+	# returns True, so a failed shutdown can be tried again. None returns as
+	# soon as it is time to shut down.
+	#
+	# cycle_timeout, reopen_after, stale_after - see above. stale_after None
+	# waits for every board.
+	#
+	def __init__(self, devices, scheduler, burst=1, burst_rate=3300, shutdown_when="all", on_samples=None,
+			cycle_timeout=1.0, reopen_after=3, stale_after=None, on_shutdown=None):
+		if shutdown_when not in ("all", "any"):
+			raise ValueError("shutdown_when must be \"all\" or \"any\"")
+		self.devices = devices
+		self.scheduler = scheduler
+		self.burst = burst
+		self.burst_rate = burst_rate
+		self.shutdown_when = shutdown_when
+		self.on_samples = on_samples
+		self.on_shutdown = on_shutdown
+		self.cycle_timeout = cycle_timeout
+		self.reopen_after = max(1, reopen_after)
+		self.stale_after = stale_after
+		self.seq = 0
+		self.swap = threading.Lock()
+		buses = []
+		for d in devices:
+			if d.bus not in buses:
+				buses.append(d.bus)
+		self.workers = [BusWorker([d for d in devices if d.bus == bus], burst, burst_rate) for bus in buses]
+		for worker in self.workers:
+			worker.start()
+
+	# Read every board, all buses at once. Sets device.sample - blind for
+	# the boards on a bus which failed.
+	def read(self):
+		start = time.time()
+		began = time.monotonic()
+		deadline = began + self.cycle_timeout
+		for worker in self.workers:
+			# A bus still busy with the last reading, or a reopen, is left to
+			# finish it.
+			if not worker.busy:
+				worker.ask()
+		for i, worker in enumerate(self.workers):
+			try:
+				samples = worker.done.get(timeout=max(0.0, deadline - time.monotonic()))
+				worker.busy = False
+			except queue.Empty:
+				samples = IOError("bus %s: no reading after %.1f seconds" % (worker.devices[0].bus, self.cycle_timeout))
+			if isinstance(samples, (IOError, OSError)):
+				samples = self.failed(i, start, began, deadline)
+			elif isinstance(samples, Exception):
+				raise samples
+			elif samples is None:
+				# A reopen came back, there is no reading this time.
+				elapsed = time.monotonic() - began
+				samples = [blind_sample(start, elapsed) for d in worker.devices]
+			else:
+				worker.failures = 0
+			for d, sample in zip(worker.devices, samples):
+				d.sample = sample
+
+	# Blind samples for the boards of worker i, and reopen its bus every
+	# reopen_after failures - in the worker, until deadline at most. A
+	# worker stuck on the bus is left behind and a new one reopens it.
+	def failed(self, i, start, began, deadline):
+		worker = self.workers[i]
+		worker.failures += 1
+		for d in worker.devices:
+			d.adc.metrics.count(FAILED)
+		if worker.failures % self.reopen_after == 0:
+			stuck = None
+			if worker.busy:
+				stuck = worker
+				stuck.stop()
+				worker = self.workers[i] = BusWorker(stuck.devices, self.burst, self.burst_rate)
+				worker.failures = stuck.failures
+				worker.start()
+			worker.ask(lambda: self.reopen_bus(worker, stuck))
+			try:
+				worker.done.get(timeout=max(0.0, deadline - time.monotonic()))
+				worker.busy = False
+			except queue.Empty:
+				pass
+		elapsed = time.monotonic() - began
+		return [blind_sample(start, elapsed) for d in worker.devices]
+
+	# Run by the worker: open its bus again for all its boards and close the
+	# old transport - by the stuck worker, if there is one, when it exits.
+	def reopen_bus(self, worker, stuck):
+		devices = worker.devices
+		bus = open_bus(devices[0].bus, devices[0].sampler.decoder.board.name)
+		with self.swap:
+			old = devices[0].adc.bus
+			for d in devices:
+				d.adc.bus = bus
+		if stuck is not None:
+			stuck.retire(old)
+		else:
+			close_bus(old)
+		devices[0].adc.metrics.count(REOPENS)
+		for d in devices:
+			probe(bus, d.address)
+
+	# Write the samples to the sinks and evaluate the rules of each board.
+	# Returns True if it is time to shut down. The times go to the Metrics
+	# of each board's adc.
+	def evaluate(self):
+		self.seq += 1
+		for d in self.devices:
+			began = time.monotonic()
+			if d.sample.codes:
+				write_sinks(d.sinks, d.sample, self.seq, d.adc.metrics, d.sink_errors)
+			began = d.adc.metrics.since(OUTPUT, began)
+			d.runtime = d.estimator.update(d.sample) if d.estimator is not None else None
+			d.actions = d.rules.evaluate(d.sample, d.runtime)
+			d.adc.metrics.since(RULES, began)
+		low = [d.rules.active(SHUTDOWN) for d in self.devices]
+		if self.shutdown_when == "all":
+			return any(low) and all(l or self.stale(d) for l, d in zip(low, self.devices))
+		return any(low)
+
+	# True if device has had no reading for more than stale_after seconds.
+	def stale(self, device):
+		return self.stale_after is not None and device.sample.time - device.rules.seen > self.stale_after
+
+	# The sample that needs the fastest readings sets the schedule.
+	def next_delay(self):
+		periods = self.scheduler.periods
+		urgent = min((d.sample for d in self.devices), key=lambda s: periods[self.scheduler.state_for(s)])
+		return self.scheduler.next_delay(urgent)
+
+	#
+	# Read and evaluate on the schedule until it is time to shut down, see
+	# on_shutdown. Returns the devices, with the samples that called for the
+	# shutdown.
+	#
+	def run(self):
+		try:
+			while True:
+				self.read()
+				shutdown = self.evaluate()
+				if self.on_samples is not None:
+					self.on_samples(self.devices)
+				if self.on_shutdown is not None:
+					shutdown = self.on_shutdown(self.devices, shutdown)
+				if shutdown:
+					return self.devices
+				time.sleep(self.next_delay())
+				self.scheduler.woke()
+		finally:
+			self.close()
+
+	def close(self):
+		for worker in self.workers:
+			worker.stop()
+			worker.release()
+		for d in self.devices:
+			close_sinks(d.sinks)
+			d.sinks = []
+
+
+if __name__ == "__main__":
+	import argparse
+	from uptime2.boards import BOARDS
+	from uptime2.policy import Rules
+	from uptime2.sampler import Sampler
+	from uptime2.scheduler import Scheduler, FAST, NORMAL, SLOW
+
+	parser = argparse.ArgumentParser(description="Find the UpTime boards on the I2C buses and print their readings.")
+	parser.add_argument("--bus", type=int, action="append", help="I2C bus number (repeat for more), default 1")
+	parser.add_argument("--board", default="pi-uptime", choices=sorted(BOARDS))
+	parser.add_argument("--vref", type=float, default=6.144)
+	parser.add_argument("--period", type=float, default=2.0, help="seconds between readings")
+	parser.add_argument("--burst", type=int, default=8)
+	parser.add_argument("--count", type=int, default=0, help="number of readings, 0 for no limit")
+	args = parser.parse_args()
+
+	decoder = BOARDS[args.board].decoder(args.vref)
+	devices = []
+	for number, bus, address in find_devices(args.bus or [1], board=args.board):
+		adc = TLA2024(bus, address)
+		devices.append(Device("%d-0x%02x" % (number, address), number, address, adc, Sampler(adc, decoder, SINGLE_ENDED), Rules([])))
+	if not devices:
+		parser.exit(1, "No UpTime boards found\n")
+	print("Found %s" % ", ".join(d.name for d in devices))
+	scheduler = Scheduler({FAST: args.period, NORMAL: args.period, SLOW: args.period}, 0, 0, 99)
+	monitor = MultiMonitor(devices, scheduler, args.burst)
+	try:
+		n = 0
+		while args.count == 0 or n < args.count:
+			monitor.read()
+			monitor.evaluate()
+			for d in devices:
+				s = d.sample
+				print("%s %-8s %5.2f %5.2f %5.2f %8.2fC %6.1fms" % (time.ctime(s.time), d.name, s.Vin, s.Vout, s.Vbattery, s.TempC, s.elapsed * 1000))
+			n += 1
+			time.sleep(monitor.next_delay())
+			scheduler.woke()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		monitor.close()
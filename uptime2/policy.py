@@ -0,0 +1,264 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# The checks the main loops make on each reading.
+#
+# Rules - the checks both scripts make, written as rules and evaluated one
+# reading at a time:
+#
+#	"Vin < 3.8 for 3 and Vbattery < 3.1 for 3 -> shutdown"
+#	"Vin > 3.8 and TempC > 60 clear 55 for 3 -> too-hot every 600"
+#
+# A rule is conditions joined by "and", "->" and an action. A condition is
+# a field (Vin, Vbattery, Vout, TempC, runtime - the seconds of battery
+# left from uptime2/runtime.py - or stale - the seconds since the last
+# reading which was not blind, see uptime2/guard.py), <, <=, > or >=, and a
+# number, then:
+#
+#	clear X  - hysteresis. Once true, the condition stays true until the
+#	           field is past X, e.g. TempC > 60 clear 55 stays true down to 55.
+#	for N    - debounce. The condition becomes true only after N readings
+#	           in a row.
+#
+# and after the action:
+#
+#	every S  - rate limit. The action fires at most once every S seconds.
+#
+# An action fires only when its rule becomes true, not on every reading
+# while it stays true. Conditions that are the same in several rules are
+# evaluated once. With noise_margin, a field with burst noise (see
+# uptime2/sampler.py) must be past the number by noise_margin x its noise.
+# A field which could not be read (NaN) leaves its conditions as they were -
+# no news is not good news for a low battery.
+#
+# since() gives the time a rule's conditions were first all past their
+# numbers - the threshold crossing, before the debounce - e.g. to time the
+# shutdown from it.
+#
+# Limits holds the thresholds of the scripts and makes their rules - so the
+# scripts, the replay and the backtest (uptime2/replay.py) decide the same way.
+#
+
+import math
+import operator
+import re
+
+SHUTDOWN = "shutdown"   # Vin has failed and the battery is low.
+TOO_COLD = "too-cold"   # Too cold for battery charging.
+TOO_HOT = "too-hot"     # Too hot for battery charging.
+
+
+#
+# The operating limits - see V_batt_min, V_in_min, Temp_min, Temp_max,
+# noise_margin, shutdown_time, debounce, Temp_hysteresis, alert_interval and
+# blind_time in the scripts. rules() makes the rules the scripts check on
+# each reading; the replay and the backtest in uptime2/replay.py check the
+# same ones. shutdown_time or blind_time None leaves out that rule.
+#
+class Limits(object):
+	def __init__(self, V_batt_min, V_in_min, Temp_min, Temp_max, noise_margin=0, shutdown_time=None, debounce=3,
+			Temp_hysteresis=3.0, alert_interval=600, blind_time=None):
+		self.V_batt_min = V_batt_min
+		self.V_in_min = V_in_min
+		self.Temp_min = Temp_min
+		self.Temp_max = Temp_max
+		self.noise_margin = noise_margin
+		self.shutdown_time = shutdown_time
+		self.debounce = debounce
+		self.Temp_hysteresis = Temp_hysteresis
+		self.alert_interval = alert_interval
+		self.blind_time = blind_time
+
+	def rules(self):
+		# Vin has failed and the battery is low - debounce readings in a row of each.
+		rules = ["Vin < %g for %d and Vbattery < %g for %d -> shutdown" % (self.V_in_min, self.debounce, self.V_batt_min, self.debounce)]
+		# The battery would not last through a clean shutdown - see uptime2/runtime.py. Debounced, as one
+		# estimate can be off.
+		if self.shutdown_time is not None:
+			rules.append("Vin < %g and runtime < %g for %d -> shutdown" % (self.V_in_min, self.shutdown_time, self.debounce))
+		# On the battery and no reading for blind_time seconds - see uptime2/guard.py.
+		if self.blind_time is not None:
+			rules.append("Vin < %g and stale > %g -> shutdown" % (self.V_in_min, self.blind_time))
+		# Temperature only matters for charging, which needs Vin.
+		rules.append("Vin > %g and TempC < %g clear %g for %d -> too-cold every %d" % (self.V_in_min, self.Temp_min,
+			self.Temp_min + self.Temp_hysteresis, self.debounce, self.alert_interval))
+		rules.append("Vin > %g and TempC > %g clear %g for %d -> too-hot every %d" % (self.V_in_min, self.Temp_max,
+			self.Temp_max - self.Temp_hysteresis, self.debounce, self.alert_interval))
+		return rules
+
+
+class RuleError(ValueError):
+	pass
+
+
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+# Fields of a sample and the index of their noise in sample.noise.
+NOISE = {"Vin": 0, "Vbattery": 1, "Vout": 2, "TempC": 3}
+FIELDS = tuple(NOISE) + ("runtime", "stale")
+
+CONDITION_RE = re.compile(r"^(\w+)\s*(<=|>=|<|>)\s*(-?[\d.]+)(?:\s+clear\s+(-?[\d.]+))?(?:\s+for\s+(\d+))?$")
+ACTION_RE = re.compile(r"^([\w-]+)(?:\s+every\s+([\d.]+))?$")
+
+
+class Condition(object):
+	def __init__(self, field, op, threshold, clear=None, debounce=1):
+		self.field = field
+		self.op = op
+		self.compare = OPERATORS[op]
+		self.threshold = threshold
+		self.clear = threshold if clear is None else clear
+		self.debounce = max(1, debounce)
+		self.below = op in ("<", "<=")
+		self.state = False
+		self.count = 0
+		# sample.time of the first reading in this run of held readings.
+		self.since = None
+		if (self.below and self.clear < threshold) or (not self.below and self.clear > threshold):
+			raise RuleError("%s %s %g: clear %g is on the wrong side" % (field, op, threshold, self.clear))
+
+	# value - the field, None if there is none (e.g. no runtime estimate),
+	# NaN if it could not be read. time - sample.time.
+	def update(self, value, time):
+		if value is None:
+			held = False
+		elif math.isnan(value):
+			return self.state
+		elif self.state:
+			held = self.compare(value, self.clear)
+		else:
+			held = self.compare(value, self.threshold)
+		if self.state:
+			if not held:
+				self.state = False
+				self.count = 0
+				self.since = None
+		elif held:
+			if self.count == 0:
+				self.since = time
+			self.count += 1
+			self.state = self.count >= self.debounce
+		else:
+			self.count = 0
+			self.since = None
+		return self.state
+
+
+class Rule(object):
+	def __init__(self, text, conditions, action, every=0):
+		self.text = text
+		self.conditions = conditions
+		self.action = action
+		self.every = every
+		self.active = False
+		self.fired = None
+		# When the conditions were all first held, while active.
+		self.since = None
+
+
+class Rules(object):
+	#
+	# rules - the rules, as text, see above.
+	# noise_margin - see above, e.g. 3 for 3 standard errors.
+	#
+	def __init__(self, rules, noise_margin=0):
+		self.noise_margin = noise_margin
+		self.conditions = []
+		self.keys = {}
+		self.rules = [self.compile(text) for text in rules]
+		self.reset()
+
+	# Forget all state, as if just started.
+	def reset(self):
+		for condition in self.conditions:
+			condition.state = False
+			condition.count = 0
+			condition.since = None
+		for rule in self.rules:
+			rule.active = False
+			rule.fired = None
+			rule.since = None
+		# Actions whose rule stopped being true at the last evaluate().
+		self.cleared = []
+		# sample.time of the last sample with Vin.
+		self.seen = None
+
+	def compile(self, text):
+		if "->" not in text:
+			raise RuleError("%r: no -> action" % text)
+		left, right = text.split("->", 1)
+		indexes = []
+		for part in re.split(r"\s+and\s+", left.strip()):
+			m = CONDITION_RE.match(part.strip())
+			if m is None:
+				raise RuleError("%r: can not read condition %r" % (text, part))
+			field, op, threshold, clear, debounce = m.groups()
+			if field not in FIELDS:
+				raise RuleError("%r: unknown field %s - use one of %s" % (text, field, ", ".join(FIELDS)))
+			key = (field, op, float(threshold), None if clear is None else float(clear), int(debounce or 1))
+			if key not in self.keys:
+				try:
+					condition = Condition(*key)
+				except RuleError as e:
+					raise RuleError("%r: %s" % (text, e))
+				self.keys[key] = len(self.conditions)
+				self.conditions.append(condition)
+			indexes.append(self.keys[key])
+		m = ACTION_RE.match(right.strip())
+		if m is None:
+			raise RuleError("%r: can not read action %r" % (text, right))
+		return Rule(text, indexes, m.group(1), float(m.group(2) or 0))
+
+	def value(self, condition, sample, runtime, stale):
+		if condition.field == "runtime":
+			return runtime
+		if condition.field == "stale":
+			return stale
+		value = getattr(sample, condition.field)
+		if self.noise_margin:
+			noise = self.noise_margin * sample.noise[NOISE[condition.field]]
+			value = value + noise if condition.below else value - noise
+		return value
+
+	# True while a rule with action is true, e.g. to shut down only when
+	# the batteries of all boards are low.
+	def active(self, action):
+		return any(rule.active for rule in self.rules if rule.action == action)
+
+	# The text of the rules with action which are true, e.g. for the log.
+	def why(self, action):
+		return [rule.text for rule in self.rules if rule.active and rule.action == action]
+
+	# sample.time at which the first rule with action which is true crossed
+	# its thresholds, or None if none is true.
+	def since(self, action):
+		times = [rule.since for rule in self.rules if rule.active and rule.action == action]
+		return min(times) if times else None
+
+	#
+	# Evaluate the rules on the next sample. runtime - seconds of battery
+	# left, or None. Returns the actions which fire, in rule order.
+	#
+	def evaluate(self, sample, runtime=None):
+		if self.seen is None or not math.isnan(sample.Vin):
+			self.seen = sample.time
+		stale = sample.time - self.seen
+		states = [c.update(self.value(c, sample, runtime, stale), sample.time) for c in self.conditions]
+		actions = []
+		self.cleared = []
+		for rule in self.rules:
+			active = all(states[i] for i in rule.conditions)
+			if active and not rule.active:
+				rule.since = max(self.conditions[i].since for i in rule.conditions)
+				if rule.fired is None or sample.time - rule.fired >= rule.every:
+					actions.append(rule.action)
+					rule.fired = sample.time
+			elif rule.active and not active:
+				self.cleared.append(rule.action)
+				rule.since = None
+			rule.active = active
+		return actions
@@ -0,0 +1,333 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Offline replay and threshold backtesting on recorded readings.
+#
+# Tuning V_batt_min, V_in_min, Temp_min and Temp_max used to mean editing
+# the script and waiting for a real power failure. Here the recorded
+# readings - the sample ring file (uptime2/ringbuf.py) or the CSV log
+# (uptime2/logsink.py) - are used instead:
+#
+#	replay   - runs the readings through the Rules in uptime2/policy.py,
+#	           with the runtime estimate, as fast as it can - the rules of the
+#	           scripts (Limits.rules()), or rules of your own (--rule).
+#	backtest - scores a whole grid of limits in one pass with numpy. For
+#	           each combination it reports, over all the outages recorded
+#	           (runs of Vin < V_in_min):
+#	             shutdowns   - outages in which a shutdown would have fired.
+#	             unneeded    - of those, outages where Vin came back.
+#	             missed      - outages where the recording stopped (the power
+#	                           went) and no shutdown fired.
+#	             min_left    - the least time left between a shutdown and
+#	                           the end of the recording (seconds).
+#	             too_cold, too_hot - number of temperature alerts.
+#
+# The backtest scores the rules of Limits.rules() - the same rules, debounce,
+# hysteresis, alert interval and runtime estimate as the scripts - worked out
+# for all combinations at once instead of reading by reading. The replay of
+# one combination gives the same shutdowns and alerts. Each recording (split
+# at gaps) starts afresh, as the script did when it started. The stale rule
+# never fires on recorded readings - blind readings are not recorded.
+#
+# Examples:
+#
+#	python3 -m uptime2.replay replay /var/lib/uptime2/samples.ring --board piz-uptime
+#	python3 -m uptime2.replay backtest /var/log/uptime2.csv* --V_batt_min 2.9:3.4:0.05 --V_in_min 3.6:4.2:0.1
+#
+# Needs numpy ("sudo apt install python3-numpy").
+#
+
+import time
+from collections import namedtuple
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from uptime2.boards import BOARDS
+from uptime2.policy import Limits, Rules, SHUTDOWN
+from uptime2.ringbuf import SAMPLE_MAGIC, SampleRing, capacity_of
+from uptime2.runtime import RuntimeEstimator
+from uptime2.sampler import Sample
+
+# Recorded readings, oldest first - numpy arrays of the same length.
+Telemetry = namedtuple("Telemetry", "time Vin Vbattery Vout TempC")
+
+
+def load_csv(path):
+	data = numpy.genfromtxt(path, delimiter=",", names=True, ndmin=1)
+	return Telemetry(data["time"], data["Vin"], data["Vbattery"], data["Vout"], data["TempC"])
+
+
+def load_ring(path, board, vref=6.144):
+	ring = SampleRing(path, capacity_of(path), readonly=True)
+	try:
+		times, codes = ring.read()
+	finally:
+		ring.close()
+	values = BOARDS[board].decoder(vref).decode_array(codes)
+	return Telemetry(numpy.asarray(times), values[:, 0], values[:, 1], values[:, 2], values[:, 3])
+
+
+# Load and join recorded readings - ring files and CSV logs (e.g. rotated logs).
+def load(paths, board="pi-uptime", vref=6.144):
+	parts = []
+	for path in paths:
+		with open(path, "rb") as f:
+			magic = f.read(len(SAMPLE_MAGIC))
+		if magic == SAMPLE_MAGIC:
+			parts.append(load_ring(path, board, vref))
+		else:
+			parts.append(load_csv(path))
+	joined = [numpy.concatenate([p[i] for p in parts]) for i in range(len(Telemetry._fields))]
+	order = numpy.argsort(joined[0], kind="stable")
+	return Telemetry(*[a[order] for a in joined])
+
+
+# first[i] - reading i starts a recording: it is the first, or comes more
+# than gap seconds after the one before (default: 10 x the median time
+# between readings). The script was started again - the rules start afresh.
+def recordings(t, gap=None):
+	if gap is None:
+		gap = 10 * numpy.median(numpy.diff(t)) if len(t) > 1 else 0.0
+	first = numpy.ones(len(t), dtype=bool)
+	first[1:] = numpy.diff(t) > gap
+	return first
+
+
+def samples(telemetry):
+	noise = (0.0, 0.0, 0.0, 0.0)
+	for t, Vin, Vbattery, Vout, TempC in zip(*telemetry):
+		yield Sample(float(t), float(Vin), float(Vbattery), float(Vout), float(TempC), (0, 0, 0, 0), noise, 0.0)
+
+
+#
+# Run the readings through rules - Rules (uptime2/policy.py), e.g.
+# Rules(limits.rules()) as the scripts do. Returns a list of (time, actions)
+# for each reading on which actions fire. Like the scripts, every reading
+# is checked, including the ones after a shutdown would have fired.
+# estimator - a RuntimeEstimator (uptime2/runtime.py) for the runtime
+# rules, as the scripts have, or None. gap - see recordings().
+#
+def replay(telemetry, rules, estimator=None, gap=None):
+	events = []
+	first = recordings(telemetry.time, gap)
+	for sample, fresh in zip(samples(telemetry), first):
+		if fresh:
+			rules.reset()
+			if estimator is not None:
+				estimator.reset()
+		runtime = estimator.update(sample) if estimator is not None else None
+		actions = rules.evaluate(sample, runtime)
+		if actions:
+			events.append((sample.time, actions))
+	return events
+
+
+# Readings in a row with held true, up to and including each reading -
+# what a "for N" condition counts. It starts over at each recording.
+def run_lengths(held, first):
+	n = numpy.arange(len(held))
+	last_not = numpy.maximum.accumulate(numpy.where(held, -1, n))
+	begin = numpy.maximum(last_not + 1, numpy.maximum.accumulate(numpy.where(first, n, 0)))
+	return numpy.where(held, n - begin + 1, 0)
+
+
+#
+# The state of a condition with hysteresis and debounce on each reading,
+# like uptime2.policy.Condition: held - the field is past the threshold,
+# kept - it is not past clear. It becomes true after debounce readings
+# held in a row and stays true while kept.
+#
+def condition_states(held, kept, debounce, first):
+	n = numpy.arange(len(held))
+	entered = numpy.maximum.accumulate(numpy.where(run_lengths(held, first) >= debounce, n, -1))
+	left = numpy.maximum.accumulate(numpy.where(~kept | first, n, -1))
+	return entered >= left
+
+
+#
+# How many times a rule true on the readings active fires - when it
+# becomes true, at most once every every seconds.
+#
+def alerts(t, active, first, every):
+	rising = active.copy()
+	rising[1:] &= ~active[:-1] | first[1:]
+	recording = numpy.cumsum(first)
+	count = 0
+	last = None
+	for i in numpy.flatnonzero(rising):
+		if last is None or recording[i] != recording[last] or t[i] - t[last] >= every:
+			count += 1
+			last = i
+	return count
+
+
+def grid(spec):
+	if ":" in spec:
+		start, stop, step = [float(x) for x in spec.split(":")]
+		return numpy.arange(start, stop + step / 2, step)
+	return numpy.array([float(x) for x in spec.split(",")])
+
+
+RESULT_DTYPE = [("V_batt_min", "f8"), ("V_in_min", "f8"), ("Temp_min", "f8"), ("Temp_max", "f8"),
+	("outages", "i8"), ("shutdowns", "i8"), ("unneeded", "i8"), ("missed", "i8"), ("min_left", "f8"),
+	("too_cold", "i8"), ("too_hot", "i8")]
+
+
+#
+# Score every combination of the limits given. limits - the Limits (see
+# uptime2/policy.py) for the rest: debounce, Temp_hysteresis,
+# alert_interval, shutdown_time. estimator - makes the RuntimeEstimator for
+# a V_in_min, e.g. lambda V_in_min: RuntimeEstimator(V_in_min), or None to
+# leave out the runtime rule. gap - see recordings(). Returns a numpy record
+# array with a row per combination - see RESULT_DTYPE.
+#
+def backtest(telemetry, V_batt_min, V_in_min, Temp_min, Temp_max, limits=None, estimator=None, gap=None):
+	if limits is None:
+		limits = Limits(None, None, None, None)
+	debounce = max(1, limits.debounce)
+	t = telemetry.time
+	vin = telemetry.Vin
+	vbatt = numpy.where(numpy.isnan(telemetry.Vbattery), numpy.inf, telemetry.Vbattery)
+	temps = telemetry.TempC
+	V_batt_min = numpy.asarray(V_batt_min, dtype=float)
+	V_in_min = numpy.asarray(V_in_min, dtype=float)
+	Temp_min = numpy.asarray(Temp_min, dtype=float)
+	Temp_max = numpy.asarray(Temp_max, dtype=float)
+	first = recordings(t, gap)
+	# continues[i] - reading i + 1 follows reading i without a gap.
+	continues = numpy.zeros(len(t), dtype=bool)
+	continues[:-1] = ~first[1:]
+
+	shape = (len(V_batt_min), len(V_in_min), len(Temp_min), len(Temp_max))
+	result = numpy.zeros(shape, dtype=RESULT_DTYPE)
+	result["V_batt_min"] = V_batt_min[:, None, None, None]
+	result["V_in_min"] = V_in_min[None, :, None, None]
+	result["Temp_min"] = Temp_min[None, None, :, None]
+	result["Temp_max"] = Temp_max[None, None, None, :]
+	result["min_left"] = numpy.nan
+
+	# "Vbattery < V_batt_min for debounce", for each V_batt_min.
+	low = [run_lengths(vbatt < vb, first) >= debounce for vb in V_batt_min]
+	interval = limits.alert_interval
+	for j, vi in enumerate(V_in_min):
+		# Temperature alerts - "Vin > vi and TempC < Temp_min clear Temp_min +
+		# Temp_hysteresis for debounce -> too-cold every alert_interval", and too-hot.
+		on = vin > vi
+		for k, tmin in enumerate(Temp_min):
+			cold = condition_states(temps < tmin, ~(temps >= tmin + limits.Temp_hysteresis), debounce, first)
+			result["too_cold"][:, j, k, :] = alerts(t, on & cold, first, interval)
+		for k, tmax in enumerate(Temp_max):
+			hot = condition_states(temps > tmax, ~(temps <= tmax - limits.Temp_hysteresis), debounce, first)
+			result["too_hot"][:, j, :, k] = alerts(t, on & hot, first, interval)
+
+		# Outages - runs of readings with Vin < vi, split at gaps.
+		idx = numpy.flatnonzero(vin < vi)
+		if not len(idx):
+			continue
+		breaks = numpy.ones(len(idx), dtype=bool)
+		breaks[1:] = (numpy.diff(idx) != 1) | ~continues[idx[:-1]]
+		starts = numpy.flatnonzero(breaks)
+		ends = numpy.append(starts[1:], len(idx)) - 1
+		segment = numpy.cumsum(breaks) - 1
+
+		# Readings on which a shutdown rule is true, for each V_batt_min:
+		# "Vin < vi for debounce and Vbattery < V_batt_min for debounce", or
+		# "Vin < vi and runtime < shutdown_time for debounce".
+		failed = numpy.arange(len(idx)) - starts[segment] >= debounce - 1
+		true = numpy.array([failed & l[idx] for l in low]).reshape(len(V_batt_min), len(idx))
+		if estimator is not None and limits.shutdown_time is not None:
+			runtime = numpy.full(len(idx), numpy.nan)
+			est = estimator(vi)
+			for n, i in enumerate(idx):
+				if breaks[n]:
+					est.reset()
+				left = est.update(Sample(t[i], vin[i], telemetry.Vbattery[i], telemetry.Vout[i], temps[i], (), (), 0.0))
+				if left is not None:
+					runtime[n] = left
+			true |= (run_lengths(runtime < limits.shutdown_time, breaks) >= debounce)[None, :]
+
+		# Readings before the first shutdown of each outage, for each V_batt_min.
+		so_far = numpy.cumsum(true, axis=1)
+		so_far -= (so_far[:, starts] - true[:, starts])[:, segment]
+		before = numpy.add.reduceat(so_far == 0, starts, axis=1)
+		fired = before < (ends - starts + 1)[None, :]
+		fire_time = t[idx[numpy.minimum(starts[None, :] + before, ends[None, :])]]
+		left = t[idx[ends]][None, :] - fire_time
+		recovered = continues[idx[ends]][None, :]
+		lost = fired & ~recovered
+
+		result["outages"][:, j] = len(starts)
+		result["shutdowns"][:, j] = fired.sum(axis=1)[:, None, None]
+		result["unneeded"][:, j] = (fired & recovered).sum(axis=1)[:, None, None]
+		result["missed"][:, j] = (~fired & ~recovered).sum(axis=1)[:, None, None]
+		min_left = numpy.where(lost, left, numpy.inf).min(axis=1)
+		result["min_left"][:, j] = numpy.where(numpy.isinf(min_left), numpy.nan, min_left)[:, None, None]
+	return result.reshape(-1)
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Replay recorded uptime2 readings through the checks, or backtest a grid of limits.")
+	parser.add_argument("mode", choices=("replay", "backtest"))
+	parser.add_argument("paths", nargs="+", help="sample ring files and/or CSV logs")
+	parser.add_argument("--board", default="pi-uptime", choices=sorted(BOARDS), help="board, to decode ring files")
+	parser.add_argument("--vref", type=float, default=6.144)
+	parser.add_argument("--V_batt_min", default="3.1", help="value, list a,b,c or range start:stop:step")
+	parser.add_argument("--V_in_min", default="3.8")
+	parser.add_argument("--Temp_min", default="5.0")
+	parser.add_argument("--Temp_max", default="60.0")
+	parser.add_argument("--debounce", type=int, default=3)
+	parser.add_argument("--Temp_hysteresis", type=float, default=3.0)
+	parser.add_argument("--alert-interval", type=float, default=600)
+	parser.add_argument("--shutdown-time", type=float, default=150, help="seconds needed to shut down, for the runtime rule - 0 to leave it out")
+	parser.add_argument("--blind-time", type=float, default=30)
+	parser.add_argument("--V_empty", type=float, default=2.7)
+	parser.add_argument("--runtime-memory", type=float, default=120)
+	parser.add_argument("--temp-coeff", type=float, default=0.01)
+	parser.add_argument("--rule", action="append", help="replay with this rule instead of the rules of the scripts (repeat for more rules)")
+	parser.add_argument("--noise-margin", type=float, default=0)
+	parser.add_argument("--gap", type=float, default=None, help="seconds without readings that end a recording")
+	parser.add_argument("--min-left", type=float, default=0.0, help="only show limits leaving at least this many seconds")
+	parser.add_argument("--top", type=int, default=20, help="number of results to show")
+	args = parser.parse_args()
+
+	telemetry = load(args.paths, args.board, args.vref)
+	estimator = lambda V_in_min: RuntimeEstimator(V_in_min, args.V_empty, args.runtime_memory, args.temp_coeff)
+	start = time.time()
+	if args.mode == "replay":
+		limits = Limits(float(args.V_batt_min), float(args.V_in_min), float(args.Temp_min), float(args.Temp_max),
+			args.noise_margin, args.shutdown_time or None, args.debounce, args.Temp_hysteresis, args.alert_interval, args.blind_time)
+		rules = Rules(args.rule or limits.rules(), args.noise_margin)
+		events = replay(telemetry, rules, estimator(limits.V_in_min), args.gap)
+		took = time.time() - start
+		shutdowns = [t for t, actions in events if SHUTDOWN in actions]
+		if shutdowns:
+			print("First shutdown at %s" % time.ctime(shutdowns[0]))
+		else:
+			print("No shutdown")
+		print("%d readings with a shutdown, %d with other actions" % (len(shutdowns), len(events) - len(shutdowns)))
+		print("%d readings replayed in %.2f seconds" % (len(telemetry.time), took))
+	else:
+		if args.rule:
+			parser.error("--rule is for replay - the backtest scores the rules of the scripts")
+		limits = Limits(None, None, None, None, args.noise_margin, args.shutdown_time or None, args.debounce,
+			args.Temp_hysteresis, args.alert_interval, args.blind_time)
+		result = backtest(telemetry, grid(args.V_batt_min), grid(args.V_in_min), grid(args.Temp_min), grid(args.Temp_max),
+			limits, estimator, args.gap)
+		took = time.time() - start
+		if args.min_left > 0:
+			result = result[~(result["min_left"] < args.min_left)]
+		# Fewest missed, then fewest unneeded, then the most time left.
+		result = result[numpy.lexsort((-result["min_left"], result["unneeded"], result["missed"]))]
+		print("V_batt_min V_in_min Temp_min Temp_max outages shutdowns unneeded missed min_left too_cold too_hot")
+		for r in result[:args.top]:
+			print("%10.3f %8.3f %8.1f %8.1f %7d %9d %8d %6d %8.0f %8d %7d" % tuple(r))
+		print("%d combinations over %d readings in %.2f seconds" % (len(result), len(telemetry.time), took))
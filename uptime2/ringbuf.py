@@ -0,0 +1,234 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Fixed size ring buffer files, memory mapped.
+#
+# RingFile keeps the last capacity records of a fixed size in a file. The
+# file is mapped, so a record is written with a single copy into the
+# mapping, and whatever was written is still there after the program dies.
+# The mapping is synced to disk every sync_interval seconds, which bounds
+# what a power cut can lose.
+#
+# SampleRing is the history of raw readings - 10 bytes per reading:
+#
+#	I   time in 1/10 seconds since the epoch in the file header
+#	6s  the 4 raw 12 bit codes, channel0 in the lowest 12 bits
+#
+# A week of 1 second readings is about 6 MB. Nothing is decoded when
+# writing; read() returns the codes of a time range and Decoder.decode_array()
+# (uptime2/boards.py) turns them into values.
+#
+# File header, little endian, 64 bytes:
+#
+#	0   4s  magic
+#	4   I   record size
+#	8   Q   capacity, in records
+#	16  Q   head - number of records ever written
+#	24  d   epoch - time.time() the file was created
+#
+# To look at the last readings after an unexpected shutdown:
+#
+#	python3 -m uptime2.ringbuf /var/lib/uptime2/samples.ring --board pi-uptime --last 20
+#
+
+import mmap
+import os
+import struct
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+HEADER = struct.Struct("<4sIQQd")
+HEAD = struct.Struct("<Q")
+HEAD_OFFSET = 16
+HEADER_SIZE = 64
+
+
+# The capacity a ring file was made with, from its header.
+def capacity_of(path):
+	with open(path, "rb") as f:
+		return HEADER.unpack(f.read(HEADER.size))[2]
+
+
+class RingFile(object):
+	#
+	# path - the file. It is created if it does not exist.
+	# magic - 4 bytes which tell what the records are.
+	# record - a struct.Struct for one record.
+	# capacity - number of records kept.
+	# readonly - only read an existing file, e.g. as a user who may not write it.
+	#
+	def __init__(self, path, magic, record, capacity, sync_interval=60, readonly=False):
+		self.path = path
+		self.record = record
+		self.sync_interval = sync_interval
+		self.readonly = readonly
+		size = HEADER_SIZE + record.size * capacity
+		directory = os.path.dirname(path)
+		if directory and not readonly and not os.path.isdir(directory):
+			os.makedirs(directory)
+		if readonly:
+			fd = os.open(path, os.O_RDONLY)
+		else:
+			fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+		try:
+			new = os.fstat(fd).st_size == 0 and not readonly
+			if new:
+				os.ftruncate(fd, size)
+			elif os.fstat(fd).st_size != size:
+				raise IOError("%s has a different size - delete it or use the capacity it was made with" % path)
+			if not readonly:
+				# Reserve the blocks now - also for a file made sparse by an older
+				# version. A sparse file gets its blocks on the first write to each
+				# page, and on a full card that write is a SIGBUS which kills the
+				# process that should shut the Pi down.
+				try:
+					os.posix_fallocate(fd, 0, size)
+				except OSError as e:
+					if new:
+						os.ftruncate(fd, 0)
+					raise IOError(e.errno, "%s: cannot reserve %d bytes - %s" % (path, size, e.strerror))
+			if readonly:
+				self.map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ)
+			else:
+				self.map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+		finally:
+			os.close(fd)
+		if new:
+			HEADER.pack_into(self.map, 0, magic, record.size, capacity, 0, time.time())
+		m, record_size, self.capacity, self.head, self.epoch = HEADER.unpack_from(self.map, 0)
+		if m != magic or record_size != record.size or self.capacity != capacity:
+			self.map.close()
+			raise IOError("%s is not a ring file of this kind or capacity" % path)
+		self.synced = time.monotonic()
+
+	def __len__(self):
+		return min(self.head, self.capacity)
+
+	# Write one record - the fields of self.record.
+	def append(self, *fields):
+		offset = HEADER_SIZE + (self.head % self.capacity) * self.record.size
+		self.record.pack_into(self.map, offset, *fields)
+		self.head += 1
+		HEAD.pack_into(self.map, HEAD_OFFSET, self.head)
+		if time.monotonic() - self.synced >= self.sync_interval:
+			self.sync()
+
+	def sync(self):
+		self.map.flush()
+		self.synced = time.monotonic()
+
+	# The raw bytes of all records kept, oldest first.
+	def raw(self):
+		if self.readonly:
+			self.head = HEAD.unpack_from(self.map, HEAD_OFFSET)[0]
+		if self.head <= self.capacity:
+			return self.map[HEADER_SIZE:HEADER_SIZE + self.head * self.record.size]
+		split = HEADER_SIZE + (self.head % self.capacity) * self.record.size
+		return self.map[split:] + self.map[HEADER_SIZE:split]
+
+	# All records kept, oldest first, as tuples.
+	def records(self):
+		return list(self.record.iter_unpack(self.raw()))
+
+	# The raw bytes of all records kept, oldest first, chunk records at a
+	# time - for going through a big file without copying all of it.
+	def chunks(self, chunk=4096):
+		if self.readonly:
+			self.head = HEAD.unpack_from(self.map, HEAD_OFFSET)[0]
+		size = self.record.size
+		n = max(0, self.head - self.capacity)
+		while n < self.head:
+			index = n % self.capacity
+			count = min(chunk, self.head - n, self.capacity - index)
+			offset = HEADER_SIZE + index * size
+			yield self.map[offset:offset + count * size]
+			n += count
+
+	def close(self):
+		if not self.readonly:
+			self.sync()
+		self.map.close()
+
+
+SAMPLE_MAGIC = b"UPTR"
+SAMPLE_RECORD = struct.Struct("<IIH")
+if numpy is not None:
+	SAMPLE_DTYPE = numpy.dtype([("t", "<u4"), ("lo", "<u4"), ("hi", "<u2")])
+
+# Codes are packed 12 bits each, channel0 first.
+def pack_codes(codes):
+	value = codes[0] | (codes[1] << 12) | (codes[2] << 24) | (codes[3] << 36)
+	return value & 0xFFFFFFFF, value >> 32
+
+
+def unpack_codes(lo, hi):
+	value = lo | (hi << 32)
+	return tuple((value >> (12 * c)) & 0xFFF for c in range(4))
+
+
+class SampleRing(RingFile):
+	def __init__(self, path, capacity, sync_interval=60, readonly=False):
+		RingFile.__init__(self, path, SAMPLE_MAGIC, SAMPLE_RECORD, capacity, sync_interval, readonly)
+
+	# Daemon sink - see uptime2/daemon.py.
+	def write(self, sample, seq):
+		lo, hi = pack_codes(sample.codes)
+		self.append(max(0, int((sample.time - self.epoch) * 10)), lo, hi)
+
+	#
+	# Readings from start to end (time.time() values, None for no limit).
+	# Returns the times and the codes, N x 4. With numpy these are arrays,
+	# ready for Decoder.decode_array(), else lists.
+	#
+	def read(self, start=None, end=None):
+		if numpy is not None:
+			records = numpy.frombuffer(self.raw(), dtype=SAMPLE_DTYPE)
+			times = records["t"] / 10.0 + self.epoch
+			first = 0 if start is None else numpy.searchsorted(times, start, "left")
+			last = len(times) if end is None else numpy.searchsorted(times, end, "right")
+			records = records[first:last]
+			value = records["lo"].astype(numpy.uint64) | (records["hi"].astype(numpy.uint64) << numpy.uint64(32))
+			codes = numpy.column_stack([(value >> numpy.uint64(12 * c)) & numpy.uint64(0xFFF) for c in range(4)]).astype(numpy.uint16)
+			return times[first:last], codes.reshape(-1, 4)
+		times = []
+		codes = []
+		for t, c in self.readings(start, end):
+			times.append(t)
+			codes.append(c)
+		return times, codes
+
+	# (time, codes) of each reading from start to end, oldest first, one at
+	# a time - without numpy and without holding them all in memory.
+	def readings(self, start=None, end=None):
+		for raw in self.chunks():
+			for t, lo, hi in SAMPLE_RECORD.iter_unpack(raw):
+				t = t / 10.0 + self.epoch
+				if (start is None or t >= start) and (end is None or t <= end):
+					yield t, unpack_codes(lo, hi)
+
+
+if __name__ == "__main__":
+	import argparse
+	from uptime2.boards import BOARDS
+
+	parser = argparse.ArgumentParser(description="Print readings kept in an uptime2 sample ring file.")
+	parser.add_argument("path")
+	parser.add_argument("--board", default="pi-uptime", choices=sorted(BOARDS))
+	parser.add_argument("--vref", type=float, default=6.144)
+	parser.add_argument("--last", type=int, default=20, help="number of readings to print")
+	args = parser.parse_args()
+
+	ring = SampleRing(args.path, capacity_of(args.path), readonly=True)
+	decoder = BOARDS[args.board].decoder(args.vref)
+	times, codes = ring.read()
+	for t, c in list(zip(times, codes))[-args.last:]:
+		Vin, Vbattery, Vout, TempC = decoder.decode(c)
+		print("%s %5.2f %5.2f %5.2f %8.2fC" % (time.ctime(t), Vin, Vout, Vbattery, TempC))
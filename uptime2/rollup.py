@@ -0,0 +1,184 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Rollups - min/max/mean/last of each channel per minute and per hour.
+#
+# The raw readings (uptime2/ringbuf.py) are the fine tier. Rollups keeps two
+# coarse tiers, each in its own ring file:
+#
+#	minute.ring - one record a minute, 31 days by default.
+#	hour.ring   - one record an hour, 2 years by default.
+#
+# Each sample updates a running accumulator per tier - O(1) - and a record
+# is written only when a minute or an hour is over. Old records are written
+# over, so the disk space used never grows. Queries over a long time read
+# the hour tier instead of scanning raw readings.
+#
+# Record, little endian, 70 bytes:
+#
+#	I    start of the minute/hour, seconds since 1970
+#	H    number of readings
+#	16f  min, max, mean, last of Vin, Vbattery, Vout, TempC
+#
+# To print the last day:
+#
+#	python3 -m uptime2.rollup /var/lib/uptime2 --tier hour --last 24
+#
+
+import math
+import os
+import struct
+import time
+from collections import namedtuple
+
+from uptime2.boards import CHANNELS
+from uptime2.ringbuf import RingFile
+
+ROLLUP_MAGIC = b"UPTA"
+ROLLUP_RECORD = struct.Struct("<IH16f")
+
+MINUTE = 60
+HOUR = 3600
+TIERS = {"minute": MINUTE, "hour": HOUR}
+
+# start - time.time() of the start of the minute/hour.
+# count - number of readings.
+# Vin, Vbattery, Vout, TempC - (min, max, mean, last) of each channel.
+Rollup = namedtuple("Rollup", ("start", "count") + CHANNELS)
+
+
+def record_to_rollup(record):
+	stats = record[2:]
+	return Rollup(record[0], record[1], *[tuple(stats[c * 4:c * 4 + 4]) for c in range(len(CHANNELS))])
+
+
+# Combine two rollups of the same minute/hour, e.g. written before and
+# after a restart.
+def merge(a, b):
+	channels = []
+	for c in range(len(CHANNELS)):
+		x = a[2 + c]
+		y = b[2 + c]
+		count = a.count + b.count
+		channels.append((min(x[0], y[0]), max(x[1], y[1]), (x[2] * a.count + y[2] * b.count) / count, y[3]))
+	return Rollup(a.start, a.count + b.count, *channels)
+
+
+class Accumulator(object):
+	def __init__(self, size):
+		self.size = size
+		self.reset(None)
+
+	def reset(self, start):
+		self.start = start
+		self.count = 0
+		n = len(CHANNELS)
+		self.min = [float("nan")] * n
+		self.max = [float("nan")] * n
+		self.sum = [0.0] * n
+		self.n = [0] * n
+		self.last = [float("nan")] * n
+
+	def add(self, values):
+		self.count += 1
+		for c, v in enumerate(values):
+			if math.isnan(v):
+				continue
+			if self.n[c] == 0:
+				self.min[c] = self.max[c] = v
+			elif v < self.min[c]:
+				self.min[c] = v
+			elif v > self.max[c]:
+				self.max[c] = v
+			self.sum[c] += v
+			self.n[c] += 1
+			self.last[c] = v
+
+	def fields(self):
+		stats = []
+		for c in range(len(CHANNELS)):
+			mean = self.sum[c] / self.n[c] if self.n[c] else float("nan")
+			stats.extend((self.min[c], self.max[c], mean, self.last[c]))
+		return [int(self.start), min(self.count, 0xFFFF)] + stats
+
+
+class Rollups(object):
+	#
+	# directory - where minute.ring and hour.ring are kept.
+	# minutes, hours - the capacity of each tier.
+	#
+	def __init__(self, directory, minutes=31 * 24 * 60, hours=2 * 366 * 24, readonly=False):
+		self.readonly = readonly
+		self.tiers = {
+			"minute": RingFile(os.path.join(directory, "minute.ring"), ROLLUP_MAGIC, ROLLUP_RECORD, minutes, readonly=readonly),
+			"hour": RingFile(os.path.join(directory, "hour.ring"), ROLLUP_MAGIC, ROLLUP_RECORD, hours, readonly=readonly),
+		}
+		self.accumulators = dict((name, Accumulator(size)) for name, size in TIERS.items())
+
+	# Daemon sink - see uptime2/daemon.py.
+	def write(self, sample, seq):
+		values = (sample.Vin, sample.Vbattery, sample.Vout, sample.TempC)
+		for name, acc in self.accumulators.items():
+			start = int(sample.time // acc.size) * acc.size
+			if start != acc.start:
+				if acc.count:
+					self.tiers[name].append(*acc.fields())
+				acc.reset(start)
+			acc.add(values)
+
+	# Rollups of one tier from start to end (time.time(), None for no limit),
+	# oldest first.
+	def read(self, tier, start=None, end=None):
+		rollups = []
+		for record in self.tiers[tier].records():
+			rollup = record_to_rollup(record)
+			if (start is not None and rollup.start + TIERS[tier] <= start) or (end is not None and rollup.start > end):
+				continue
+			if rollups and rollups[-1].start == rollup.start:
+				rollups[-1] = merge(rollups[-1], rollup)
+			else:
+				rollups.append(rollup)
+		return rollups
+
+	# Rollups from start to end, from the finest tier which still holds start.
+	def query(self, start, end=None):
+		minutes = self.tiers["minute"]
+		if len(minutes) and record_to_rollup(minutes.records()[0]).start <= start:
+			return "minute", self.read("minute", start, end)
+		return "hour", self.read("hour", start, end)
+
+	# Write what has been gathered of the current minute and hour, so a
+	# restart does not lose it. read() merges it with the rest of the bucket.
+	def flush(self):
+		for name, acc in self.accumulators.items():
+			if acc.count and not self.readonly:
+				self.tiers[name].append(*acc.fields())
+				acc.reset(None)
+				self.tiers[name].sync()
+
+	def close(self):
+		self.flush()
+		for tier in self.tiers.values():
+			tier.close()
+
+
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Print uptime2 minute or hour rollups.")
+	parser.add_argument("directory", nargs="?", default="/var/lib/uptime2")
+	parser.add_argument("--tier", default="hour", choices=sorted(TIERS))
+	parser.add_argument("--last", type=int, default=24, help="number of minutes/hours to print")
+	parser.add_argument("--minutes", type=int, default=31 * 24 * 60)
+	parser.add_argument("--hours", type=int, default=2 * 366 * 24)
+	args = parser.parse_args()
+
+	rollups = Rollups(args.directory, args.minutes, args.hours, readonly=True)
+	print("Start                     Count  Vin min/mean  Vout min/mean  Batt-V min/mean  Temp min/max")
+	for r in rollups.read(args.tier)[-args.last:]:
+		print("%s %6d  %5.2f %5.2f   %5.2f %5.2f     %5.2f %5.2f     %6.2f %6.2f" % (time.ctime(r.start), r.count,
+			r.Vin[0], r.Vin[2], r.Vout[0], r.Vout[2], r.Vbattery[0], r.Vbattery[2], r.TempC[0], r.TempC[1]))
@@ -0,0 +1,130 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Battery time-to-empty, estimated from the discharge since Vin failed.
+#
+# A fixed V_batt_min shuts down too early with a light load and too late
+# with a heavy one (or a small 14500 cell). The estimator fits a straight
+# line to Vbattery against time - recursive least squares, O(1) a reading -
+# and works out when the line reaches V_empty. Older readings are forgotten
+# with a time constant of memory seconds, so the fit follows the discharge
+# curve as it bends down near the end.
+#
+# Right after Vin fails the battery voltage sags under the new load for a few
+# seconds - a line through the sag would be far too steep. Readings in the
+# first settle seconds on the battery are not fitted. The fit must then be
+# steady before it gives an estimate: the standard error of the slope, from
+# the scatter of the readings about the line, must be less than
+# max_slope_error of the slope.
+#
+# Cold cells run out sooner - the voltage under load falls off earlier. The
+# empty voltage is raised by temp_coeff volts per degree below 25C.
+#
+# update() returns the seconds left, or None on mains, while settling, while
+# there is less than min_history seconds of discharge to go on, or while the
+# fit is not steady. While the battery can not
+# be read (a blind sample, see uptime2/guard.py) the last estimate counts
+# down with the clock. The shutdown checks
+# (uptime2/policy.py) shut down when it is below the time the Pi needs to
+# shut down cleanly.
+#
+
+import math
+
+REFERENCE_TEMP = 25.0
+
+
+class RuntimeEstimator(object):
+	#
+	# V_in_min - below this Vin, we are running on the battery.
+	# V_empty - the battery is empty at this Vbattery (at 25C or warmer).
+	# memory - seconds of discharge the fit follows.
+	# temp_coeff - V added to V_empty per degree below 25C.
+	# min_history - seconds of discharge fitted before there is an estimate.
+	# settle, max_slope_error - see above.
+	#
+	def __init__(self, V_in_min, V_empty=2.7, memory=120.0, temp_coeff=0.01, min_history=20.0, settle=20.0,
+			max_slope_error=0.2):
+		self.V_in_min = V_in_min
+		self.V_empty = V_empty
+		self.memory = memory
+		self.temp_coeff = temp_coeff
+		self.min_history = min_history
+		self.settle = settle
+		self.max_slope_error = max_slope_error
+		self.reset()
+
+	def reset(self):
+		# sample.time of the first reading on the battery.
+		self.failed = None
+		self.start = None
+		self.last = None
+		self.counted = None
+		# Fit V = a + b * (t - start), and its 2 x 2 covariance.
+		self.a = self.b = 0.0
+		self.p = [[1e6, 0.0], [0.0, 1e6]]
+		# Forgotten like the fit - the squared errors and their weight.
+		self.errors = self.weight = 0.0
+		self.remaining = None
+
+	# The empty voltage at TempC.
+	def empty_at(self, TempC):
+		if math.isnan(TempC) or TempC >= REFERENCE_TEMP:
+			return self.V_empty
+		return self.V_empty + self.temp_coeff * (REFERENCE_TEMP - TempC)
+
+	def update(self, sample):
+		if sample.Vin >= self.V_in_min:
+			self.reset()
+			return None
+		if math.isnan(sample.Vbattery):
+			if self.remaining is not None:
+				self.remaining = max(0.0, self.remaining - (sample.time - self.counted))
+				self.counted = sample.time
+			return self.remaining
+		if self.failed is None:
+			self.failed = sample.time
+		if sample.time - self.failed < self.settle:
+			return None
+		if self.start is None:
+			self.start = self.last = sample.time
+		x = sample.time - self.start
+		# Forget with a time constant of memory seconds, whatever the time between readings.
+		lam = math.exp(-max(0.0, sample.time - self.last) / self.memory)
+		self.last = self.counted = sample.time
+		p = self.p
+		px0 = p[0][0] + p[0][1] * x
+		px1 = p[1][0] + p[1][1] * x
+		gain = 1.0 / (lam + px0 + x * px1)
+		k0 = px0 * gain
+		k1 = px1 * gain
+		error = sample.Vbattery - (self.a + self.b * x)
+		self.a += k0 * error
+		self.b += k1 * error
+		# The scatter about the new line.
+		error = sample.Vbattery - (self.a + self.b * x)
+		self.errors = lam * self.errors + error * error
+		self.weight = lam * self.weight + 1.0
+		self.p = [[(p[0][0] - k0 * px0) / lam, (p[0][1] - k0 * px1) / lam],
+			[(p[1][0] - k1 * px0) / lam, (p[1][1] - k1 * px1) / lam]]
+		if x < self.min_history or not self.steady():
+			self.remaining = None
+		elif self.b >= 0:
+			self.remaining = float("inf")
+		else:
+			now = self.a + self.b * x
+			self.remaining = max(0.0, (self.empty_at(sample.TempC) - now) / self.b)
+		return self.remaining
+
+	# True if the standard error of the slope is within max_slope_error of it.
+	def steady(self):
+		variance = self.p[1][1] * self.errors / self.weight
+		return math.sqrt(max(0.0, variance)) <= self.max_slope_error * abs(self.b)
+
+	# Volts a second - negative while discharging.
+	def slope(self):
+		return self.b
@@ -0,0 +1,95 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# One reading of all 4 channels - a Sample - from the ADC.
+#
+# With burst = 1 each channel is converted once, as the scripts always did.
+# With burst > 1 each channel is converted burst times at burst_rate SPS and
+# the burst is reduced by one of the filters in uptime2/filters.py.
+#
+
+import time
+from collections import namedtuple
+
+from uptime2.boards import signed_code
+from uptime2.filters import FILTERS, stderr
+from uptime2.metrics import SCAN, DECODE
+
+#
+# time - time.time() when the reading started.
+# Vin, Vbattery, Vout, TempC - the decoded values.
+# codes - the 12 bit code of each channel (the median code of a burst).
+# noise - standard error of each value, 0 without a burst.
+# elapsed - seconds the reading took.
+#
+Sample = namedtuple("Sample", "time Vin Vbattery Vout TempC codes noise elapsed")
+
+
+NAN = float("nan")
+
+
+# A Sample for a reading which could not be made, e.g. the bus failed - the
+# values are NaN and there are no codes. See uptime2/guard.py.
+def blind_sample(start, elapsed):
+	return Sample(start, NAN, NAN, NAN, NAN, codes=(), noise=(0.0, 0.0, 0.0, 0.0), elapsed=elapsed)
+
+
+class Sampler(object):
+	#
+	# adc - a TLA2024.
+	# decoder - from BOARDS[board].decoder(vref).
+	# channels - the config MSB of channel0 - channel3.
+	# burst, burst_rate, burst_filter - see above. burst_filter is
+	# "median", "trimmed-mean" or "ema".
+	# The scan and decode times go to the Metrics of the adc.
+	#
+	def __init__(self, adc, decoder, channels, burst=1, burst_rate=3300, burst_filter="median"):
+		self.adc = adc
+		self.decoder = decoder
+		self.channels = channels
+		self.burst = burst
+		self.burst_rate = burst_rate
+		self.filter = FILTERS[burst_filter]
+		self.metrics = adc.metrics
+
+	def read(self):
+		start = time.time()
+		if self.burst <= 1:
+			scan = self.adc.scan(self.channels)
+			self.metrics.add(SCAN, scan.elapsed)
+			return self.from_scan(start, scan.codes, scan.elapsed)
+		result = self.adc.burst(self.channels, self.burst, self.burst_rate)
+		self.metrics.add(SCAN, result.elapsed)
+		return self.from_burst(start, result.codes, result.elapsed)
+
+	# Run job on the ADC, e.g. a brownout watch - at once, with no deadline.
+	# See BusGuard.call() in uptime2/guard.py.
+	def call(self, job, deadline=None):
+		return job()
+
+	# A Sample from the codes of a scan, one per channel.
+	def from_scan(self, start, codes, elapsed):
+		began = time.monotonic()
+		values = self.decoder.decode(codes)
+		sample = Sample(start, *values, codes=tuple(codes), noise=(0.0,) * len(values), elapsed=elapsed)
+		self.metrics.since(DECODE, began)
+		return sample
+
+	# A Sample from the codes of a burst, a list per channel.
+	def from_burst(self, start, bursts, elapsed):
+		began = time.monotonic()
+		values = []
+		noise = []
+		codes = []
+		for channel, burst in enumerate(bursts):
+			filtered = self.filter(self.decoder.decode_channel(channel, burst))
+			values.append(filtered.value)
+			noise.append(stderr(filtered))
+			codes.append(sorted(burst, key=signed_code)[len(burst) // 2])
+		sample = Sample(start, *values, codes=tuple(codes), noise=tuple(noise), elapsed=elapsed)
+		self.metrics.since(DECODE, began)
+		return sample
@@ -0,0 +1,91 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Sampling scheduler keyed to the power state.
+#
+# The main loops used to read the ADC and then time.sleep(zeit), so the real
+# period was zeit plus the time the reading took, and it was the same during
+# a mains failure as on a healthy supply. The scheduler keeps absolute
+# deadlines on the monotonic clock, so the period does not drift, and picks
+# the period from the last sample:
+#
+#	fast   - Vin is below V_in_min, or Vbattery is within batt_margin of V_batt_min.
+#	slow   - Vin is fine and the battery is full (Vbattery >= V_batt_full).
+#	normal - anything else.
+#
+# A deadline that has already passed when we get to wait for it is counted
+# as missed and skipped. Jitter is how late we woke up after a deadline.
+#
+
+import math
+import time
+
+FAST = "fast"
+NORMAL = "normal"
+SLOW = "slow"
+
+
+class Scheduler(object):
+	#
+	# periods - seconds between readings for FAST, NORMAL and SLOW, e.g.
+	# {FAST: 0.5, NORMAL: 2, SLOW: 10}.
+	#
+	def __init__(self, periods, V_in_min, V_batt_min, V_batt_full, batt_margin=0.2):
+		self.periods = periods
+		self.V_in_min = V_in_min
+		self.V_batt_min = V_batt_min
+		self.V_batt_full = V_batt_full
+		self.batt_margin = batt_margin
+		self.state = NORMAL
+		self.deadline = None
+		self.cycles = 0
+		self.missed = 0
+		self.jitter_max = 0.0
+		self.jitter_total = 0.0
+
+	# A blind sample (NaN, see uptime2/guard.py) is read again soon.
+	def state_for(self, sample):
+		if math.isnan(sample.Vin) or sample.Vin < self.V_in_min or sample.Vbattery < self.V_batt_min + self.batt_margin:
+			return FAST
+		if sample.Vbattery >= self.V_batt_full:
+			return SLOW
+		return NORMAL
+
+	# Seconds till the next reading is due. The period is picked from sample.
+	def next_delay(self, sample):
+		self.state = self.state_for(sample)
+		period = self.periods[self.state]
+		now = time.monotonic()
+		if self.deadline is None:
+			self.deadline = now
+		self.deadline += period
+		if now > self.deadline:
+			skipped = int((now - self.deadline) / period) + 1
+			self.missed += skipped
+			self.deadline += skipped * period
+		return self.deadline - now
+
+	# Call when woken up for the deadline given by next_delay().
+	def woke(self):
+		jitter = time.monotonic() - self.deadline
+		self.cycles += 1
+		self.jitter_total += jitter
+		self.jitter_max = max(self.jitter_max, jitter)
+
+	# Sleep till the next reading is due.
+	def wait(self, sample):
+		time.sleep(self.next_delay(sample))
+		self.woke()
+
+	def stats(self):
+		return {
+			"state": self.state,
+			"cycles": self.cycles,
+			"missed": self.missed,
+			"jitter_max": self.jitter_max,
+			"jitter_mean": self.jitter_total / self.cycles if self.cycles else 0.0,
+		}
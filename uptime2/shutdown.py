@@ -0,0 +1,221 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Shutting the Pi down once the checks say so.
+#
+# The scripts used to run "shutdown -h 2 &" through a shell, sleep 2
+# seconds and exit - nothing was flushed and nobody knew how long it took.
+# Shutdown:
+#
+#	- finds the command when the script starts, not when the battery is
+#	  empty: shutdown(8), or a hook of your own (e.g. a script which tells
+#	  other machines first), run directly without a shell. A missing
+#	  command is an error at startup.
+#	- flushes the telemetry first - the log, the snapshot, the ring and the
+#	  rollups - so the last readings are on the card.
+#	- picks the grace period - the minutes shutdown(8) waits, so users can
+#	  save their work - from the battery runtime left: grace seconds at
+#	  most, and none ("now") once the runtime left is less than halt_time
+#	  (the seconds the Pi needs to halt) plus a minute.
+#	- if the hook fails, runs shutdown(8) instead.
+#	- logs the time from the threshold crossing (see Rules.since() in
+#	  uptime2/policy.py - before the debounce) to the shutdown request, and
+#	  how long the flush took, to log_path (fsync'ed) and stdout.
+#	- if every command fails, says so, and due() tells the scripts to try
+#	  again - after retry seconds, doubled after each failure up to
+#	  retry_max - for as long as the shutdown rules stay true. The scripts
+#	  keep reading meanwhile.
+#
+# A hook gets the grace period in seconds and the reason in the environment,
+# as UPTIME2_SHUTDOWN_GRACE and UPTIME2_SHUTDOWN_REASON.
+#
+
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+
+SHUTDOWN_PATHS = ("/sbin/shutdown", "/usr/sbin/shutdown")
+SHUTDOWN_LOG = "/var/log/uptime2-shutdown.log"
+
+
+class ShutdownError(RuntimeError):
+	pass
+
+
+# The full path of program, looked up in PATH and the sbin directories.
+def find_program(program):
+	path = shutil.which(program, path=os.pathsep.join([os.environ.get("PATH", os.defpath), "/sbin", "/usr/sbin"]))
+	if path is None:
+		raise ShutdownError("%s not found" % program)
+	return path
+
+
+def shutdown_command():
+	for path in SHUTDOWN_PATHS:
+		if os.access(path, os.X_OK):
+			return path
+	return find_program("shutdown")
+
+
+class Shutdown(object):
+	#
+	# hook - a command (a string, split as the shell would, or a list) to
+	# run instead of shutdown(8). None for shutdown(8).
+	# grace - the longest grace period, seconds. Rounded down to minutes.
+	# halt_time - seconds the Pi needs to halt, see above.
+	# flush - called before the shutdown, e.g. [lambda: log.flush(fsync=True),
+	# snapshot.flush]. An error in one is logged and the rest still run.
+	# log_path - where each shutdown is logged. None for stdout only.
+	# wait - seconds to wait for the command to say it is done.
+	# retry, retry_max - seconds before the first and the longest wait before
+	# trying again after a failure, see above.
+	#
+	def __init__(self, hook=None, grace=120, halt_time=30, flush=(), log_path=SHUTDOWN_LOG, wait=5.0, retry=5.0,
+			retry_max=60.0):
+		self.commands = []
+		if hook is not None:
+			argv = shlex.split(hook) if isinstance(hook, str) else list(hook)
+			self.commands.append([find_program(argv[0])] + argv[1:])
+		self.shutdown = shutdown_command()
+		self.grace = grace
+		self.halt_time = halt_time
+		self.flush = list(flush)
+		self.log_path = log_path
+		self.wait = wait
+		self.retry = retry
+		self.retry_max = retry_max
+		self.failures = 0
+		self.retry_at = None
+		self.record = None
+
+	#
+	# True if it is time to shut down - active says whether the shutdown
+	# rules are true. At once, then, after a failure, once the backoff is
+	# over. It starts over once the rules are no longer true.
+	#
+	def due(self, active):
+		if not active:
+			self.failures = 0
+			self.retry_at = None
+			return False
+		return self.retry_at is None or time.monotonic() >= self.retry_at
+
+	# No command shut down - try again later, see due().
+	def failed(self, record):
+		self.failures += 1
+		record["ok"] = False
+		record["retry"] = min(self.retry_max, self.retry * 2 ** (self.failures - 1))
+		self.retry_at = time.monotonic() + record["retry"]
+
+	# Grace period in whole minutes for runtime seconds of battery left (None
+	# if not known).
+	def grace_minutes(self, runtime=None):
+		grace = self.grace
+		if runtime is not None:
+			grace = min(grace, runtime - self.halt_time)
+		return max(0, int(grace // 60))
+
+	def argv(self, command, minutes):
+		if command is None:
+			return [self.shutdown, "-h", "+%d" % minutes if minutes else "now"]
+		return command
+
+	#
+	# Shut down for sample, the reading on which the checks fired. reason -
+	# e.g. the rules which fired. since - sample.time of the threshold
+	# crossing, see Rules.since(), None for sample.time. Returns the record
+	# logged - a dict with the command, grace, flush and latency times, and
+	# ok, False if no command worked.
+	#
+	def __call__(self, sample, reason="", runtime=None, since=None):
+		if since is None:
+			since = sample.time
+		minutes = self.grace_minutes(runtime)
+		began = time.monotonic()
+		errors = []
+		for flush in self.flush:
+			try:
+				flush()
+			except Exception as e:
+				errors.append("%s" % e)
+		flushed = time.monotonic()
+		env = dict(os.environ, UPTIME2_SHUTDOWN_GRACE="%d" % (minutes * 60), UPTIME2_SHUTDOWN_REASON=reason)
+		proc = requested = None
+		ok = False
+		for command in self.commands + [None]:
+			argv = self.argv(command, minutes)
+			try:
+				proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL, env=env, close_fds=True, start_new_session=True)
+			except (IOError, OSError) as e:
+				proc = None
+				errors.append("%s: %s" % (argv[0], e))
+				continue
+			requested = time.time()
+			if command is None:
+				ok = True
+				break
+			try:
+				if proc.wait(self.wait) == 0:
+					ok = True
+					break
+				errors.append("%s exited with %d" % (argv[0], proc.returncode))
+			except subprocess.TimeoutExpired:
+				ok = True
+				break
+		self.record = {
+			"time": time.time(),
+			"reason": reason,
+			"command": " ".join(argv),
+			"grace": minutes * 60,
+			"Vin": sample.Vin,
+			"Vbattery": sample.Vbattery,
+			"runtime": runtime,
+			"flush": flushed - began,
+			# From the threshold crossing.
+			"since": since,
+			"latency": (requested or time.time()) - since,
+			"errors": errors,
+			"ok": True,
+			"retry": None,
+		}
+		if not ok:
+			self.failed(self.record)
+		self.log(self.record)
+		# shutdown(8) only schedules the halt - it should be back at once.
+		if proc is not None and command is None:
+			try:
+				if proc.wait(self.wait) != 0:
+					self.record["errors"].append("%s exited with %d" % (argv[0], proc.returncode))
+					self.failed(self.record)
+					self.log(self.record)
+			except subprocess.TimeoutExpired:
+				pass
+		if self.record["ok"]:
+			self.failures = 0
+			self.retry_at = None
+		return self.record
+
+	def log(self, record):
+		line = "%s shutdown: %s - %s, grace %d s, Vin %.2f, Vbattery %.2f, flush %.1f ms, threshold to request %.1f ms%s%s\n" % (
+			time.ctime(record["time"]), record["reason"] or "?", record["command"], record["grace"], record["Vin"],
+			record["Vbattery"], record["flush"] * 1000, record["latency"] * 1000,
+			"".join(", %s" % e for e in record["errors"]),
+			", failed - trying again in %g s" % record["retry"] if record["retry"] is not None else "")
+		sys.stdout.write(line)
+		sys.stdout.flush()
+		if self.log_path is None:
+			return
+		try:
+			with open(self.log_path, "a") as f:
+				f.write(line)
+				f.flush()
+				os.fsync(f.fileno())
+		except (IOError, OSError):
+			pass
@@ -0,0 +1,318 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Simulated I2C bus with TLA2024 chips, for running without a Pi.
+#
+# SimBus has the calls of smbus/smbus2 SMBus which uptime2/i2c.py uses,
+# including i2c_rdwr, so it works with both transports. Each SimTLA2024
+# models what the scripts depend on:
+#
+#	- the register pointer, the config register (reset value 0x8583) and
+#	  the conversion register.
+#	- MUX, PGA, MODE and DR in the config register. A one-shot conversion
+#	  takes 1/DR seconds (times clock), OS reads 0 until it is done, and the
+#	  conversion register keeps the old code until then. In continuous mode
+#	  a new code is there every 1/DR seconds.
+#	- 12 bit two's complement codes, clipped at the full scale range.
+#
+# The inputs are a Scenario - Vin, Vbattery, Vout and TempC as functions of
+# the seconds since the bus was opened, plus gaussian noise - turned into
+# the pin voltages of a board (uptime2/boards.py). Each transfer takes the
+# time it would at clock_hz on a real bus.
+#
+# To run a script or the daemon on the simulator:
+#
+#	UPTIME2_BUS=sim UPTIME2_SIM_SCENARIO=outage python3 uptime-2.0.py
+#
+# UPTIME2_SIM_ADDRESSES (e.g. "0x48,0x49") puts more chips on the bus. The
+# inputs are made for the board of the script, or UPTIME2_SIM_BOARD.
+#
+# Faults, to see what the scripts do when the bus fails: error_rate is the
+# fraction of transfers which fail with a Remote I/O error (a NAK), and
+# from stall_at seconds after the bus is opened every transfer hangs for
+# stall_for seconds. UPTIME2_SIM_ERROR_RATE, UPTIME2_SIM_STALL_AT and
+# UPTIME2_SIM_STALL_FOR set them.
+#
+
+import errno
+import math
+import os
+import random
+import time
+
+from uptime2.boards import BOARDS, KELVIN
+
+# Full scale range in volts for PGA (config MSB bits 3-1). 110 and 111 are 0.256V too.
+FSR = (6.144, 4.096, 2.048, 1.024, 0.512, 0.256, 0.256, 0.256)
+# MUX (config MSB bits 6-4) - the + and - input. None is GND.
+MUX = ((0, 1), (0, 3), (1, 3), (2, 3), (0, None), (1, None), (2, None), (3, None))
+DATA_RATES = (128, 250, 490, 920, 1600, 2400, 3300, 3300)
+RESET_CONFIG = (0x85, 0x83)
+
+REMOTE_IO_ERROR = 121
+
+
+#
+# Waveforms - functions of the seconds since the bus was opened.
+#
+
+def constant(value):
+	return lambda t: value
+
+
+# normal, then low from start for duration seconds (None - for good). fall
+# is the seconds it takes to get from normal to low.
+def step(normal, low, start, duration=None, fall=0.0):
+	def value(t):
+		if t < start or (duration is not None and t >= start + duration):
+			return normal
+		if fall > 0 and t < start + fall:
+			return normal + (low - normal) * (t - start) / fall
+		return low
+	return value
+
+
+# value, falling by slope volts a second from start.
+def ramp(value, slope, start=0.0):
+	return lambda t: value if t < start else value - slope * (t - start)
+
+
+class Scenario(object):
+	#
+	# Vin, Vbattery, Vout, TempC - waveforms.
+	# noise - standard deviation of each, in volts (degrees for TempC).
+	# seed - for the noise, so a run can be repeated.
+	#
+	def __init__(self, Vin, Vbattery, Vout, TempC, noise=(0.005, 0.005, 0.005, 0.2), seed=1):
+		self.waveforms = (Vin, Vbattery, Vout, TempC)
+		self.noise = noise
+		self.random = random.Random(seed)
+
+	def values(self, t):
+		return [w(t) + (self.random.gauss(0, n) if n else 0.0) for w, n in zip(self.waveforms, self.noise)]
+
+
+#
+# Scenarios by name.
+#	mains    - Vin on, battery full.
+#	outage   - Vin fails after 5 seconds, the battery falls 10 mV a second.
+#	brownout - Vin sags to 3.5V for 50 ms every 3 seconds.
+#
+def mains():
+	return Scenario(constant(5.1), constant(4.15), constant(5.05), constant(25.0))
+
+
+def outage(start=5.0):
+	return Scenario(step(5.1, 0.3, start), ramp(4.1, 0.01, start), step(5.05, 4.9, start), constant(25.0))
+
+
+def brownout():
+	return Scenario(lambda t: 3.5 if t % 3.0 < 0.05 else 5.1, constant(4.15), constant(5.05), constant(25.0))
+
+
+SCENARIOS = {"mains": mains, "outage": outage, "brownout": brownout}
+
+
+# The pin voltages of board for scenario values - the inverse of Board.volts()
+# and NTC.temperature(), with the 6.144V range the calibration is for. The
+# chip turns them into codes with the range set in its config register, so a
+# vref or PGA setting which does not match the pins clips or decodes wrong,
+# as on a real board.
+def board_pins(board):
+	def pins(values):
+		out = []
+		for channel, value in enumerate(values):
+			if channel == 3:
+				ntc = board.ntc
+				r = ntc.r25 * math.exp(ntc.beta * (1.0 / (value + KELVIN) - 1.0 / (25.0 + KELVIN)))
+				value = ntc.supply * r / (r + ntc.r_fixed)
+			pin = (value - board.offset[channel]) / board.mult[channel]
+			out.append(pin * (board.max_reading / 2048.0))
+		return out
+	return pins
+
+
+class SimTLA2024(object):
+	#
+	# inputs - returns the 4 pin voltages for the seconds since start.
+	# clock - conversion time as a multiple of 1/DR (the real chip is within 10%).
+	#
+	def __init__(self, inputs, start, clock=1.0):
+		self.inputs = inputs
+		self.start = start
+		self.clock = clock
+		self.config = list(RESET_CONFIG)
+		self.pointer = 0
+		self.conversion = 0
+		self.done = None         # time.monotonic() the one-shot conversion ends
+		self.continuous = None   # time.monotonic() continuous mode started
+		self.converted = 0       # conversions seen in continuous mode
+
+	def conversion_time(self):
+		return self.clock / DATA_RATES[self.config[1] >> 5]
+
+	def code(self, when):
+		pins = self.inputs(when - self.start)
+		positive, negative = MUX[(self.config[0] >> 4) & 0x07]
+		volts = pins[positive] - (pins[negative] if negative is not None else 0.0)
+		fsr = FSR[(self.config[0] >> 1) & 0x07]
+		code = max(-2048, min(2047, int(round(volts / fsr * 2048))))
+		return (code & 0xFFF) << 4
+
+	def update(self, now):
+		if self.done is not None and now >= self.done:
+			self.conversion = self.code(self.done)
+			self.done = None
+		if self.continuous is not None:
+			n = int((now - self.continuous) / self.conversion_time())
+			if n > self.converted:
+				self.converted = n
+				self.conversion = self.code(self.continuous + n * self.conversion_time())
+
+	def write(self, data):
+		now = time.monotonic()
+		self.update(now)
+		self.pointer = data[0] & 0x03
+		if len(data) >= 3 and self.pointer == 1:
+			self.config = [data[1] & 0x7F, data[2]]
+			if data[1] & 0x01:
+				self.continuous = None
+				if data[1] & 0x80 and self.done is None:
+					self.done = now + self.conversion_time()
+			else:
+				self.continuous = now
+				self.converted = 0
+				self.done = None
+
+	def read(self, n):
+		self.update(time.monotonic())
+		if self.pointer == 1:
+			os_bit = 0x00 if self.done is not None or self.continuous is not None else 0x80
+			value = [self.config[0] | os_bit, self.config[1]]
+		elif self.pointer == 0:
+			value = [self.conversion >> 8, self.conversion & 0xFF]
+		else:
+			value = [0, 0]
+		return (value * n)[:n]
+
+
+# A message for SimBus.i2c_rdwr - like smbus2.i2c_msg.
+class SimMsg(object):
+	def __init__(self, addr, read, data):
+		self.addr = addr
+		self.is_read = read
+		self.buf = data
+
+	@staticmethod
+	def write(addr, data):
+		return SimMsg(addr, False, list(data))
+
+	@staticmethod
+	def read(addr, length):
+		return SimMsg(addr, True, [0] * length)
+
+	def __len__(self):
+		return len(self.buf)
+
+	def __iter__(self):
+		return iter(self.buf)
+
+
+class SimBus(object):
+	# smbus2 I2cFunc.I2C - the adapter can do plain I2C messages.
+	I2C = 0x00000001
+
+	#
+	# chips - {address: SimTLA2024}.
+	# clock_hz - bus clock. Each transfer takes as long as it would - 9
+	# bits a byte plus start and stop. 0 for no delay.
+	# error_rate, stall_at, stall_for, seed - faults, see above.
+	#
+	def __init__(self, chips, clock_hz=100000, combined=True, error_rate=0.0, stall_at=None, stall_for=0.0, seed=1):
+		self.chips = chips
+		self.clock_hz = clock_hz
+		self.funcs = self.I2C if combined else 0
+		self.transactions = 0
+		self.error_rate = error_rate
+		self.stall_at = None if stall_at is None else time.monotonic() + stall_at
+		self.stall_for = stall_for
+		self.random = random.Random(seed)
+		self.closed = False
+
+	def chip(self, address):
+		if address not in self.chips:
+			raise IOError(REMOTE_IO_ERROR, "Remote I/O error")
+		return self.chips[address]
+
+	def transfer(self, nbytes):
+		if self.closed:
+			raise IOError(errno.EBADF, "Bad file descriptor")
+		self.transactions += 1
+		if self.clock_hz:
+			time.sleep((nbytes * 9 + 2) / float(self.clock_hz))
+		if self.stall_at is not None and time.monotonic() >= self.stall_at:
+			time.sleep(self.stall_for)
+		if self.error_rate and self.random.random() < self.error_rate:
+			raise IOError(REMOTE_IO_ERROR, "Remote I/O error")
+
+	def write_i2c_block_data(self, address, register, data):
+		self.transfer(2 + len(data))
+		self.chip(address).write([register] + list(data))
+
+	def read_i2c_block_data(self, address, register, length):
+		self.transfer(3 + length)
+		chip = self.chip(address)
+		chip.write([register])
+		return chip.read(length)
+
+	# SMBus words are LSB first.
+	def read_word_data(self, address, register):
+		data = self.read_i2c_block_data(address, register, 2)
+		return data[0] | (data[1] << 8)
+
+	def i2c_rdwr(self, *msgs):
+		self.transfer(sum(len(m) + 1 for m in msgs))
+		for m in msgs:
+			chip = self.chip(m.addr)
+			if m.is_read:
+				m.buf = chip.read(len(m.buf))
+			else:
+				chip.write(m.buf)
+
+	def close(self):
+		self.closed = True
+
+
+#
+# A transport (uptime2/i2c.py) on a SimBus with a chip at each address, all
+# fed the same scenario.
+#
+def open_sim_bus(number=1, scenario=None, addresses=(0x48,), board="pi-uptime", clock_hz=100000, combined=True,
+		error_rate=0.0, stall_at=None, stall_for=0.0):
+	from uptime2.i2c import RdwrTransport, SMBusTransport
+	if scenario is None:
+		scenario = mains()
+	pins = board_pins(BOARDS[board])
+	start = time.monotonic()
+	inputs = lambda t: pins(scenario.values(t))
+	bus = SimBus(dict((address, SimTLA2024(inputs, start)) for address in addresses), clock_hz, combined,
+		error_rate, stall_at, stall_for)
+	if combined:
+		return RdwrTransport(bus, SimMsg)
+	return SMBusTransport(bus)
+
+
+# open_sim_bus() set up from the UPTIME2_SIM_ variables above, for board
+# unless UPTIME2_SIM_BOARD is set.
+def open_sim_bus_from_environment(number, board="pi-uptime"):
+	env = os.environ.get
+	scenario = SCENARIOS[env("UPTIME2_SIM_SCENARIO", "mains")]()
+	addresses = [int(a, 0) for a in env("UPTIME2_SIM_ADDRESSES", "0x48").split(",")]
+	stall_at = env("UPTIME2_SIM_STALL_AT")
+	return open_sim_bus(number, scenario, addresses, env("UPTIME2_SIM_BOARD", board),
+		error_rate=float(env("UPTIME2_SIM_ERROR_RATE", 0)), stall_at=None if stall_at is None else float(stall_at),
+		stall_for=float(env("UPTIME2_SIM_STALL_FOR", 0)))
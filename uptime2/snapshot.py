@@ -0,0 +1,119 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Shared memory snapshot of the latest reading.
+#
+# The daemon writes each sample into a small fixed record in /dev/shm.
+# Any local program can map the record and read the latest values with no
+# system calls and no I2C traffic, however many programs are reading.
+#
+# Layout, little endian, 64 bytes:
+#
+#	0   4s  magic "UPT2"
+#	4   I   version (1)
+#	8   Q   lock - odd while the writer is updating the record
+#	16  Q   seq - goes up by one for each reading
+#	24  d   time - time.time() of the reading
+#	32  d   Vin
+#	40  d   Vout
+#	48  d   Vbattery
+#	56  d   TempC
+#
+# The lock is a seqlock: the writer makes it odd, writes the values and
+# makes it even again. A reader reads the lock, the values and the lock
+# again, and retries if the lock was odd or has changed.
+#
+# Reading from another program or from the shell:
+#
+#	from uptime2.snapshot import SnapshotReader
+#	print(SnapshotReader().read())
+#
+#	python3 -m uptime2.snapshot
+#
+
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+
+SNAPSHOT_PATH = "/dev/shm/uptime2.snapshot"
+
+MAGIC = b"UPT2"
+VERSION = 1
+HEADER = struct.Struct("<4sI")
+LOCK = struct.Struct("<Q")
+VALUES = struct.Struct("<Qddddd")
+LOCK_OFFSET = 8
+VALUES_OFFSET = 16
+SIZE = VALUES_OFFSET + VALUES.size
+
+# Give up on a record which stays locked for this many tries - the writer
+# died in the middle of an update.
+MAX_TRIES = 10000
+
+Snapshot = namedtuple("Snapshot", "seq time Vin Vout Vbattery TempC")
+
+
+class SnapshotWriter(object):
+	def __init__(self, path=SNAPSHOT_PATH, mode=0o644):
+		fd = os.open(path, os.O_RDWR | os.O_CREAT, mode)
+		try:
+			os.ftruncate(fd, SIZE)
+			self.map = mmap.mmap(fd, SIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+		finally:
+			os.close(fd)
+		HEADER.pack_into(self.map, 0, MAGIC, VERSION)
+		self.lock = LOCK.unpack_from(self.map, LOCK_OFFSET)[0] & ~1
+
+	# Publish a sample. seq is the daemon's reading counter.
+	def write(self, sample, seq):
+		self.lock += 1
+		LOCK.pack_into(self.map, LOCK_OFFSET, self.lock)
+		VALUES.pack_into(self.map, VALUES_OFFSET, seq, sample.time, sample.Vin, sample.Vout, sample.Vbattery, sample.TempC)
+		self.lock += 1
+		LOCK.pack_into(self.map, LOCK_OFFSET, self.lock)
+
+	# Write the snapshot to the file now, e.g. before shutting down.
+	def flush(self):
+		self.map.flush()
+
+	def close(self):
+		self.map.close()
+
+
+class SnapshotReader(object):
+	def __init__(self, path=SNAPSHOT_PATH):
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			self.map = mmap.mmap(fd, SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+		finally:
+			os.close(fd)
+		magic, version = HEADER.unpack_from(self.map, 0)
+		if magic != MAGIC or version != VERSION:
+			self.map.close()
+			raise IOError("%s is not an uptime2 snapshot" % path)
+
+	# A consistent copy of the record. seq is 0 until the first reading.
+	def read(self):
+		for i in range(MAX_TRIES):
+			before = LOCK.unpack_from(self.map, LOCK_OFFSET)[0]
+			if before & 1:
+				continue
+			values = VALUES.unpack_from(self.map, VALUES_OFFSET)
+			if LOCK.unpack_from(self.map, LOCK_OFFSET)[0] == before:
+				return Snapshot(*values)
+		raise IOError("uptime2 snapshot stays locked - is the writer stuck?")
+
+	def close(self):
+		self.map.close()
+
+
+if __name__ == "__main__":
+	snapshot = SnapshotReader().read()
+	print("%s seq %d Vin %5.2f Vout %5.2f Vbattery %5.2f %6.2fC" % (time.ctime(snapshot.time), snapshot.seq,
+		snapshot.Vin, snapshot.Vout, snapshot.Vbattery, snapshot.TempC))
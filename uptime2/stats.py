@@ -0,0 +1,381 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Statistics over the recorded readings, in constant memory.
+#
+# The readings are streamed one at a time - from the sample ring file
+# (uptime2/ringbuf.py) or the CSV log (uptime2/logsink.py) - so a long
+# history can be summarised on a Pi Zero. For each channel, for all the
+# readings and for each power state, the summary keeps:
+#
+#	- count, min, max, mean and standard deviation (running moments).
+#	- a quantile sketch, for percentiles such as p1 or p99. Values are
+#	  counted in buckets whose width grows with the value (each bucket is
+#	  accuracy wide relative to its value), so a percentile is within
+#	  accuracy (0.5% by default) of the true value. The number of buckets
+#	  is capped at max_bins.
+#
+# Power states, from Vin:
+#
+#	mains      - Vin >= V_in_min.
+#	brownout   - Vin is below V_in_min but above V_in_off.
+#	on-battery - Vin is below V_in_off, the input is gone.
+#
+# The time between two readings counts to the state of the first one,
+# unless it is more than gap seconds (the monitor was not running).
+#
+# Summaries merge - the sketches and moments of the same channel and state
+# add up - so the summaries of many boards can be saved (--save) and
+# combined on another host (--merge).
+#
+# Examples:
+#
+#	python3 -m uptime2.stats /var/lib/uptime2/samples.ring --board piz-uptime
+#	python3 -m uptime2.stats /var/log/uptime2.csv* --save $(hostname).json
+#	python3 -m uptime2.stats --merge board1.json board2.json
+#
+
+import csv
+import json
+import math
+
+from uptime2.boards import CHANNELS
+
+MAINS = "mains"
+BROWNOUT = "brownout"
+ON_BATTERY = "on-battery"
+STATES = (MAINS, BROWNOUT, ON_BATTERY)
+ALL = "all"
+
+# Smallest magnitude which gets a bucket of its own - anything closer to
+# 0 is counted as 0.
+MIN_VALUE = 1e-3
+
+
+#
+# Mergeable quantile sketch with relative accuracy - a value v goes in
+# bucket ceil(log(v) / log(gamma)), one set of buckets for positive and
+# one for negative values.
+#
+class Sketch(object):
+	def __init__(self, accuracy=0.005, max_bins=2048):
+		self.accuracy = accuracy
+		self.max_bins = max_bins
+		self.gamma = (1 + accuracy) / (1 - accuracy)
+		self.log_gamma = math.log(self.gamma)
+		self.positive = {}
+		self.negative = {}
+		self.zeros = 0
+		self.count = 0
+
+	def key(self, value):
+		return int(math.ceil(math.log(value) / self.log_gamma))
+
+	def value(self, key):
+		return 2 * self.gamma ** key / (self.gamma + 1)
+
+	def add(self, value, count=1):
+		if value > MIN_VALUE:
+			k = self.key(value)
+			self.positive[k] = self.positive.get(k, 0) + count
+		elif value < -MIN_VALUE:
+			k = self.key(-value)
+			self.negative[k] = self.negative.get(k, 0) + count
+		else:
+			self.zeros += count
+		self.count += count
+		if len(self.positive) + len(self.negative) > self.max_bins:
+			self.collapse()
+
+	# Too many buckets - fold the ones closest to 0 into their neighbour.
+	# Only the lowest percentiles lose accuracy.
+	def collapse(self):
+		while len(self.positive) + len(self.negative) > self.max_bins:
+			store = self.positive if len(self.positive) >= len(self.negative) else self.negative
+			low = sorted(store)[:2]
+			store[low[1]] += store.pop(low[0])
+
+	def merge(self, other):
+		if other.accuracy != self.accuracy:
+			raise ValueError("cannot merge sketches of different accuracy")
+		for k, n in other.positive.items():
+			self.positive[k] = self.positive.get(k, 0) + n
+		for k, n in other.negative.items():
+			self.negative[k] = self.negative.get(k, 0) + n
+		self.zeros += other.zeros
+		self.count += other.count
+		if len(self.positive) + len(self.negative) > self.max_bins:
+			self.collapse()
+
+	# The value at quantile q (0 to 1), NaN if nothing was added.
+	def quantile(self, q):
+		if not self.count:
+			return float("nan")
+		rank = q * (self.count - 1)
+		seen = 0
+		for k in sorted(self.negative, reverse=True):
+			seen += self.negative[k]
+			if seen > rank:
+				return -self.value(k)
+		seen += self.zeros
+		if seen > rank:
+			return 0.0
+		for k in sorted(self.positive):
+			seen += self.positive[k]
+			if seen > rank:
+				return self.value(k)
+		return self.value(max(self.positive))
+
+	def to_dict(self):
+		return {"accuracy": self.accuracy, "max_bins": self.max_bins, "zeros": self.zeros,
+			"positive": dict((str(k), n) for k, n in self.positive.items()),
+			"negative": dict((str(k), n) for k, n in self.negative.items())}
+
+	@classmethod
+	def from_dict(cls, d):
+		sketch = cls(d["accuracy"], d["max_bins"])
+		sketch.positive = dict((int(k), n) for k, n in d["positive"].items())
+		sketch.negative = dict((int(k), n) for k, n in d["negative"].items())
+		sketch.zeros = d["zeros"]
+		sketch.count = sketch.zeros + sum(sketch.positive.values()) + sum(sketch.negative.values())
+		return sketch
+
+
+#
+# Statistics of one channel - running moments (Welford, merged with Chan's
+# formula) and a Sketch. NaN values (e.g. TempC with the NTC out of range)
+# are counted apart and otherwise ignored.
+#
+class Stats(object):
+	def __init__(self, accuracy=0.005, max_bins=2048):
+		self.n = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+		self.min = float("nan")
+		self.max = float("nan")
+		self.nan = 0
+		self.sketch = Sketch(accuracy, max_bins)
+
+	def add(self, value):
+		if math.isnan(value):
+			self.nan += 1
+			return
+		self.n += 1
+		delta = value - self.mean
+		self.mean += delta / self.n
+		self.m2 += delta * (value - self.mean)
+		if self.n == 1 or value < self.min:
+			self.min = value
+		if self.n == 1 or value > self.max:
+			self.max = value
+		self.sketch.add(value)
+
+	def merge(self, other):
+		if other.n:
+			n = self.n + other.n
+			delta = other.mean - self.mean
+			self.mean += delta * other.n / n
+			self.m2 += other.m2 + delta * delta * self.n * other.n / n
+			self.min = other.min if not self.n else min(self.min, other.min)
+			self.max = other.max if not self.n else max(self.max, other.max)
+			self.n = n
+		self.nan += other.nan
+		self.sketch.merge(other.sketch)
+
+	def stdev(self):
+		return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else float("nan")
+
+	# Within the accuracy of the sketch, but never outside min and max.
+	def percentile(self, p):
+		value = self.sketch.quantile(p / 100.0)
+		return min(max(value, self.min), self.max) if self.n else value
+
+	def to_dict(self):
+		return {"n": self.n, "mean": self.mean, "m2": self.m2, "min": self.min if self.n else None,
+			"max": self.max if self.n else None, "nan": self.nan, "sketch": self.sketch.to_dict()}
+
+	@classmethod
+	def from_dict(cls, d):
+		stats = cls()
+		stats.n = d["n"]
+		stats.mean = d["mean"]
+		stats.m2 = d["m2"]
+		stats.min = d["min"] if d["min"] is not None else float("nan")
+		stats.max = d["max"] if d["max"] is not None else float("nan")
+		stats.nan = d["nan"]
+		stats.sketch = Sketch.from_dict(d["sketch"])
+		return stats
+
+
+def power_state(Vin, V_in_min, V_in_off):
+	if Vin >= V_in_min:
+		return MAINS
+	if Vin >= V_in_off:
+		return BROWNOUT
+	return ON_BATTERY
+
+
+class Summary(object):
+	#
+	# name - what the readings are from, e.g. the host name.
+	# V_in_min, V_in_off - the power state limits, see above.
+	# gap - longest time between readings counted to a power state (seconds).
+	# accuracy, max_bins - see Sketch.
+	#
+	def __init__(self, name="", V_in_min=3.8, V_in_off=1.0, gap=60, accuracy=0.005, max_bins=2048):
+		self.name = name
+		self.V_in_min = V_in_min
+		self.V_in_off = V_in_off
+		self.gap = gap
+		self.channels = dict((group, dict((c, Stats(accuracy, max_bins)) for c in CHANNELS)) for group in (ALL,) + STATES)
+		self.seconds = dict((state, 0.0) for state in STATES)
+		self.first = self.last = None
+		self.last_state = None
+
+	# values - Vin, Vbattery, Vout, TempC.
+	def add(self, t, values):
+		state = power_state(values[0], self.V_in_min, self.V_in_off)
+		for c, v in zip(CHANNELS, values):
+			self.channels[ALL][c].add(v)
+			self.channels[state][c].add(v)
+		if self.last is not None and 0 <= t - self.last <= self.gap:
+			self.seconds[self.last_state] += t - self.last
+		if self.first is None:
+			self.first = t
+		self.last = t
+		self.last_state = state
+
+	# Daemon sink - see uptime2/daemon.py.
+	def write(self, sample, seq):
+		self.add(sample.time, (sample.Vin, sample.Vbattery, sample.Vout, sample.TempC))
+
+	def close(self):
+		pass
+
+	def merge(self, other):
+		for group, channels in other.channels.items():
+			for c, stats in channels.items():
+				self.channels[group][c].merge(stats)
+		for state, seconds in other.seconds.items():
+			self.seconds[state] += seconds
+		if other.first is not None:
+			self.first = other.first if self.first is None else min(self.first, other.first)
+			self.last = other.last if self.last is None else max(self.last, other.last)
+
+	def to_dict(self):
+		return {"name": self.name, "V_in_min": self.V_in_min, "V_in_off": self.V_in_off, "gap": self.gap,
+			"first": self.first, "last": self.last, "seconds": self.seconds,
+			"channels": dict((group, dict((c, s.to_dict()) for c, s in channels.items())) for group, channels in self.channels.items())}
+
+	@classmethod
+	def from_dict(cls, d):
+		summary = cls(d["name"], d["V_in_min"], d["V_in_off"], d["gap"])
+		summary.first = d["first"]
+		summary.last = d["last"]
+		summary.seconds = dict(d["seconds"])
+		summary.channels = dict((group, dict((c, Stats.from_dict(s)) for c, s in channels.items())) for group, channels in d["channels"].items())
+		return summary
+
+
+#
+# Readings as (time, (Vin, Vbattery, Vout, TempC)), one at a time.
+#
+
+def csv_readings(path):
+	with open(path) as f:
+		for row in csv.DictReader(f):
+			yield float(row["time"]), tuple(float(row[c]) for c in CHANNELS)
+
+
+def ring_readings(path, decoder):
+	from uptime2.ringbuf import SampleRing, capacity_of
+	ring = SampleRing(path, capacity_of(path), readonly=True)
+	try:
+		for t, codes in ring.readings():
+			yield t, decoder.decode(codes)
+	finally:
+		ring.close()
+
+
+def readings(path, decoder):
+	from uptime2.ringbuf import SAMPLE_MAGIC
+	with open(path, "rb") as f:
+		magic = f.read(len(SAMPLE_MAGIC))
+	if magic == SAMPLE_MAGIC:
+		return ring_readings(path, decoder)
+	return csv_readings(path)
+
+
+def duration(seconds):
+	if seconds >= 86400:
+		return "%.1fd" % (seconds / 86400)
+	if seconds >= 3600:
+		return "%.1fh" % (seconds / 3600)
+	return "%.0fs" % seconds
+
+
+def report(summary, percentiles=(1, 5, 50, 95, 99)):
+	lines = []
+	if summary.name:
+		lines.append(summary.name)
+	total = sum(summary.seconds.values())
+	for state in STATES:
+		share = 100.0 * summary.seconds[state] / total if total else 0.0
+		lines.append("%-11s %10s %6.2f%%" % (state, duration(summary.seconds[state]), share))
+	head = "%-11s %-9s %8s %7s %7s %7s %7s" % ("", "", "n", "min", "mean", "stdev", "max")
+	lines.append(head + "".join(" %7s" % ("p%g" % p) for p in percentiles))
+	for group in (ALL,) + STATES:
+		for c in CHANNELS:
+			s = summary.channels[group][c]
+			if not s.n:
+				continue
+			line = "%-11s %-9s %8d %7.3f %7.3f %7.3f %7.3f" % (group, c, s.n, s.min, s.mean, s.stdev(), s.max)
+			lines.append(line + "".join(" %7.3f" % s.percentile(p) for p in percentiles))
+	return "\n".join(lines)
+
+
+if __name__ == "__main__":
+	import argparse
+	import socket
+	from uptime2.boards import BOARDS
+
+	parser = argparse.ArgumentParser(description="Statistics over recorded uptime2 readings, or merge saved summaries.")
+	parser.add_argument("paths", nargs="*", help="sample ring files and/or CSV logs, or summaries with --merge")
+	parser.add_argument("--merge", action="store_true", help="the paths are summaries saved with --save")
+	parser.add_argument("--board", default="pi-uptime", choices=sorted(BOARDS), help="board, to decode ring files")
+	parser.add_argument("--vref", type=float, default=6.144)
+	parser.add_argument("--name", default=socket.gethostname())
+	parser.add_argument("--V_in_min", type=float, default=3.8)
+	parser.add_argument("--V_in_off", type=float, default=1.0)
+	parser.add_argument("--gap", type=float, default=60)
+	parser.add_argument("--accuracy", type=float, default=0.005)
+	parser.add_argument("--percentiles", default="1,5,50,95,99")
+	parser.add_argument("--save", help="save the summary as JSON, for --merge")
+	args = parser.parse_args()
+
+	if args.merge:
+		summary = None
+		for path in args.paths:
+			with open(path) as f:
+				s = Summary.from_dict(json.load(f))
+			if summary is None:
+				summary = s
+			else:
+				summary.merge(s)
+				summary.name = "%s + %s" % (summary.name, s.name)
+	else:
+		summary = Summary(args.name, args.V_in_min, args.V_in_off, args.gap, args.accuracy)
+		decoder = BOARDS[args.board].decoder(args.vref)
+		for path in args.paths:
+			for t, values in readings(path, decoder):
+				summary.add(t, values)
+	if summary is None:
+		parser.error("no summaries to merge")
+	print(report(summary, [float(p) for p in args.percentiles.split(",")]))
+	if args.save:
+		with open(args.save, "w") as f:
+			json.dump(summary.to_dict(), f)
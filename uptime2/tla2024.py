@@ -0,0 +1,289 @@
+######################################################################
+# (C) ALCHEMY POWER INC 2016,2017 etc. - ALL RIGHT RESERVED.
+# CODE SUBJECT TO CHANGE AT ANY TIME.
+# YOU CAN COPY/DISTRIBUTE THE CODE AS NEEDED AS LONG AS YOU MAINTAIN
+# THE HEADERS (THIS PORTION) OF THE TEXT IN THE FILE.
+######################################################################
+#
+# Scan engine for the TI TLA2024 - 4 channel, 12 bit ADC.
+# See Page 17 and 18 of the data sheet for the register layout.
+#
+# The old getreading() reset the config and data registers, slept tiempo,
+# triggered a one-shot conversion and slept tiempo again - at least 0.2
+# seconds per channel. The chip finishes a conversion in 1/SPS seconds, so
+# here we trigger the conversion and poll the OS bit of the config register
+# until the chip says it is done (or until a deadline passes). The register
+# resets are not needed - every trigger writes the full config register.
+#
+# Register access goes through a transport - see uptime2/i2c.py. A scan reads
+# the data register of one channel and triggers the next one in the same
+# call, which is a single ioctl when the adapter can do combined messages.
+#
+# Each TLA2024 times its bus calls and conversion waits into a Metrics (see
+# uptime2/metrics.py) and counts the bus errors and timeouts.
+#
+# A bus call which fails (a NAK, arbitration lost) is tried again up to
+# retries times, after backoff, 2 x backoff, ... seconds. Every call is
+# safe to repeat - each write sets the whole config register. If it still
+# fails the IOError goes up - see uptime2/guard.py for what happens then.
+#
+# owner - the thread which reads the chip, or None for any. A thread which
+# was left behind stuck in a bus call (see uptime2/guard.py) gets Abandoned
+# on its next bus call or data rate change, so it can not mix its scan with
+# the one of the thread which took over.
+#
+
+import threading
+import time
+from collections import namedtuple
+
+from uptime2.i2c import SMBusTransport
+from uptime2.metrics import Metrics, TRIGGER, POLL, WAIT, READ, BUS_ERRORS, TIMEOUTS, POLLS, RETRIES
+
+#
+# Config register, MSB (the channel# values in the scripts).
+# Bit 7 is OS. Writing 1 starts a one-shot conversion. When read back it
+# is 0 while a conversion is in progress and 1 when the chip is idle.
+#
+OS_BIT          = 0x80
+
+#
+# Config register, MSB bit 0 is MODE - 1 for one-shot conversions (the
+# channel# values in the scripts), 0 to convert continuously.
+#
+MODE_BIT        = 0x01
+
+#
+# Config MSB of the 4 inputs as the boards use them - single ended AIN0 to
+# AIN3, +/- 6.144V, one-shot. The same as channel0 - channel3 in the scripts.
+#
+SINGLE_ENDED    = (0b11000001, 0b11010001, 0b11100001, 0b11110001)
+
+#
+# Data rates in SPS for DR[2:0] in the LSB of the config register. See Table 8.
+# DR = 111 is also 3300 SPS. Bits 4-0 of the LSB must be written as 00011.
+#
+DATA_RATES = (128, 250, 490, 920, 1600, 2400, 3300)
+LSB_RESERVED    = 0x03
+
+#
+# The conversion clock is +/- 10% - allow for a slow chip before polling.
+#
+CLOCK_TOLERANCE = 1.1
+
+# Poll the OS bit no faster than this (seconds).
+MIN_POLL        = 0.0005
+
+
+class ConversionTimeout(IOError):
+	pass
+
+
+class Abandoned(IOError):
+	pass
+
+
+# codes - the 12 bit code read for each channel, in the order asked for.
+# times - seconds each conversion took, from trigger to data read.
+# elapsed - seconds for the whole scan.
+ScanResult = namedtuple("ScanResult", "codes times elapsed")
+
+# codes - a list of the codes read for each channel.
+# elapsed - seconds for the whole burst.
+BurstResult = namedtuple("BurstResult", "codes elapsed")
+
+
+# Return the config LSB for a data rate in SPS.
+def config_lsb(data_rate):
+	if data_rate not in DATA_RATES:
+		raise ValueError("TLA2024 data rate must be one of %s SPS" % (DATA_RATES,))
+	return (DATA_RATES.index(data_rate) << 5) | LSB_RESERVED
+
+
+class TLA2024(object):
+	#
+	# bus - a transport from uptime2.i2c.open_bus(), or a plain SMBus.
+	# address - I2C address of the ADC - 0x48, 0x49 or 0x4B.
+	# data_rate - SPS, see DATA_RATES.
+	# timeout - the longest we wait for one conversion, in seconds.
+	# metrics - a Metrics to time the stages into, shared e.g. with the
+	# Sampler and the Daemon. None for a new one.
+	# retries, backoff - see above.
+	#
+	def __init__(self, bus, address, data_rate=490, timeout=0.1, metrics=None, retries=2, backoff=0.001):
+		if not hasattr(bus, "read_conversion"):
+			bus = SMBusTransport(bus)
+		self.bus = bus
+		self.address = address
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.metrics = metrics if metrics is not None else Metrics()
+		self.owner = None
+		self.set_data_rate(data_rate)
+
+	# Raise Abandoned if the calling thread is not the owner - see above.
+	def check_owner(self):
+		owner = self.owner
+		if owner is not None and owner is not threading.current_thread():
+			raise Abandoned("TLA2024 at 0x%02x: %s was left behind" % (self.address, threading.current_thread().name))
+
+	def set_data_rate(self, data_rate):
+		self.check_owner()
+		self.lsb = config_lsb(data_rate)
+		self.data_rate = data_rate
+		self.conversion_time = CLOCK_TOLERANCE / data_rate
+		self.poll_interval = max(MIN_POLL, self.conversion_time / 8)
+
+	# Call the transport method with the address and args, timed into stage.
+	# Retried as above.
+	def _call(self, stage, method, *args):
+		delay = self.backoff
+		for attempt in range(self.retries + 1):
+			self.check_owner()
+			start = time.monotonic()
+			try:
+				return method(self.address, *args)
+			except (IOError, OSError):
+				self.metrics.count(BUS_ERRORS)
+				if attempt == self.retries:
+					raise
+			finally:
+				self.metrics.since(stage, start)
+			self.metrics.count(RETRIES)
+			time.sleep(delay)
+			delay *= 2
+
+	# Start a one-shot conversion. channel is the config MSB, e.g. 0b11000001.
+	def trigger(self, channel):
+		self._call(TRIGGER, self.bus.write_config, channel | OS_BIT, self.lsb)
+
+	# True once the conversion has finished.
+	def ready(self):
+		self.metrics.count(POLLS)
+		return bool(self._call(POLL, self.bus.read_config)[0] & OS_BIT)
+
+	# The 4 LSB bits of the data register are always 0. See page 15 of data sheet.
+	# stage - what the time is added to, see uptime2/metrics.py.
+	def read_code(self, stage=READ):
+		return self._call(stage, self.bus.read_conversion) >> 4
+
+	# Read the finished conversion and start one on channel.
+	def read_code_and_trigger(self, channel):
+		return self._call(READ, self.bus.read_conversion_and_write_config, channel | OS_BIT, self.lsb) >> 4
+
+	# Wait for the conversion started at start (time.monotonic()) to finish.
+	def wait(self, start):
+		deadline = start + self.timeout
+		# Sleep out what is left of the conversion time - none of it if other
+		# work (e.g. another chip, see scan_many()) has taken that long.
+		left = start + self.conversion_time - time.monotonic()
+		if left > 0:
+			time.sleep(left)
+		while not self.ready():
+			if time.monotonic() >= deadline:
+				self.metrics.count(TIMEOUTS)
+				raise ConversionTimeout("TLA2024 at 0x%02x: no conversion after %.3f seconds" % (self.address, self.timeout))
+			time.sleep(self.poll_interval)
+		self.metrics.since(WAIT, start)
+
+	# Convert channel over and over at the data rate. read_code() then returns
+	# the latest conversion - with the combined transport that is a bare 2
+	# byte read. The next trigger() goes back to one-shot conversions.
+	def start_continuous(self, channel):
+		self._call(TRIGGER, self.bus.write_config, channel & ~(OS_BIT | MODE_BIT), self.lsb)
+
+	# Stop converting - the chip powers down after the conversion in progress.
+	def stop_continuous(self, channel):
+		self._call(TRIGGER, self.bus.write_config, (channel | MODE_BIT) & ~OS_BIT, self.lsb)
+
+	# Convert one channel. Returns the 12 bit code and the seconds it took.
+	def convert(self, channel):
+		start = time.monotonic()
+		self.trigger(channel)
+		self.wait(start)
+		code = self.read_code()
+		return code, time.monotonic() - start
+
+	# Convert each channel in turn, back-to-back. The read of each channel
+	# also triggers the next one.
+	def scan(self, channels):
+		start = began = time.monotonic()
+		codes = []
+		times = []
+		self.trigger(channels[0])
+		for next_channel in list(channels[1:]) + [None]:
+			self.wait(began)
+			if next_channel is None:
+				code = self.read_code()
+			else:
+				code = self.read_code_and_trigger(next_channel)
+			now = time.monotonic()
+			codes.append(code)
+			times.append(now - began)
+			began = now
+		return ScanResult(codes, times, now - start)
+
+	# Take n conversions of each channel at data_rate, back-to-back, for
+	# oversampling. The data rate is put back afterwards.
+	def burst(self, channels, n, data_rate=3300):
+		rate = self.data_rate
+		self.set_data_rate(data_rate)
+		try:
+			scan = self.scan([channel for channel in channels for i in range(n)])
+		finally:
+			self.set_data_rate(rate)
+		codes = [scan.codes[i * n:(i + 1) * n] for i in range(len(channels))]
+		return BurstResult(codes, scan.elapsed)
+
+
+# True if a TLA2024 answers at address on the transport bus - its config
+# register has the reserved bits set as the chip always has them.
+def probe(bus, address):
+	try:
+		msb, lsb = bus.read_config(address)
+	except (IOError, OSError):
+		return False
+	return (lsb & 0x1F) == LSB_RESERVED
+
+
+#
+# Scan several ADCs, e.g. stacked boards on one bus, at the same time. Each
+# step triggers the next conversion on one chip and moves on to the next
+# chip while it converts, so scanning N chips takes about as long as one.
+# Returns a ScanResult per ADC.
+#
+def scan_many(adcs, channels):
+	start = time.monotonic()
+	began = []
+	codes = [[] for adc in adcs]
+	times = [[] for adc in adcs]
+	for adc in adcs:
+		adc.trigger(channels[0])
+		began.append(time.monotonic())
+	for next_channel in list(channels[1:]) + [None]:
+		for i, adc in enumerate(adcs):
+			adc.wait(began[i])
+			if next_channel is None:
+				code = adc.read_code()
+			else:
+				code = adc.read_code_and_trigger(next_channel)
+			now = time.monotonic()
+			codes[i].append(code)
+			times[i].append(now - began[i])
+			began[i] = now
+	elapsed = time.monotonic() - start
+	return [ScanResult(codes[i], times[i], elapsed) for i in range(len(adcs))]
+
+
+# TLA2024.burst() on several ADCs at the same time. Returns a BurstResult per ADC.
+def burst_many(adcs, channels, n, data_rate=3300):
+	rates = [adc.data_rate for adc in adcs]
+	for adc in adcs:
+		adc.set_data_rate(data_rate)
+	try:
+		scans = scan_many(adcs, [channel for channel in channels for i in range(n)])
+	finally:
+		for adc, rate in zip(adcs, rates):
+			adc.set_data_rate(rate)
+	return [BurstResult([scan.codes[i * n:(i + 1) * n] for i in range(len(channels))], scan.elapsed) for scan in scans]